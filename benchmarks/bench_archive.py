@@ -0,0 +1,93 @@
+#!/usr/bin/python
+"""
+Runs the archive pipeline against a directory, and optionally an S3 compatible endpoint such as a local
+MinIO or moto_server. Queues a set of files where some have the same content, then reports how long
+archive_photo blocked the caller, how long the archive took to drain and how many duplicates were skipped.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from common import load_rpi_security
+
+def create_files(path, count, size, duplicate_ratio, large_mb):
+    random.seed(0)
+    files = []
+    contents = []
+    for i in range(count):
+        if contents and random.random() < duplicate_ratio:
+            content = random.choice(contents)
+        else:
+            content = os.urandom(size)
+            contents.append(content)
+        file_path = os.path.join(path, 'rpi-security-%04d.jpeg' % i)
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        files.append(file_path)
+    if large_mb:
+        file_path = os.path.join(path, 'rpi-security-large.mp4')
+        with open(file_path, 'wb') as f:
+            for i in range(large_mb):
+                f.write(os.urandom(1024 * 1024))
+        files.append(file_path)
+    return files, len(contents) + (1 if large_mb else 0)
+
+def run(rpis, name, backend, db_file, files, batch_size):
+    rpis.archiver = rpis.Archiver(backend, db_file, batch_size=batch_size, batch_interval=0.5)
+    archived = []
+    archive = rpis.archiver.archive
+    rpis.archiver.archive = lambda batch: archived.extend(archive(batch))
+    blocked = []
+    start = time.time()
+    for file_path in files:
+        call_start = time.time()
+        rpis.archive_photo(file_path)
+        blocked.append(time.time() - call_start)
+    queued = time.time()
+    batches = 0
+    while not rpis.archiver.queue.empty():
+        rpis.archiver.archive(rpis.archiver.get_batch())
+        batches += 1
+    elapsed = time.time() - start
+    print('%-10s files: %-5s archived: %-5s duplicates skipped: %-5s batches: %-4s drain time: %6.3fs  archive_photo max: %.1f us  queueing: %.3fs' % (
+        name, len(files), len(archived), len(files) - len(archived), batches, elapsed, max(blocked) * 1e6, queued - start))
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark the archive pipeline.')
+    p.add_argument('-n', '--count', help='Number of files to archive.', type=int, default=200)
+    p.add_argument('-s', '--size', help='Size of each file in KB.', type=int, default=200)
+    p.add_argument('-d', '--duplicate-ratio', help='Fraction of files that repeat earlier content.', type=float, default=0.3)
+    p.add_argument('-b', '--batch-size', help='archive_batch_size to use.', type=int, default=20)
+    p.add_argument('-l', '--large-mb', help='Also archive one file of this many MB to exercise chunked uploads.', type=int, default=32)
+    p.add_argument('--s3-endpoint', help='S3 compatible endpoint URL to also benchmark, e.g. http://127.0.0.1:5000')
+    p.add_argument('--s3-bucket', help='Bucket to use, it is created if it does not exist.', default='rpi-security-bench')
+    args = p.parse_args()
+    rpis = load_rpi_security()
+    temp_dir = tempfile.mkdtemp(prefix='rpi-security-bench-')
+    try:
+        source = os.path.join(temp_dir, 'source')
+        os.makedirs(source)
+        files, unique = create_files(source, args.count, args.size * 1024, args.duplicate_ratio, args.large_mb)
+        print('Created %s files with %s unique contents' % (len(files), unique))
+        backend = rpis.DirectoryArchive(os.path.join(temp_dir, 'archive'))
+        run(rpis, 'directory', backend, os.path.join(temp_dir, 'directory.db'), files, args.batch_size)
+        # A second pass finds everything in the index
+        run(rpis, 'directory', backend, os.path.join(temp_dir, 'directory.db'), files, args.batch_size)
+        if args.s3_endpoint:
+            backend = rpis.S3Archive(args.s3_bucket, prefix='bench/', endpoint=args.s3_endpoint)
+            try:
+                backend.client.create_bucket(Bucket=args.s3_bucket)
+            except backend.client.exceptions.BucketAlreadyOwnedByYou:
+                pass
+            run(rpis, 's3', backend, os.path.join(temp_dir, 's3.db'), files, args.batch_size)
+            objects = backend.client.list_objects_v2(Bucket=args.s3_bucket, Prefix='bench/').get('KeyCount')
+            print('Objects in bucket: %s' % objects)
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == "__main__":
+    main()
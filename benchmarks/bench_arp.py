@@ -0,0 +1,115 @@
+#!/usr/bin/python
+"""
+Compares arp_ping_macs with the previous implementation that sent one srp per MAC address against a fake
+scapy srp. The fake srp sleeps for the time a real probe round would take: a small cost per packet sent
+plus the full timeout when any packet goes unanswered. It reports how long each probe round took.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from common import load_rpi_security, Namespace
+from simulation import FakeLayer
+
+NETWORK = '192.168.1.0/24'
+
+class FakeNetwork(object):
+    """
+    A network where some MAC addresses are online at known IPs. Records the duration of every srp round.
+    """
+    def __init__(self, online, packet_cost, answer_time, scale):
+        self.online = online
+        self.packet_cost = packet_cost
+        self.answer_time = answer_time
+        self.scale = scale
+        self.rounds = []
+
+    def srp(self, packets, timeout=1, verbose=False):
+        if not isinstance(packets, list):
+            packets = [packets]
+        sent = 0
+        answered = []
+        for packet in packets:
+            targets = 256 if packet.pdst == NETWORK else 1
+            sent += targets
+            ip = self.online.get(packet.dst)
+            if ip and (targets > 1 or packet.pdst == ip):
+                answered.append((packet, FakeLayer(hwsrc=packet.dst, psrc=ip)))
+        duration = sent * self.packet_cost + (timeout if len(answered) < len(packets) else self.answer_time)
+        time.sleep(duration * self.scale)
+        self.rounds.append(duration)
+        return answered, []
+
+def legacy_arp_ping_macs(rpis, mac_addresses, repeat=1, scale=1.0):
+    """
+    The arp_ping_macs implementation prior to batched probing.
+    """
+    def _arp_ping(mac_address, ip_address):
+        result = False
+        answered, unanswered = rpis.srp(rpis.Ether(dst=mac_address)/rpis.ARP(pdst=ip_address), timeout=1, verbose=False)
+        for reply in answered:
+            if reply[1].hwsrc == mac_address:
+                result = str(reply[1].psrc)
+        return result
+    while repeat > 0:
+        if time.time() - rpis.alarm_state['last_packet'] < 30:
+            break
+        for mac_address in mac_addresses:
+            if _arp_ping(mac_address, rpis.config['network_address']):
+                break
+        if repeat > 1:
+            time.sleep(2 * scale)
+        repeat -= 1
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark arp_ping_macs against one srp per MAC address.')
+    p.add_argument('-m', '--macs', help='Number of monitored MAC addresses.', type=int, default=3)
+    p.add_argument('-r', '--repeat', help='Repeat value as used by process_photos.', type=int, default=3)
+    p.add_argument('--packet-cost', help='Seconds to send one packet.', type=float, default=0.0005)
+    p.add_argument('--answer-time', help='Seconds for a reply when all packets are answered.', type=float, default=0.05)
+    p.add_argument('-s', '--scale', help='Multiplier for simulated sleeps, use less than 1 for a quick run.', type=float, default=1.0)
+    args = p.parse_args()
+    rpis = load_rpi_security()
+    rpis.Ether = lambda **fields: FakeLayer(**fields)
+    rpis.ARP = lambda **fields: FakeLayer(**fields)
+    macs = ['aa:aa:aa:bb:bb:%02x' % i for i in range(args.macs)]
+    # packet_detected reads the full config and records the last MAC address seen in the state store
+    temp_dir = tempfile.mkdtemp(prefix='rpi-security-bench-')
+    config_file = os.path.join(temp_dir, 'rpi-security.conf')
+    with open(config_file, 'w') as f:
+        f.write('[main]\nmac_addresses=%s\ntelegram_bot_token=simulated\n' % ','.join(macs))
+    rpis.config = rpis.parse_config_file(config_file)
+    rpis.config['network_address'] = NETWORK
+    rpis.presence_monitor = Namespace(packet_detected=lambda mac_address, timestamp: None)
+    rpis.state_store = rpis.StateStore(os.path.join(temp_dir, 'state'))
+    scenarios = [
+        ('all away', {}),
+        ('last MAC online', {macs[-1]: '192.168.1.20'}),
+        ('last MAC online, IP cached', {macs[-1]: '192.168.1.20'}),
+    ]
+    try:
+        for name, online in scenarios:
+            for implementation in ['legacy', 'batched']:
+                network = FakeNetwork(online, args.packet_cost, args.answer_time, args.scale)
+                rpis.srp = network.srp
+                rpis.alarm_state = {'last_packet': 0, 'last_packet_mac': None}
+                if implementation == 'legacy':
+                    start = time.time()
+                    legacy_arp_ping_macs(rpis, macs, repeat=args.repeat, scale=args.scale)
+                else:
+                    if 'cached' not in name:
+                        rpis.arp_ip_cache.clear()
+                    start = time.time()
+                    rpis.arp_ping_macs(macs, repeat=args.repeat, repeat_interval=2 * args.scale)
+                elapsed = (time.time() - start) / args.scale
+                print('%-28s %-8s total: %6.3fs  rounds: %s  round times: %s' % (
+                    name, implementation, elapsed, len(network.rounds), ', '.join(['%.3fs' % r for r in network.rounds])))
+    finally:
+        rpis.state_store.close()
+        shutil.rmtree(temp_dir)
+
+if __name__ == "__main__":
+    main()
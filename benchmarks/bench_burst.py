@@ -0,0 +1,64 @@
+#!/usr/bin/python
+"""
+Compares taking photos one at a time with take_photo through the still port against take_burst through
+the video port. Reports frames/s and the time until the first frame is available. With --picamera the
+real camera is used, otherwise a synthetic camera where still port captures cost --still-delay each.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from common import load_rpi_security
+from simulation import FakeCamera
+
+def still_photos(rpis, save_path, count, first):
+    for i in range(count):
+        rpis.take_photo(os.path.join(save_path, 'still-%s.jpeg' % i))
+        first.setdefault('time', time.time())
+
+def burst_photos(rpis, count, fps, first):
+    rpis.take_burst(count, fps, lambda i, jpeg: first.setdefault('time', time.time()))
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark burst photos through the video port against the still port.')
+    p.add_argument('-n', '--count', help='Number of photos, as camera_capture_length.', type=int, default=4)
+    p.add_argument('-f', '--fps', help='camera_burst_fps to use.', type=float, default=15)
+    p.add_argument('-r', '--runs', help='Number of runs of each method.', type=int, default=3)
+    p.add_argument('--still-delay', help='Simulated still port mode switch time in seconds.', type=float, default=0.5)
+    p.add_argument('--picamera', help='Use the real camera.', action='store_true', default=False)
+    args = p.parse_args()
+    rpis = load_rpi_security()
+    if args.picamera:
+        import picamera
+        rpis.camera = picamera.PiCamera()
+        rpis.camera.resolution = (1024, 768)
+        # Let the sensor settle so the first run is not penalised
+        time.sleep(2)
+    else:
+        rpis.camera = FakeCamera(still_delay=args.still_delay)
+    save_path = tempfile.mkdtemp(prefix='rpi-security-bench-')
+    try:
+        methods = [
+            ('still port', lambda first: still_photos(rpis, save_path, args.count, first)),
+            ('video port', lambda first: burst_photos(rpis, args.count, args.fps, first)),
+        ]
+        for name, function in methods:
+            rates, firsts = [], []
+            for run in range(args.runs):
+                first = {}
+                start = time.time()
+                function(first)
+                elapsed = time.time() - start
+                rates.append(args.count / elapsed)
+                firsts.append(first['time'] - start)
+            print('%-10s photos: %-3s mean frames/s: %6.2f  mean time to first frame: %.3fs' % (
+                name, args.count, sum(rates) / len(rates), sum(firsts) / len(firsts)))
+    finally:
+        rpis.camera.close()
+        shutil.rmtree(save_path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+"""
+Compares take_gif with previous implementations using a fake camera: writing a temporary JPEG for each
+frame, and capturing in memory but encoding with PIL's per frame palettes. Reports wall time, bytes
+written and GIF size for each, then the encode time alone for PIL and GifEncoder on the same frames.
+"""
+
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+from common import load_rpi_security, measure
+from simulation import FakeCamera
+
+def legacy_take_gif(rpis, output_file, length):
+    """
+    The take_gif implementation prior to the in-memory pipeline.
+    """
+    Image = rpis.Image
+    temp_jpeg_path = rpis.config['camera_save_path'] + "/rpi-security-" + datetime.now().strftime("%Y-%m-%d-%H%M%S") + 'gif-part'
+    jpeg_files = ['%s-%s.jpg' % (temp_jpeg_path, i) for i in range(length*3)]
+    for jpeg in jpeg_files:
+        rpis.camera.capture(jpeg, resize=(800,600))
+    im = Image.open(jpeg_files[0])
+    ims = [Image.open(i) for i in jpeg_files[1:]]
+    im.save(output_file, append_images=ims, save_all=True, loop=0, duration=200)
+    im.close()
+    for imfile in ims:
+        imfile.close()
+    for jpeg in jpeg_files:
+        os.remove(jpeg)
+
+def pil_take_gif(rpis, output_file, length):
+    """
+    The take_gif implementation prior to GifEncoder.
+    """
+    frames = rpis.capture_frames(length*3, resize=(800,600))
+    frames[0].save(output_file, append_images=frames[1:], save_all=True, loop=0, duration=200)
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark take_gif against the temporary JPEG implementation.')
+    p.add_argument('-l', '--length', help='camera_capture_length to use.', type=int, default=4)
+    p.add_argument('-r', '--runs', help='Number of runs of each implementation.', type=int, default=3)
+    p.add_argument('-m', '--max-kb', help='Also encode to fit this size in KB.', type=int, default=150)
+    p.add_argument('--plain', help='Use a plain background, which flatters PIL, instead of a texture.', action='store_true', default=False)
+    args = p.parse_args()
+    from PIL import Image
+    import numpy
+    rpis = load_rpi_security()
+    rpis.Image = Image
+    rpis.np = numpy
+    background = None
+    if not args.plain:
+        background = Image.merge('RGB', [Image.effect_noise((128, 96), sigma) for sigma in (40, 50, 60)]).resize((1024, 768), Image.BICUBIC)
+    rpis.camera = FakeCamera(background=background)
+    save_path = tempfile.mkdtemp(prefix='rpi-security-bench-')
+    rpis.config = {'camera_save_path': save_path}
+    try:
+        implementations = [
+            ('legacy', lambda f: legacy_take_gif(rpis, f, args.length)),
+            ('PIL', lambda f: pil_take_gif(rpis, f, args.length)),
+            ('GifEncoder', lambda f: rpis.take_gif(f, args.length)),
+            ('GifEncoder %sKB' % args.max_kb, lambda f: rpis.take_gif(f, args.length, max_bytes=args.max_kb * 1024)),
+        ]
+        for name, function in implementations:
+            times, written = [], []
+            for run in range(args.runs):
+                output_file = os.path.join(save_path, '%s-%s.gif' % (name.replace(' ', '-'), run))
+                elapsed, nbytes = measure(function, output_file)
+                times.append(elapsed)
+                written.append(nbytes)
+            print('%-16s frames: %-3s mean time: %.3fs  min time: %.3fs  bytes written per GIF: %s  GIF size: %s' % (
+                name, args.length*3, sum(times) / len(times), min(times),
+                'n/a' if None in written else sum(written) // len(written),
+                os.path.getsize(output_file)
+            ))
+        frames = rpis.capture_frames(args.length*3, resize=(800,600))
+        encoders = [
+            ('PIL', lambda: frames[0].save(io.BytesIO(), format='gif', append_images=frames[1:], save_all=True, loop=0, duration=200)),
+            ('GifEncoder', lambda: rpis.GifEncoder().encode(frames, 200)),
+        ]
+        for name, function in encoders:
+            start = time.time()
+            function()
+            print('%-16s encode time: %.3fs' % (name, time.time() - start))
+    finally:
+        shutil.rmtree(save_path)
+
+if __name__ == "__main__":
+    main()
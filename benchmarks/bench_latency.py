@@ -0,0 +1,115 @@
+#!/usr/bin/python
+"""
+End to end latency benchmark using the simulated backends. Measures each stage of an alarm from the
+PIR edge to capture, encode, queued and delivered to the fake Telegram server, and how long the presence
+monitor takes to arm after the deadline and to disarm after a packet.
+"""
+
+import argparse
+import time
+
+from common import load_rpi_security
+from simulation import Simulation
+
+STAGES = ['capture', 'encode', 'queued', 'first delivered', 'all delivered']
+
+def instrument(rpis, marks):
+    """
+    Wraps the pipeline functions to record the first time each stage completes for the current event.
+    """
+    def wrap(function, stage, when='after'):
+        def wrapper(*args, **kwargs):
+            if when == 'before':
+                marks.setdefault(stage, time.time())
+            result = function(*args, **kwargs)
+            if when == 'after':
+                marks.setdefault(stage, time.time())
+            return result
+        return wrapper
+    rpis.capture_frames = wrap(rpis.capture_frames, 'capture')
+    rpis.take_photo = wrap(rpis.take_photo, 'capture')
+    rpis.queue_captured_file = wrap(rpis.queue_captured_file, 'capture', when='before')
+    rpis.take_gif = wrap(rpis.take_gif, 'encode')
+    rpis.upload_queue.put = wrap(rpis.upload_queue.put, 'queued', when='before')
+    rpis.capture_motion_event = wrap(rpis.capture_motion_event, 'captured')
+    rpis.capture_scheduler.capture = rpis.capture_motion_event
+
+def summary(name, values):
+    if not values:
+        return '%-22s n/a' % name
+    return '%-22s mean: %7.3fs  min: %7.3fs  max: %7.3fs' % (name, sum(values) / len(values), min(values), max(values))
+
+def main():
+    p = argparse.ArgumentParser(description='End to end latency benchmark with simulated hardware.')
+    p.add_argument('-m', '--camera-mode', help='camera_mode to benchmark.', default='photo')
+    p.add_argument('-l', '--length', help='camera_capture_length.', type=int, default=2)
+    p.add_argument('-b', '--burst-fps', help='camera_burst_fps, 0 for the still port.', type=float, default=0)
+    p.add_argument('--no-preview', help='Disable alert_preview.', action='store_true', default=False)
+    p.add_argument('--upload-target', help='alert_upload_target_seconds, 0 to disable.', type=float, default=10)
+    p.add_argument('-e', '--events', help='Number of motion events.', type=int, default=3)
+    p.add_argument('-t', '--packet-timeout', help='packet_timeout in seconds.', type=int, default=2)
+    p.add_argument('-a', '--arm-delay', help='Seconds after packet_timeout before arming.', type=float, default=1)
+    p.add_argument('--still-delay', help='Simulated still port mode switch time in seconds.', type=float, default=0.5)
+    p.add_argument('--latency', help='Simulated Telegram latency in seconds.', type=float, default=0.05)
+    p.add_argument('--bandwidth', help='Simulated upload bandwidth in bytes/s.', type=float, default=250000)
+    p.add_argument('--arp-scale', help='Multiplier for simulated ARP ping timeouts.', type=float, default=1.0)
+    args = p.parse_args()
+    rpis = load_rpi_security()
+    sim = Simulation(rpis, config={
+        'camera_mode': args.camera_mode,
+        'camera_capture_length': args.length,
+        'camera_burst_fps': args.burst_fps,
+        # Every event is measured separately so none are merged
+        'motion_cooldown': 0,
+        'alert_preview': not args.no_preview,
+        'alert_upload_target_seconds': args.upload_target,
+        'packet_timeout': args.packet_timeout,
+    }, latency=args.latency, bandwidth=args.bandwidth, arp_scale=args.arp_scale, arm_delay=args.arm_delay, still_delay=args.still_delay)
+    server = sim.server
+    marks = {}
+    instrument(rpis, marks)
+    sim.start()
+    try:
+        arm_deadline = rpis.presence_monitor.last_packet + args.packet_timeout + args.arm_delay
+        armed = server.wait_for(lambda r: r.method == 'sendMessage' and b'*armed*' in r.body)
+        if armed is None:
+            raise SystemExit('System did not arm')
+        arm_state_delay = rpis.alarm_state['last_state_change'] - arm_deadline
+        arm_message_delay = armed.time - arm_deadline
+        results = dict((stage, []) for stage in STAGES)
+        sizes = []
+        for event in range(args.events):
+            marks.clear()
+            start_index = len(server.requests)
+            edge_time = time.time()
+            sim.pir_edge()
+            deadline = edge_time + 60
+            while 'captured' not in marks or rpis.upload_queue.depth() > 0:
+                if time.time() > deadline:
+                    raise SystemExit('Captured files were not delivered')
+                time.sleep(0.01)
+            delivered = [r for r in server.requests[start_index:] if r.method != 'sendMessage']
+            marks.setdefault('encode', marks.get('capture'))
+            marks['first delivered'] = delivered[0].time
+            marks['all delivered'] = delivered[-1].time
+            for stage in STAGES:
+                results[stage].append(marks[stage] - edge_time)
+            sizes.append(', '.join(['%s %sKB' % (r.method, r.size // 1024) for r in delivered]))
+        start_index = len(server.requests)
+        packet_time = time.time()
+        sim.sniffer.inject(rpis.config['mac_addresses'][0])
+        disarmed = server.wait_for(lambda r: r.method == 'sendMessage' and b'*disarmed*' in r.body, start=start_index)
+        print('Camera mode: %s  events: %s' % (args.camera_mode, args.events))
+        print('Sent for the last event: %s' % sizes[-1])
+        print('Latency from PIR edge:')
+        for stage in STAGES:
+            print('  ' + summary(stage, results[stage]))
+        print('Presence:')
+        print('  %-22s %7.3fs' % ('arm after deadline', arm_state_delay))
+        print('  %-22s %7.3fs' % ('arm message', arm_message_delay))
+        print('  %-22s %7.3fs' % ('disarm message', disarmed.time - packet_time))
+    finally:
+        sim.close()
+
+if __name__ == "__main__":
+    main()
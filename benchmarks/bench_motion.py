@@ -0,0 +1,103 @@
+#!/usr/bin/python
+"""
+Drives CaptureScheduler with a simulated clock through bursts of PIR edges, such as someone walking past
+the sensor for a minute, and compares it with the previous behaviour where every edge ran a capture
+inline in the GPIO callback. Reports alerts (motion events), captures, files sent and seconds the camera
+was busy. No time passes, captures only advance the simulated clock.
+"""
+
+import argparse
+from collections import deque
+
+from common import load_rpi_security
+
+def scenarios(walk_seconds, edge_interval):
+    walk = [i * edge_interval for i in range(int(walk_seconds / edge_interval))]
+    # Someone passing every two minutes for an hour, each pass retriggering the PIR three times
+    passes = [start + i * edge_interval for start in range(0, 3600, 120) for i in range(3)]
+    continuous = [i * edge_interval for i in range(int(3600 / edge_interval))]
+    return [('walk for %ss' % walk_seconds, walk), ('passes for an hour', passes), ('motion for an hour', continuous)]
+
+def files_per_capture(mode, length):
+    return length if mode == 'photo' else 1
+
+def legacy(edges, mode, length, capture_time):
+    """
+    Every edge runs a capture in the callback thread. Edges during a capture are latched once by the
+    GPIO driver so they cause at most one more capture, and every capture is a separate alert.
+    """
+    now = 0
+    captures = 0
+    busy = 0
+    pending = deque(edges)
+    while pending:
+        now = max(now, pending.popleft())
+        duration = length if mode == 'video' else capture_time
+        captures += 1
+        busy += duration
+        now += duration
+        latched = False
+        while pending and pending[0] <= now:
+            pending.popleft()
+            latched = True
+        if latched:
+            pending.appendleft(now)
+    return captures, captures, captures * files_per_capture(mode, length), busy
+
+def scheduled(rpis, edges, mode, length, capture_time, cooldown, max_event_seconds, max_per_hour):
+    clock = {'now': 0}
+    pending = deque(edges)
+    results = {'events': set(), 'captures': 0, 'busy': 0}
+
+    def advance(to):
+        while pending and pending[0] <= to:
+            scheduler.trigger(pending.popleft())
+        clock['now'] = max(clock['now'], to)
+
+    def capture(event):
+        start = clock['now']
+        if mode == 'video':
+            end = scheduler.recording_end(length)
+            while clock['now'] < end:
+                advance(min(end, clock['now'] + 0.5))
+                end = scheduler.recording_end(length)
+        else:
+            advance(clock['now'] + capture_time)
+        results['events'].add(event['start'])
+        results['captures'] += 1
+        results['busy'] += clock['now'] - start
+
+    scheduler = rpis.CaptureScheduler(capture, get_state=lambda: 'armed', cooldown=cooldown,
+        max_event_seconds=max_event_seconds, max_per_hour=max_per_hour, clock=lambda: clock['now'])
+    while pending or scheduler.edges:
+        if not scheduler.edges:
+            with scheduler.condition:
+                scheduler.idle_timeout(pending[0])
+            advance(pending[0])
+        scheduler.handle(*scheduler.wait_for_edges())
+    return len(results['events']), results['captures'], results['captures'] * files_per_capture(mode, length), results['busy']
+
+def main():
+    p = argparse.ArgumentParser(description='Compare motion event coalescing with one capture per PIR edge.')
+    p.add_argument('-m', '--camera-mode', help='camera_mode to model.', default='gif')
+    p.add_argument('-l', '--length', help='camera_capture_length.', type=int, default=4)
+    p.add_argument('-c', '--capture-time', help='Seconds one photo or GIF capture takes.', type=float, default=9)
+    p.add_argument('-w', '--walk-seconds', help='Length of the continuous motion scenario.', type=int, default=60)
+    p.add_argument('-i', '--edge-interval', help='Seconds between PIR retriggers.', type=float, default=3)
+    p.add_argument('--cooldown', help='motion_cooldown.', type=float, default=10)
+    p.add_argument('--max-event-seconds', help='motion_max_event_seconds.', type=float, default=60)
+    p.add_argument('--max-per-hour', help='motion_max_captures_per_hour.', type=int, default=60)
+    args = p.parse_args()
+    rpis = load_rpi_security()
+    for name, edges in scenarios(args.walk_seconds, args.edge_interval):
+        results = [
+            ('per edge', legacy(edges, args.camera_mode, args.length, args.capture_time)),
+            ('scheduled', scheduled(rpis, edges, args.camera_mode, args.length, args.capture_time,
+                args.cooldown, args.max_event_seconds, args.max_per_hour)),
+        ]
+        for method, (events, captures, files, busy) in results:
+            print('%-20s %-10s edges: %-4s alerts: %-4s captures: %-4s files: %-4s camera busy: %5.0fs' % (
+                name, method, len(edges), events, captures, files, busy))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+"""
+Compares the /photo and /gif handlers using CameraArbiter with the previous handlers, which captured and
+sent the file in the bot thread. Runs the service with the simulated backends and, like the bot, calls
+the handlers one after another from one thread. First several people send bursts of /photo and /gif,
+then there is a motion event while a /gif is being captured. Reports captures, how long the bot was
+blocked, when the files were delivered, how long the alarm waited for the camera and the most captures
+using the camera at the same time.
+"""
+
+import argparse
+import time
+from contextlib import contextmanager
+from threading import Lock, Thread, current_thread
+
+from common import load_rpi_security
+from simulation import Simulation
+
+class NoArbiter(object):
+    """
+    Lets every capture use the camera straight away, as before CameraArbiter.
+    """
+    @contextmanager
+    def alarm(self):
+        yield
+
+    @contextmanager
+    def on_demand(self):
+        yield
+
+def legacy_handlers(rpis):
+    def photo():
+        file_path = rpis.config['camera_save_path'] + "/rpi-security-" + rpis.datetime.now().strftime("%Y-%m-%d-%H%M%S") + '.jpeg'
+        rpis.take_photo(file_path)
+        rpis.telegram_send_file(file_path)
+        rpis.outbox.add(file_path, state='delivered')
+    def gif():
+        file_path = rpis.config['camera_save_path'] + "/rpi-security-" + rpis.datetime.now().strftime("%Y-%m-%d-%H%M%S") + '.gif'
+        rpis.take_gif(file_path, rpis.config['camera_capture_length'])
+        rpis.telegram_send_file(file_path)
+        rpis.outbox.add(file_path, state='delivered')
+    return {'photo': photo, 'gif': gif}
+
+def arbiter_handlers(rpis):
+    return {
+        'photo': lambda: rpis.camera_arbiter.request('photo', rpis.capture_on_demand_photo, rpis.telegram_send_file),
+        'gif': lambda: rpis.camera_arbiter.request('gif', rpis.capture_on_demand_gif, rpis.telegram_send_file),
+    }
+
+def count_camera_users(camera):
+    """
+    Wraps the camera capture methods to record the most threads capturing at the same time.
+    """
+    lock = Lock()
+    users = {}
+    usage = {'max': 0}
+    def wrap(function):
+        def wrapper(*args, **kwargs):
+            thread = current_thread()
+            with lock:
+                users[thread] = users.get(thread, 0) + 1
+                usage['max'] = max(usage['max'], len(users))
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with lock:
+                    users[thread] -= 1
+                    if not users[thread]:
+                        del users[thread]
+        return wrapper
+    camera.capture = wrap(camera.capture)
+    camera.capture_sequence = wrap(camera.capture_sequence)
+    return usage
+
+def count_calls(rpis, names, counts):
+    for name in names:
+        def wrap(function, name=name):
+            def wrapper(*args, **kwargs):
+                counts[name] = counts.get(name, 0) + 1
+                return function(*args, **kwargs)
+            return wrapper
+        setattr(rpis, name, wrap(getattr(rpis, name)))
+
+def dispatch(taps, handlers):
+    """
+    Calls the handler for each (delay, command) in one thread like the bot dispatcher, returning the time
+    the taps started and the total time spent in the handlers.
+    """
+    start = time.time()
+    blocked = 0
+    for delay, command in taps:
+        time.sleep(max(0, start + delay - time.time()))
+        handler_start = time.time()
+        handlers[command]()
+        blocked += time.time() - handler_start
+    return start, blocked
+
+def wait_for_deliveries(server, start_index, gifs, timeout):
+    """
+    Waits until gifs GIFs have been delivered and a second more for other files, returning the photos and
+    GIFs delivered from request index start_index.
+    """
+    deadline = time.time() + timeout
+    delivered = lambda: [r for r in server.requests[start_index:] if r.method in ('sendPhoto', 'sendDocument')]
+    while time.time() < deadline and len([r for r in delivered() if r.method == 'sendDocument']) < gifs:
+        time.sleep(0.05)
+    time.sleep(1)
+    return delivered()
+
+def run(variant, args):
+    rpis = load_rpi_security()
+    sim = Simulation(rpis, config={
+        'camera_mode': 'photo',
+        'camera_capture_length': args.length,
+        'alert_preview': True,
+        'packet_timeout': 1,
+        'camera_on_demand_freshness': args.freshness,
+    }, arm_delay=0.5, still_delay=args.still_delay)
+    try:
+        usage = count_camera_users(rpis.camera)
+        counts = {}
+        if variant == 'legacy':
+            rpis.camera_arbiter = NoArbiter()
+            count_calls(rpis, ['take_photo', 'take_gif'], counts)
+            handlers = legacy_handlers(rpis)
+        else:
+            count_calls(rpis, ['capture_on_demand_photo', 'capture_on_demand_gif'], counts)
+            handlers = arbiter_handlers(rpis)
+        alarm_marks = []
+        queue_captured_file = rpis.queue_captured_file
+        def timed_queue_captured_file(*queue_args, **kwargs):
+            alarm_marks.append(time.time())
+            queue_captured_file(*queue_args, **kwargs)
+        rpis.queue_captured_file = timed_queue_captured_file
+        sim.start()
+        if not sim.server.wait_for(lambda r: r.method == 'sendMessage' and b'*armed*' in r.body, timeout=30):
+            raise SystemExit('System did not arm')
+
+        # Burst: every user taps /photo then /gif
+        taps = []
+        for user in range(args.users):
+            taps += [(user * 0.2, 'photo'), (user * 0.2 + 0.1, 'gif')]
+        start_index = len(sim.server.requests)
+        start, blocked = dispatch(taps, handlers)
+        delivered = wait_for_deliveries(sim.server, start_index, args.users if variant == 'legacy' else 1, 120)
+        captures = sum(counts.values())
+        print('%-8s burst of %s requests: captures: %-3s bot blocked: %6.2fs  deliveries: %-3s first: %6.2fs  last: %6.2fs' % (
+            variant, len(taps), captures, blocked, len(delivered),
+            delivered[0].time - start if delivered else 0, delivered[-1].time - start if delivered else 0))
+
+        # A motion event while a /gif is capturing
+        time.sleep(args.freshness + 1)
+        usage['max'] = 0
+        del alarm_marks[:]
+        gif_thread = Thread(target=handlers['gif'])
+        gif_thread.start()
+        time.sleep(0.5)
+        edge_time = time.time()
+        sim.pir_edge()
+        deadline = edge_time + 60
+        while not alarm_marks and time.time() < deadline:
+            time.sleep(0.01)
+        gif_thread.join()
+        print('%-8s motion during /gif: alarm waited for the camera: %6.2fs  most captures using the camera at once: %s' % (
+            variant, alarm_marks[0] - edge_time if alarm_marks else float('nan'), usage['max']))
+        time.sleep(args.length * 3 * args.still_delay + 2)
+    finally:
+        sim.close()
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark on-demand /photo and /gif requests against the previous handlers.')
+    p.add_argument('-u', '--users', help='Number of people sending /photo and /gif in the burst.', type=int, default=3)
+    p.add_argument('-l', '--length', help='camera_capture_length, the GIF is three frames per second.', type=int, default=3)
+    p.add_argument('--still-delay', help='Simulated still port capture time in seconds.', type=float, default=0.3)
+    p.add_argument('--freshness', help='camera_on_demand_freshness.', type=float, default=5)
+    args = p.parse_args()
+    for variant in ['legacy', 'arbiter']:
+        run(variant, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+"""
+Replays a radiotap .pcap file through the filter built by calculate_filter and then through the packet
+handlers: the previous per-packet scapy callback, PacketTracker with scapy and PacketTracker on raw frames.
+Reports packets/s and CPU time per packet for each. Without --pcap a synthetic capture is generated.
+"""
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+
+from common import load_rpi_security
+
+PCAP_HEADER = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 127)
+RADIOTAP_HEADER = struct.pack('<BBHI', 0, 0, 8, 0)
+
+def mac_bytes(mac_address):
+    return bytes(bytearray([int(x, 16) for x in mac_address.split(':')]))
+
+def generate_pcap(path, count, mac_addresses, network_interface_mac, match_ratio):
+    """
+    Writes a capture of probe requests and data frames where match_ratio of them are from the monitored MACs.
+    """
+    random.seed(0)
+    others = ['02:00:00:%02x:%02x:%02x' % (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)) for i in range(50)]
+    with open(path, 'wb') as f:
+        f.write(PCAP_HEADER)
+        for i in range(count):
+            source = random.choice(mac_addresses) if random.random() < match_ratio else random.choice(others)
+            if random.random() < 0.5:
+                # Probe request: type mgt, subtype probe-req
+                frame = struct.pack('<BBH', 0x40, 0, 0) + mac_bytes('ff:ff:ff:ff:ff:ff') + mac_bytes(source) + mac_bytes('ff:ff:ff:ff:ff:ff') + b'\x00\x00' + b'\x00' * 40
+            else:
+                # Data frame to this host
+                frame = struct.pack('<BBH', 0x08, 0x02, 0) + mac_bytes(network_interface_mac) + mac_bytes(random.choice(others)) + mac_bytes(source) + b'\x00\x00' + b'\x00' * 60
+            packet = RADIOTAP_HEADER + frame
+            f.write(struct.pack('<IIII', i // 1000, i % 1000, len(packet), len(packet)))
+            f.write(packet)
+
+def read_pcap_frames(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    frames = []
+    offset = 24
+    while offset + 16 <= len(data):
+        length = struct.unpack_from('<I', data, offset + 8)[0]
+        frames.append(data[offset + 16:offset + 16 + length])
+        offset += 16 + length
+    return frames
+
+def legacy_update_time(rpis, mac_addresses):
+    """
+    The scapy callback prior to PacketTracker.
+    """
+    def update_time(packet):
+        for mac_address in mac_addresses:
+            if mac_address in packet[0].addr2 or mac_address in packet[0].addr3:
+                rpis.alarm_state['last_packet_mac'] = mac_address
+                break
+        rpis.alarm_state['last_packet'] = time.time()
+        rpis.logger.debug('Packet detected from %s' % str(rpis.alarm_state['last_packet_mac']))
+    return update_time
+
+def run(name, packets, handler):
+    cpu_start = sum(os.times()[:2])
+    start = time.time()
+    for packet in packets:
+        handler(packet)
+    elapsed = time.time() - start
+    cpu = sum(os.times()[:2]) - cpu_start
+    print('%-24s packets: %-8s %10.0f packets/s  CPU per packet: %.2f us' % (name, len(packets), len(packets) / elapsed, cpu * 1e6 / len(packets)))
+
+def main():
+    p = argparse.ArgumentParser(description='Replay a pcap through the packet capture filter and handlers.')
+    p.add_argument('-p', '--pcap', help='Radiotap pcap file to replay.')
+    p.add_argument('-m', '--mac-addresses', help='Monitored MAC addresses, comma separated.', default='aa:aa:aa:bb:bb:bb,cc:cc:cc:dd:dd:dd')
+    p.add_argument('-i', '--interface-mac', help='MAC address of the monitor interface.', default='00:0f:60:08:9c:01')
+    p.add_argument('-n', '--count', help='Number of packets to generate without --pcap.', type=int, default=200000)
+    p.add_argument('-r', '--match-ratio', help='Fraction of generated packets from monitored MACs.', type=float, default=0.2)
+    args = p.parse_args()
+    mac_addresses = args.mac_addresses.lower().split(',')
+    rpis = load_rpi_security()
+    # Per packet debug records are created as in production, but not written anywhere
+    rpis.logger.setLevel(logging.DEBUG)
+    rpis.alarm_state = {'last_packet': 0, 'last_packet_mac': None}
+    temp_dir = tempfile.mkdtemp(prefix='rpi-security-bench-')
+    try:
+        pcap = args.pcap
+        if not pcap:
+            pcap = os.path.join(temp_dir, 'generated.pcap')
+            generate_pcap(pcap, args.count, mac_addresses, args.interface_mac, args.match_ratio)
+        bpf_filter = rpis.calculate_filter(mac_addresses, args.interface_mac)
+        filtered = os.path.join(temp_dir, 'filtered.pcap')
+        total = len(read_pcap_frames(pcap))
+        start = time.time()
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(['tcpdump', '-r', pcap, '-w', filtered, bpf_filter], stderr=devnull)
+        except OSError:
+            print('tcpdump not found, replaying all %s packets without the BPF filter' % total)
+            frames = read_pcap_frames(pcap)
+        else:
+            frames = read_pcap_frames(filtered)
+            print('BPF filter passed %s of %s packets in %.2fs' % (len(frames), total, time.time() - start))
+        if not frames:
+            return
+        detected = []
+        tracker = rpis.PacketTracker(mac_addresses, detected.append)
+        run('PacketTracker raw', frames, tracker.raw_frame)
+        try:
+            from scapy.all import RadioTap
+        except ImportError:
+            print('scapy not installed, skipping scapy handlers')
+            return
+        packets = [RadioTap(frame) for frame in frames]
+        run('legacy scapy callback', packets, legacy_update_time(rpis, mac_addresses))
+        tracker = rpis.PacketTracker(mac_addresses, detected.append)
+        run('PacketTracker scapy', packets, tracker.scapy_packet)
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+"""
+Compares start() with the previous startup, which imported every module one after another, set up the
+camera and Telegram, started the threads and slept for 2 seconds before setting up the PIR sensor.
+Each runs in a new process with the simulated backends, starting armed as after a power cut, with a PIR
+edge shortly after the start. Reports when each startup phase finished and when the alert for the edge
+was captured and delivered, or that it was missed.
+Modules that are installed, such as PIL and numpy, are really imported. picamera, and telegram and scapy
+if not installed, are replaced by modules that take --import-seconds to import, so imports still wait for
+each other on the import lock as they would on Python 2.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Timer
+
+from common import load_rpi_security
+
+def stand_in_modules(path, seconds):
+    """
+    Writes modules that take seconds to import for those not installed and returns the names to import.
+    """
+    names = {}
+    for module in ['picamera', 'telegram', 'scapy']:
+        try:
+            if module == 'picamera':
+                raise ImportError
+            __import__(module)
+            names[module] = module
+        except ImportError:
+            names[module] = 'standin_%s' % module
+            with open(os.path.join(path, 'standin_%s.py' % module), 'w') as f:
+                f.write('import time\ntime.sleep(%s)\n' % seconds)
+    sys.path.insert(0, path)
+    return names
+
+def slow_camera(sim, seconds):
+    """
+    Wraps the simulated camera so creating it takes as long as initialising the camera module.
+    """
+    load_camera = sim.load_camera
+    def load():
+        time.sleep(seconds)
+        load_camera()
+    return load
+
+def legacy_start(rpis, sim, startup, names, camera_seconds):
+    __import__(names['picamera'])
+    __import__(names['scapy'])
+    sim.load_scapy()
+    __import__(names['telegram'])
+    sim.load_imaging()
+    startup.mark('imports')
+    sim.load_gpio()
+    slow_camera(sim, camera_seconds)()
+    startup.mark('camera')
+    sim.load_telegram()
+    rpis.setup_services()
+    rpis.setup_pre_trigger_buffer()
+    rpis.start_threads()
+    time.sleep(2)
+    rpis.start_motion_detection()
+    startup.mark('pir')
+    startup.mark('ready')
+
+def staged_start(rpis, sim, startup, names, camera_seconds):
+    def importing(name, load):
+        def run():
+            __import__(name)
+            load()
+        return run
+    rpis.load_camera = importing(names['picamera'], slow_camera(sim, camera_seconds))
+    rpis.load_telegram = importing(names['telegram'], sim.load_telegram)
+    rpis.load_scapy = importing(names['scapy'], sim.load_scapy)
+    rpis.start(startup)
+
+def child(args):
+    from simulation import Simulation
+    rpis = load_rpi_security()
+    startup = rpis.Startup()
+    temp_dir = tempfile.mkdtemp(prefix='rpi-security-bench-')
+    try:
+        names = stand_in_modules(temp_dir, args.import_seconds)
+        sim = Simulation(rpis, config={'camera_mode': args.camera_mode, 'camera_capture_length': 1}, setup=False)
+        # Armed before the restart
+        rpis.state_store.set('current_state', 'armed')
+        captured = []
+        queue_captured_file = rpis.queue_captured_file
+        def timed_queue_captured_file(*queue_args, **kwargs):
+            captured.append(time.time())
+            queue_captured_file(*queue_args, **kwargs)
+        rpis.queue_captured_file = timed_queue_captured_file
+        edge_timer = Timer(args.edge_at, sim.pir_edge)
+        edge_timer.start()
+        if args.child == 'legacy':
+            legacy_start(rpis, sim, startup, names, args.camera_seconds)
+        else:
+            staged_start(rpis, sim, startup, names, args.camera_seconds)
+        delivered = sim.server.wait_for(lambda r: r.method != 'sendMessage', timeout=args.edge_at + 30)
+        if delivered:
+            # Includes the ARP ping that checks for false positives before sending
+            alert = 'alert captured %.2fs, delivered %.2fs' % (captured[0] - startup.start_time, delivered.time - startup.start_time)
+        else:
+            alert = 'alert missed'
+        print('%-7s %s, %s' % (args.child, startup.summary(), alert))
+        sim.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark startup against the previous sequential startup.')
+    p.add_argument('-m', '--camera-mode', help='camera_mode to use.', default='photo')
+    p.add_argument('-i', '--import-seconds', help='Import time of each module that is not installed.', type=float, default=1.0)
+    p.add_argument('-c', '--camera-seconds', help='Time to initialise the camera.', type=float, default=1.0)
+    p.add_argument('-e', '--edge-at', help='Seconds after starting to trigger the PIR sensor.', type=float, default=0.5)
+    p.add_argument('--child', help=argparse.SUPPRESS)
+    args = p.parse_args()
+    if args.child:
+        child(args)
+        return
+    for variant in ['legacy', 'staged']:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), '--child', variant] + sys.argv[1:])
+
+if __name__ == "__main__":
+    main()
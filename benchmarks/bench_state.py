@@ -0,0 +1,154 @@
+#!/usr/bin/python
+"""
+Compares StateStore with keeping the same state, including the alarm history, in a YAML file that is
+rewritten on every change like write_state_file did. Runs a simulated day of packets, state changes and
+alarms and reports bytes written, fsyncs and time for each, then the startup load time and the time to
+find the last alarms with a long history. The libyaml dumper and loader are used when available so YAML
+is shown at its fastest.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from common import load_rpi_security, measure
+
+def workload(days, packet_interval, state_changes, alarms):
+    """
+    Returns a time ordered list of (time, kind) for a number of simulated days.
+    """
+    events = []
+    for day in range(days):
+        start = day * 86400
+        events += [(start + i * packet_interval, 'packet') for i in range(int(86400 / packet_interval))]
+        events += [(start + i * 86400.0 / state_changes + 1, 'state') for i in range(state_changes)]
+        events += [(start + i * 86400.0 / alarms + 2, 'alarm') for i in range(alarms)]
+    return sorted(events)
+
+def alarm(now):
+    return {'start': now, 'edges': 3, 'mode': 'photo', 'files': 3, 'prefix': 'rpi-security-%d' % now}
+
+def yaml_functions():
+    import yaml
+    dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return lambda data, f: yaml.dump(data, f, Dumper=dumper, default_flow_style=False), lambda f: yaml.load(f, Loader=loader)
+
+def legacy(dump, state_file, events):
+    """
+    Rewrites the whole YAML file in place on every change.
+    """
+    state = {'telegram_chat_id': 1, 'current_state': 'disarmed', 'alarms': [], 'states': []}
+    for now, kind in events:
+        if kind == 'packet':
+            state['last_packet'] = now
+            state['last_packet_mac'] = 'aa:aa:aa:bb:bb:bb'
+        elif kind == 'state':
+            state['current_state'] = 'armed' if state['current_state'] == 'disarmed' else 'disarmed'
+            state['states'].append({'time': now, 'state': state['current_state']})
+        else:
+            state['alarms'].append(alarm(now))
+        with open(state_file, 'w') as f:
+            dump(state, f)
+
+def journaled(rpis, store, clock, events):
+    """
+    Applies the same changes to a StateStore, flushing after each one as the writer thread would.
+    """
+    current_state = 'disarmed'
+    store.set('telegram_chat_id', 1)
+    for now, kind in events:
+        clock['now'] = now
+        if kind == 'packet':
+            store.set('last_packet', now, durable=False)
+            store.set('last_packet_mac', 'aa:aa:aa:bb:bb:bb', durable=False)
+            if not store.dirty or now - store.last_snapshot < store.snapshot_interval:
+                continue
+        elif kind == 'state':
+            current_state = 'armed' if current_state == 'disarmed' else 'disarmed'
+            store.set('current_state', current_state)
+            store.record('state', state=current_state)
+        else:
+            store.record('alarm', **alarm(now))
+        store.flush()
+
+def count_fsyncs(function):
+    calls = []
+    fsync = os.fsync
+    def counted(fd):
+        calls.append(fd)
+        fsync(fd)
+    os.fsync = counted
+    try:
+        function()
+    finally:
+        os.fsync = fsync
+    return len(calls)
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark the state store against a YAML state file.')
+    p.add_argument('-d', '--days', help='Simulated days for the write benchmark.', type=int, default=1)
+    p.add_argument('-p', '--packet-interval', help='Seconds between packets from the monitored MACs.', type=float, default=30)
+    p.add_argument('-s', '--state-changes', help='Alarm state changes per day.', type=int, default=20)
+    p.add_argument('-a', '--alarms', help='Alarms per day.', type=int, default=50)
+    p.add_argument('-y', '--history-days', help='Days of history for the load and query benchmark.', type=int, default=365)
+    p.add_argument('-n', '--last', help='Number of recent alarms to query.', type=int, default=10)
+    args = p.parse_args()
+    dump, load = yaml_functions()
+    rpis = load_rpi_security()
+    temp_dir = tempfile.mkdtemp(prefix='rpi-security-bench-')
+    try:
+        events = workload(args.days, args.packet_interval, args.state_changes, args.alarms)
+        print('Workload: %s days, %s changes' % (args.days, len(events)))
+        state_file = os.path.join(temp_dir, 'state.yaml')
+        results = {}
+        fsyncs = count_fsyncs(lambda: results.update(yaml=measure(legacy, dump, state_file, events)))
+        elapsed, written = results['yaml']
+        print('%-12s time: %7.3fs  bytes written: %10s  fsyncs: %-6s  atomic: no' % ('yaml', elapsed, written, fsyncs))
+        clock = {'now': 0}
+        store = rpis.StateStore(os.path.join(temp_dir, 'state'), clock=lambda: clock['now'])
+        fsyncs = count_fsyncs(lambda: results.update(store=measure(journaled, rpis, store, clock, events)))
+        elapsed, written = results['store']
+        print('%-12s time: %7.3fs  bytes written: %10s  fsyncs: %-6s  atomic: yes' % ('StateStore', elapsed, written, fsyncs))
+
+        # A long history, written without fsyncs to save time
+        history = workload(args.history_days, 3600, args.state_changes, args.alarms)
+        legacy(dump, state_file, [(0, 'packet')])
+        with open(state_file, 'r') as f:
+            state = load(f)
+        state['alarms'] = [alarm(now) for now, kind in history if kind == 'alarm']
+        state['states'] = [{'time': now, 'state': 'armed'} for now, kind in history if kind == 'state']
+        with open(state_file, 'w') as f:
+            dump(state, f)
+        history_path = os.path.join(temp_dir, 'history')
+        store = rpis.StateStore(history_path, history_bytes=1024 * 1024 * 1024, clock=lambda: clock['now'])
+        fsync = os.fsync
+        os.fsync = lambda fd: None
+        try:
+            journaled(rpis, store, clock, history)
+            store.close()
+        finally:
+            os.fsync = fsync
+        journal_size = sum([os.path.getsize(os.path.join(history_path, name)) for name in os.listdir(history_path)])
+        print('History: %s days, YAML file %s bytes, journal %s bytes' % (args.history_days, os.path.getsize(state_file), journal_size))
+        start = time.time()
+        with open(state_file, 'r') as f:
+            state = load(f)
+        last = state['alarms'][-args.last:]
+        yaml_time = time.time() - start
+        start = time.time()
+        store = rpis.StateStore(history_path, history_bytes=1024 * 1024 * 1024)
+        load_time = time.time() - start
+        start = time.time()
+        recent = store.events('alarm', limit=args.last)
+        query_time = time.time() - start
+        assert [event['start'] for event in recent] == [event['start'] for event in reversed(last)]
+        print('%-12s load and last %s alarms: %8.3fs' % ('yaml', args.last, yaml_time))
+        print('%-12s load: %8.3fs  last %s alarms: %8.4fs' % ('StateStore', load_time, args.last, query_time))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == "__main__":
+    main()
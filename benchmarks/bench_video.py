@@ -0,0 +1,82 @@
+#!/usr/bin/python
+"""
+Compares camera_mode gif and video for the same camera_capture_length. Reports the output size, CPU time
+used by rpi-security, CPU time used by the MP4 muxer and the time to upload to a fake Telegram server.
+With --picamera the real camera and hardware encoder are used. Otherwise the synthetic camera stands in
+and ffmpeg replaces the hardware encoder, its CPU time is not counted as it is free on a Raspberry Pi.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from common import load_rpi_security
+from simulation import FakeCamera, FakeTelegramServer, SimpleBot
+
+def cpu_times():
+    times = os.times()
+    return times[0] + times[1], times[2] + times[3]
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark camera_mode video against gif.')
+    p.add_argument('-l', '--length', help='camera_capture_length to use.', type=int, default=4)
+    p.add_argument('-b', '--bitrate', help='camera_video_bitrate to use.', type=int, default=2000000)
+    p.add_argument('--bandwidth', help='Simulated upload bandwidth in bytes/s.', type=float, default=250000)
+    p.add_argument('--background', help='Image to use as the synthetic camera background, a noise texture by default.')
+    p.add_argument('--picamera', help='Use the real camera.', action='store_true', default=False)
+    args = p.parse_args()
+    from PIL import Image
+    import numpy
+    rpis = load_rpi_security()
+    rpis.Image = Image
+    # take_gif encodes with GifEncoder, which needs numpy
+    rpis.np = numpy
+    if args.picamera:
+        import picamera
+        rpis.camera = picamera.PiCamera()
+        rpis.camera.resolution = (1024, 768)
+        time.sleep(2)
+    else:
+        if args.background:
+            background = Image.open(args.background).convert('RGB')
+        else:
+            # A plain background flatters GIF, texture is closer to a real scene
+            background = Image.merge('RGB', [Image.effect_noise((128, 96), sigma) for sigma in (40, 50, 60)]).resize((1024, 768), Image.BICUBIC)
+        rpis.camera = FakeCamera(background=background)
+    save_path = tempfile.mkdtemp(prefix='rpi-security-bench-')
+    rpis.config = {'camera_save_path': save_path, 'camera_video_bitrate': args.bitrate}
+    server = FakeTelegramServer(latency=0.05, bandwidth=args.bandwidth).start()
+    rpis.bot = SimpleBot('simulated', server.url)
+    rpis.state = {'telegram_chat_id': 1}
+    mux_cpu = []
+    mux_mp4 = rpis.mux_mp4
+    def timed_mux_mp4(*mux_args):
+        children_start = cpu_times()[1]
+        mux_mp4(*mux_args)
+        mux_cpu.append(cpu_times()[1] - children_start)
+    rpis.mux_mp4 = timed_mux_mp4
+    try:
+        modes = [
+            ('gif', os.path.join(save_path, 'capture.gif'), lambda f: rpis.take_gif(f, args.length)),
+            ('video', os.path.join(save_path, 'capture.mp4'), lambda f: rpis.take_video(f, args.length)),
+        ]
+        for name, output_file, function in modes:
+            start = time.time()
+            cpu_start = cpu_times()[0]
+            function(output_file)
+            cpu = cpu_times()[0] - cpu_start
+            elapsed = time.time() - start
+            upload_start = time.time()
+            rpis.telegram_send_file(output_file)
+            upload = time.time() - upload_start
+            print('%-6s size: %8s bytes  capture time: %6.2fs  CPU: %6.2fs  mux CPU: %5.2fs  upload time: %6.2fs' % (
+                name, os.path.getsize(output_file), elapsed, cpu, sum(mux_cpu) if name == 'video' else 0, upload))
+    finally:
+        server.shutdown()
+        rpis.camera.close()
+        shutil.rmtree(save_path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Shared helpers for the rpi-security benchmarks.
+"""
+
+import imp
+import logging
+import os
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script_path = os.path.join(repo_dir, 'bin', 'rpi-security.py')
+
+def load_rpi_security(name='rpi_security'):
+    """
+    Imports bin/rpi-security.py as a module without running it. Modules with different names have their
+    own globals, so several can run in one process.
+    """
+    module = imp.load_source(name, script_path)
+    module.logger = logging.getLogger(name)
+    module.logger.addHandler(logging.NullHandler())
+    module.args = Namespace(debug=False)
+    return module
+
+class Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def bytes_written():
+    """
+    Returns the number of bytes this process has passed to write() calls, or None if /proc is unavailable.
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+def measure(function, *args, **kwargs):
+    """
+    Runs a function and returns its wall time in seconds and the bytes it wrote.
+    """
+    written_before = bytes_written()
+    start = time.time()
+    function(*args, **kwargs)
+    elapsed = time.time() - start
+    written_after = bytes_written()
+    if written_before is None or written_after is None:
+        return elapsed, None
+    return elapsed, written_after - written_before
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+"""
+Replays a recorded frame sequence through CameraMotionDetector and reports throughput (frames/s)
+and detection latency. Frames can be a directory of images, a raw file of concatenated 8 bit greyscale
+frames or, when neither is given, a synthetic sequence where an object appears at --motion-start.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from common import load_rpi_security
+
+def load_image_directory(path, size):
+    from PIL import Image
+    frames = []
+    for name in sorted(os.listdir(path)):
+        image = Image.open(os.path.join(path, name)).convert('L').resize(size)
+        frames.append(np.asarray(image, dtype=np.uint8))
+    return frames
+
+def load_raw_file(path, size):
+    width, height = size
+    data = np.fromfile(path, dtype=np.uint8)
+    count = len(data) // (width * height)
+    return list(data[:count * width * height].reshape(count, height, width))
+
+def synthetic_frames(size, count, motion_start, seed=0):
+    width, height = size
+    random = np.random.RandomState(seed)
+    background = random.randint(60, 120, size=(height, width)).astype(np.int16)
+    frames = []
+    for i in range(count):
+        frame = background + random.randint(-4, 5, size=(height, width))
+        if i >= motion_start:
+            x = ((i - motion_start) * width // 30) % (width - width // 6)
+            frame[height // 4:height // 4 + height // 2, x:x + width // 6] = 220
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return frames
+
+def make_detector(rpis, size, callback, args, clock=time.time, max_fps=None, cpu_budget=None):
+    return rpis.CameraMotionDetector(
+        size=size,
+        callback=callback,
+        zones=args.zones,
+        threshold=args.threshold,
+        min_blocks=args.blocks,
+        max_fps=max_fps or args.max_fps,
+        cpu_budget=cpu_budget or args.cpu,
+        clock=clock
+    )
+
+def main():
+    p = argparse.ArgumentParser(description='Replay frames through the camera motion detector.')
+    p.add_argument('-i', '--images', help='Directory of image files, replayed in name order.')
+    p.add_argument('-r', '--raw', help='Raw file of concatenated 8 bit greyscale frames.')
+    p.add_argument('-s', '--size', help='Frame size as WIDTHxHEIGHT.', default='320x240')
+    p.add_argument('-f', '--fps', help='Frame rate the sequence was recorded at.', type=float, default=30)
+    p.add_argument('-m', '--motion-start', help='Index of the first frame containing motion, for latency.', type=int, default=None)
+    p.add_argument('-n', '--count', help='Number of synthetic frames.', type=int, default=300)
+    p.add_argument('--zones', help='Zones as x1,y1,x2,y2;... fractions of the frame.', default='')
+    p.add_argument('--threshold', help='Mean per pixel difference for a block to count as changed.', type=int, default=12)
+    p.add_argument('--blocks', help='Changed blocks needed to trigger.', type=int, default=2)
+    p.add_argument('--max-fps', help='Maximum frames analysed per second.', type=float, default=5)
+    p.add_argument('--cpu', help='Fraction of one CPU the detector may use.', type=float, default=0.25)
+    args = p.parse_args()
+    size = tuple([int(x) for x in args.size.split('x')])
+    args.zones = [tuple([float(x) for x in zone.split(',')]) for zone in args.zones.split(';') if zone.strip()]
+    rpis = load_rpi_security()
+    rpis.np = np
+    if args.images:
+        frames = load_image_directory(args.images, size)
+    elif args.raw:
+        frames = load_raw_file(args.raw, size)
+    else:
+        if args.motion_start is None:
+            args.motion_start = args.count // 2
+        frames = synthetic_frames(size, args.count, args.motion_start)
+    # Throughput: analyse every frame with no frame rate or CPU limits
+    detector = make_detector(rpis, size, lambda channel: None, args, max_fps=1e9, cpu_budget=1.0)
+    start = time.time()
+    for frame in frames:
+        detector.analyse(frame)
+    elapsed = time.time() - start
+    print('Frames: %s  size: %sx%s  throughput: %.1f frames/s  %.3f ms/frame' % (
+        len(frames), size[0], size[1], len(frames) / elapsed, elapsed * 1000 / len(frames)))
+    # Latency: replay in recorded time with the configured frame rate and CPU budget
+    timeline = {'frame_time': 0.0, 'wall_start': 0.0}
+    clock = lambda: timeline['frame_time'] + time.time() - timeline['wall_start']
+    triggers = []
+    detector = make_detector(rpis, size, lambda channel: triggers.append(timeline['frame_time']), args, clock=clock)
+    for i, frame in enumerate(frames):
+        timeline['frame_time'] = i / args.fps
+        timeline['wall_start'] = time.time()
+        detector.analyse(frame)
+    print('Analysed: %s  skipped: %s  triggers: %s' % (detector.frames_analysed, detector.frames_skipped, len(triggers)))
+    if args.motion_start is not None:
+        motion_time = args.motion_start / args.fps
+        early = [t for t in triggers if t < motion_time]
+        late = [t for t in triggers if t >= motion_time]
+        print('False triggers before motion: %s' % len(early))
+        if late:
+            print('Detection latency: %.3fs' % (late[0] - motion_time))
+        else:
+            print('Motion not detected')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+"""
+Runs a leader and several full rpi-security nodes in one process with the simulated backends, each
+module loaded under its own name so it has its own globals, and checks the coordinator mode:
+  - presence seen by one node keeps the whole system disarmed, and arming reaches every node,
+  - motion on every camera at once is one incident with one preview and one ARP check,
+  - a packet seen by a node disarms the leader and every node,
+  - many lightweight nodes speaking the protocol directly, to show how the leader scales.
+Times are from the wall clock, ARP ping timeouts are scaled down by --arp-scale.
+"""
+
+import argparse
+import os
+import time
+from threading import Thread
+
+from common import load_rpi_security
+from simulation import Simulation
+
+SECRET = 'simulated'
+
+class ProtocolNode(object):
+    """
+    A node without camera or sniffer that sends messages to the leader directly.
+    """
+    def __init__(self, rpis, name, address):
+        import socket
+        self.rpis = rpis
+        self.name = name
+        self.states = []
+        self.acks = {}
+        self.connection = socket.create_connection(address)
+        self.rfile = self.connection.makefile('rb')
+        challenge = rpis.read_message(self.rfile)
+        self.send({'t': 'hello', 'node': name, 'auth': rpis.node_auth(SECRET, challenge['nonce'])})
+        reader_thread = Thread(name='protocol_node_%s' % name, target=self.reader)
+        reader_thread.daemon = True
+        reader_thread.start()
+
+    def send(self, message, data=None):
+        self.connection.sendall(self.rpis.encode_message(message) + (data or b''))
+
+    def reader(self):
+        while True:
+            message = self.rpis.read_message(self.rfile)
+            if message is None:
+                return
+            if message['t'] == 'state':
+                self.states.append((time.time(), message['state']))
+            elif message['t'] == 'ack':
+                self.acks[message['name']] = time.time()
+
+    def close(self):
+        self.connection.close()
+
+def wait_until(condition, timeout=60, interval=0.01):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise SystemExit('Timed out')
+        time.sleep(interval)
+    return time.time()
+
+def count_calls(module, name, counts, key):
+    function = getattr(module, name)
+    def wrapper(*args, **kwargs):
+        counts[key] = counts.get(key, 0) + 1
+        return function(*args, **kwargs)
+    setattr(module, name, wrapper)
+
+def main():
+    p = argparse.ArgumentParser(description='Simulate a leader with several nodes.')
+    p.add_argument('-n', '--nodes', help='Full nodes besides the leader.', type=int, default=3)
+    p.add_argument('-s', '--protocol-nodes', help='Lightweight nodes for the scale test.', type=int, default=30)
+    p.add_argument('--seconds', help='Length of the scale test.', type=float, default=5)
+    p.add_argument('-t', '--packet-timeout', help='packet_timeout in seconds.', type=int, default=2)
+    p.add_argument('--arp-scale', help='Multiplier for simulated ARP ping timeouts.', type=float, default=0.1)
+    args = p.parse_args()
+    config = {
+        'camera_mode': 'photo',
+        'camera_capture_length': 1,
+        'packet_timeout': args.packet_timeout,
+        'coordinator_secret': SECRET,
+        'coordinator_dedup_seconds': 10,
+    }
+    leader_config = dict(config, coordinator_role='leader', coordinator_address='127.0.0.1:0', coordinator_node_name='leader')
+    leader = load_rpi_security('rpi_security_leader')
+    simulations = [Simulation(leader, config=leader_config, arm_delay=1, arp_scale=args.arp_scale)]
+    counts = {}
+    protocol_nodes = []
+    try:
+        address = leader.coordinator.server.server_address
+        nodes = []
+        for i in range(args.nodes):
+            node = load_rpi_security('rpi_security_node_%s' % i)
+            node_config = dict(config, coordinator_role='node', coordinator_address='%s:%s' % address, coordinator_node_name='node-%s' % i)
+            simulations.append(Simulation(node, config=node_config, arp_scale=args.arp_scale))
+            nodes.append(node)
+        count_calls(leader, 'arp_ping_macs', counts, 'arp')
+        accept = leader.coordinator.accept
+        def counted_accept(file_path, group):
+            accepted = accept(file_path, group)
+            if file_path.endswith('-preview.jpeg'):
+                counts['previews sent' if accepted else 'previews skipped'] = counts.get('previews sent' if accepted else 'previews skipped', 0) + 1
+            return accepted
+        leader.coordinator.accept = counted_accept
+        start = time.time()
+        for sim in simulations:
+            sim.start()
+        wait_until(lambda: leader.coordinator.connected_nodes() == args.nodes)
+        print('%s nodes connected to the leader in %.2fs' % (args.nodes, time.time() - start))
+
+        # Presence seen only by the first node
+        phone = leader.config['mac_addresses'][0]
+        seen_until = time.time() + args.packet_timeout * 2 + 2
+        armed = False
+        while time.time() < seen_until:
+            simulations[1].sniffer.inject(phone)
+            armed = armed or leader.alarm_state['current_state'] == 'armed'
+            time.sleep(0.2)
+        print('Phone seen only by node-0 for %.0fs: leader %s' % (args.packet_timeout * 2 + 2, 'armed' if armed else 'stayed disarmed'))
+        wait_until(lambda: leader.alarm_state['current_state'] == 'armed')
+        armed_at = leader.alarm_state['last_state_change']
+        wait_until(lambda: all([node.alarm_state['current_state'] == 'armed' for node in nodes]))
+        print('Phone gone: leader armed, every node armed %.3fs later' % max([node.alarm_state['last_state_change'] - armed_at for node in nodes]))
+
+        # Motion on every camera within a second
+        counts.pop('arp', None)
+        delivered_before = len(simulations[0].server.requests)
+        edge_time = time.time()
+        for sim in simulations:
+            sim.pir_edge()
+            time.sleep(0.2)
+        wait_until(lambda: len([r for r in simulations[0].server.requests[delivered_before:] if r.method != 'sendMessage']) >= 2 and leader.upload_queue.depth() == 0 and all([node.upload_queue.depth() == 0 for node in nodes]))
+        time.sleep(1)
+        delivered = [r for r in simulations[0].server.requests[delivered_before:] if r.method != 'sendMessage']
+        cameras = len(simulations)
+        incidents = len(leader.coordinator.incidents)
+        print('Motion on %s cameras within %.1fs:' % (cameras, 0.2 * (cameras - 1)))
+        print('  %-22s %s (standalone: %s)' % ('incidents', incidents, cameras))
+        print('  %-22s %s (standalone: %s)' % ('previews sent', counts.get('previews sent', 0), cameras))
+        print('  %-22s %s (standalone: %s)' % ('ARP checks', counts.get('arp', 0), cameras))
+        print('  %-22s %s' % ('Telegram uploads', ', '.join(['%s %sKB' % (r.method, r.size // 1024) for r in delivered])))
+        print('  %-22s %.2fs' % ('first delivered', delivered[0].time - edge_time))
+        print('  %-22s %.2fs' % ('all delivered', delivered[-1].time - edge_time))
+        print('  %-22s %s' % ('alarms recorded', ', '.join(sorted([event.get('node', '?') for event in leader.state_store.events('alarm', limit=cameras * 2)]))))
+
+        # A packet seen by the last node
+        packet_time = time.time()
+        simulations[-1].sniffer.inject(phone)
+        wait_until(lambda: leader.alarm_state['current_state'] == 'disarmed')
+        leader_disarmed = time.time()
+        wait_until(lambda: all([node.alarm_state['current_state'] == 'disarmed' for node in nodes]))
+        print('Phone seen by node-%s: leader disarmed after %.3fs, every node after %.3fs' % (args.nodes - 1, leader_disarmed - packet_time, time.time() - packet_time))
+
+        # Scale
+        start = time.time()
+        for i in range(args.protocol_nodes):
+            protocol_nodes.append(ProtocolNode(leader, 'sim-%s' % i, address))
+        wait_until(lambda: leader.coordinator.connected_nodes() == args.nodes + args.protocol_nodes)
+        print('%s more nodes connected in %.2fs' % (args.protocol_nodes, time.time() - start))
+        messages_before = sum(leader.coordinator_metric.values.values())
+        cpu_before = sum(os.times()[:2])
+        start = time.time()
+        jpeg = b'\xff\xd8' + b'\x00' * 20000
+        sent = 0
+        for second in range(int(args.seconds)):
+            for node in protocol_nodes:
+                node.send({'t': 'seen', 'macs': {phone: 0.5}})
+                sent += 1
+                if second == 0:
+                    node.send({'t': 'motion', 'group': 'rpi-security-%s' % node.name, 'age': 0.1})
+                    node.send({'t': 'file', 'name': 'rpi-security-%s-0.jpeg' % node.name, 'size': len(jpeg), 'group': 'rpi-security-%s' % node.name}, jpeg)
+                    sent += 2
+            time.sleep(max(0, start + second + 1 - time.time()))
+        wait_until(lambda: sum(leader.coordinator_metric.values.values()) - messages_before >= sent and all([node.acks for node in protocol_nodes]))
+        elapsed = time.time() - start
+        cpu = sum(os.times()[:2]) - cpu_before
+        print('%s nodes for %.0fs: %s messages and %s files handled, process CPU %.2fs (%.2f%% of one core)' % (
+            args.protocol_nodes, args.seconds, sent, args.protocol_nodes, cpu, 100 * cpu / elapsed))
+        changed = time.time()
+        leader.update_alarm_state('disabled')
+        wait_until(lambda: all([node.states and node.states[-1][1] == 'disabled' for node in protocol_nodes]) and all([node.alarm_state['current_state'] == 'disabled' for node in nodes]))
+        print('/disable reached all %s nodes in %.3fs' % (args.nodes + args.protocol_nodes, time.time() - changed))
+        leader.update_alarm_state('disarmed')
+    finally:
+        for node in protocol_nodes:
+            node.close()
+        for sim in simulations:
+            sim.close()
+
+if __name__ == "__main__":
+    main()
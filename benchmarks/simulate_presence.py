@@ -0,0 +1,108 @@
+#!/usr/bin/python
+"""
+Drives PresenceMonitor with a simulated clock and checks that arming, disarming and probing happen at
+exactly the expected times. Also reports how many times the monitor had to wake up.
+"""
+
+import argparse
+
+from common import load_rpi_security
+
+class Simulation(object):
+    def __init__(self, rpis, packet_timeout, arm_delay, probe_interval):
+        self.now = 0.0
+        self.state = 'disarmed'
+        self.transitions = []
+        self.probes = []
+        self.wakeups = 0
+        self.monitor = rpis.PresenceMonitor(
+            mac_addresses=['aa:aa:aa:bb:bb:bb'],
+            packet_timeout=packet_timeout,
+            get_state=lambda: self.state,
+            set_state=self.set_state,
+            probe=lambda: self.probes.append(self.now),
+            arm_delay=arm_delay,
+            probe_interval=probe_interval,
+            clock=lambda: self.now
+        )
+        # Probes are run synchronously so they can be recorded against the simulated clock
+        self.monitor.start_probe = self.monitor.probe
+        self.next_deadline = self.monitor.run_due(self.now)
+
+    def set_state(self, new_state):
+        if new_state != self.state:
+            self.state = new_state
+            self.transitions.append((self.now, new_state))
+
+    def advance(self, until):
+        """
+        Moves the clock forward, waking the monitor only at its deadlines like the real thread would.
+        """
+        while self.next_deadline is not None and self.next_deadline <= until:
+            self.now = self.next_deadline
+            self.wakeups += 1
+            self.next_deadline = self.monitor.run_due(self.now)
+        self.now = until
+
+    def packet(self, at):
+        self.advance(at)
+        self.monitor.packet_detected('aa:aa:aa:bb:bb:bb', at)
+        if self.monitor.woken:
+            self.wakeups += 1
+            self.next_deadline = self.monitor.run_due(self.now)
+        else:
+            self.next_deadline = self.monitor.deadlines[0][0]
+
+    def change_state(self, at, new_state):
+        self.advance(at)
+        self.set_state(new_state)
+        self.monitor.state_changed()
+        self.wakeups += 1
+        self.next_deadline = self.monitor.run_due(self.now)
+
+def check(name, actual, expected):
+    result = 'ok' if actual == expected else 'FAILED'
+    print('%-45s %-6s %s' % (name, result, actual))
+    return actual == expected
+
+def main():
+    p = argparse.ArgumentParser(description='Simulate PresenceMonitor with a fake clock.')
+    p.add_argument('-t', '--packet-timeout', type=float, default=700)
+    p.add_argument('-a', '--arm-delay', type=float, default=20)
+    p.add_argument('-p', '--probe-interval', type=float, default=3)
+    args = p.parse_args()
+    rpis = load_rpi_security()
+    timeout, delay, interval = args.packet_timeout, args.arm_delay, args.probe_interval
+    results = []
+
+    sim = Simulation(rpis, timeout, delay, interval)
+    sim.advance(timeout + delay + 100)
+    results.append(check('Arms exactly at timeout + arm delay', sim.transitions, [(timeout + delay, 'armed')]))
+    expected_probes = []
+    probe_time = timeout
+    while probe_time < timeout + delay:
+        expected_probes.append(probe_time)
+        probe_time += interval
+    results.append(check('Probes every interval in the grey zone', sim.probes, expected_probes))
+    sim.packet(timeout + delay + 50.5)
+    results.append(check('Disarms at the packet time', sim.transitions[-1], (timeout + delay + 50.5, 'disarmed')))
+    results.append(check('Wakeups (probes + arm + packet)', sim.wakeups, len(expected_probes) + 2))
+
+    sim = Simulation(rpis, timeout, delay, interval)
+    for i in range(1, 100):
+        sim.packet(i * timeout / 2)
+    results.append(check('Regular packets never arm', sim.transitions, []))
+    results.append(check('No wakeups while packets keep arriving', sim.wakeups, 0))
+
+    sim = Simulation(rpis, timeout, delay, interval)
+    sim.change_state(10, 'disabled')
+    sim.advance(timeout * 10)
+    results.append(check('Never arms while disabled', sim.transitions, [(10, 'disabled')]))
+    sim.change_state(timeout * 10, 'disarmed')
+    results.append(check('Arms immediately when enabled after timeout', sim.transitions[-1], (timeout * 10, 'armed')))
+
+    if not all(results):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+"""
+Simulated hardware and network backends for running bin/rpi-security.py on a normal Linux machine:
+a GPIO module with software triggered edges, a synthetic camera, a sniffer that replays or injects packets,
+a fake scapy network for ARP pings and a local fake Telegram Bot API server.
+Simulation wires these into the same setup functions used by the __main__ block.
+"""
+
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+from threading import Thread, Condition, current_thread
+
+from common import Namespace
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urllib2 import urlopen, Request
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.request import urlopen, Request
+
+class SimulatedGPIO(object):
+    """
+    Has the same interface as RPi.GPIO. Edges are triggered with edge() and, like RPi.GPIO, callbacks
+    are run one at a time in a separate thread.
+    """
+    BCM, IN, OUT, RISING = 11, 1, 0, 31
+
+    def __init__(self):
+        self.callbacks = {}
+        self.outputs = {}
+        self.edges = Queue.Queue()
+        callback_thread = Thread(name='gpio_callbacks', target=self.run_callbacks)
+        callback_thread.daemon = True
+        callback_thread.start()
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, initial=False):
+        if direction == self.OUT:
+            self.outputs[pin] = initial
+
+    def output(self, pin, value):
+        self.outputs[pin] = value
+
+    def add_event_detect(self, pin, edge, callback=None):
+        self.callbacks[pin] = callback
+
+    def cleanup(self):
+        self.callbacks = {}
+
+    def edge(self, pin):
+        self.edges.put(pin)
+
+    def run_callbacks(self):
+        while True:
+            pin = self.edges.get()
+            if pin in self.callbacks:
+                self.callbacks[pin](pin)
+
+class FakeCamera(object):
+    """
+    A stand-in for picamera.PiCamera that renders a synthetic scene with a moving box over a plain or
+    given background image.
+    capture_delay simulates the time the sensor needs for each frame. still_delay is added to captures
+    through the still port for the mode switch, captures through the video port wait for the next frame
+    at framerate instead. Recordings to splitter ports write yuv, mjpeg or, using ffmpeg, h264 frames to
+    the output at framerate from a background thread.
+    """
+    def __init__(self, resolution=(1024, 768), capture_delay=0.0, framerate=30, still_delay=0.0, background=None):
+        self.resolution = resolution
+        self.background = background
+        self.capture_delay = capture_delay
+        self.still_delay = still_delay
+        self.framerate = framerate
+        self.frame_number = 0
+        self.recordings = {}
+
+    def render(self, size):
+        from PIL import Image, ImageDraw
+        width, height = size
+        if self.background:
+            image = self.background.resize(size)
+        else:
+            image = Image.new('RGB', size, (90, 110, 90))
+        draw = ImageDraw.Draw(image)
+        x = (self.frame_number * width // 20) % width
+        draw.rectangle([x, height // 3, x + width // 8, height // 3 + height // 3], fill=(200, 40, 40))
+        self.frame_number += 1
+        return image
+
+    def padded(self, image):
+        from PIL import Image
+        size = ((image.size[0] + 31) // 32 * 32, (image.size[1] + 15) // 16 * 16)
+        padded = Image.new(image.mode, size)
+        padded.paste(image, (0, 0))
+        return padded
+
+    def capture(self, output, format=None, resize=None, use_video_port=False, **kwargs):
+        if use_video_port:
+            frame_interval = 1.0 / self.framerate
+            time.sleep(frame_interval - time.time() % frame_interval)
+        else:
+            time.sleep(self.still_delay)
+        time.sleep(self.capture_delay)
+        image = self.render(resize or self.resolution)
+        if format is None and isinstance(output, str):
+            format = 'jpeg' if output.endswith(('.jpg', '.jpeg')) else 'png'
+        if format == 'rgb':
+            data = self.padded(image).tobytes()
+            if isinstance(output, str):
+                with open(output, 'wb') as f:
+                    f.write(data)
+            else:
+                output.write(data)
+        else:
+            image.save(output, format=format)
+
+    def capture_sequence(self, outputs, format='jpeg', resize=None, use_video_port=False, **kwargs):
+        for output in outputs:
+            self.capture(output, format=format, resize=resize, use_video_port=use_video_port)
+
+    def h264_encoder(self, output, size, bitrate):
+        """
+        Starts ffmpeg as a stand-in for the hardware H.264 encoder. Frames are written to its stdin as RGB.
+        """
+        output_file = open(output, 'wb') if isinstance(output, str) else output
+        encoder = subprocess.Popen([
+            'ffmpeg', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%sx%s' % size,
+            '-r', str(self.framerate), '-i', '-', '-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', str(bitrate or 17000000),
+            '-f', 'h264', '-'
+        ], stdin=subprocess.PIPE, stdout=output_file)
+        if output_file is not output:
+            output_file.close()
+        return encoder
+
+    def start_recording(self, output, format=None, resize=None, splitter_port=1, bitrate=None, **kwargs):
+        recording = {'running': True}
+        self.recordings[splitter_port] = recording
+        if format == 'h264':
+            encoder = self.h264_encoder(output, resize or self.resolution, bitrate)
+        def record():
+            while recording['running']:
+                image = self.render(resize or self.resolution)
+                if format == 'h264':
+                    encoder.stdin.write(image.tobytes())
+                elif format == 'yuv':
+                    luma = self.padded(image.convert('L')).tobytes()
+                    output.write(luma + b'\x80' * (len(luma) // 2))
+                elif format == 'mjpeg':
+                    stream = io.BytesIO()
+                    image.save(stream, format='jpeg')
+                    output.write(stream.getvalue())
+                frame_interval = 1.0 / self.framerate
+                time.sleep(frame_interval - time.time() % frame_interval)
+            if format == 'h264':
+                encoder.stdin.close()
+                encoder.wait()
+        recording_thread = Thread(name='camera_port_%s' % splitter_port, target=record)
+        recording_thread.daemon = True
+        recording_thread.start()
+        recording['thread'] = recording_thread
+
+    def wait_recording(self, timeout=0, splitter_port=1):
+        time.sleep(timeout)
+
+    def stop_recording(self, splitter_port=1):
+        recording = self.recordings.pop(splitter_port, None)
+        if recording:
+            recording['running'] = False
+            # Like picamera, return once the output is complete
+            if recording['thread'] is not current_thread():
+                recording['thread'].join()
+
+    def close(self):
+        for splitter_port in list(self.recordings):
+            self.stop_recording(splitter_port)
+
+def probe_request_frame(mac_address):
+    """
+    Returns a radiotap frame containing an 802.11 probe request from mac_address.
+    """
+    mac = bytes(bytearray([int(x, 16) for x in mac_address.split(':')]))
+    broadcast = b'\xff' * 6
+    return struct.pack('<BBHI', 0, 0, 8, 0) + struct.pack('<BBH', 0x40, 0, 0) + broadcast + mac + broadcast + b'\x00\x00'
+
+class ReplaySniffer(object):
+    """
+    Replaces capture_packets. Replays (seconds, frame) pairs at their original spacing and then
+    passes on frames injected with inject(), all through the real PacketTracker.
+    """
+    def __init__(self, rpis, frames=None):
+        self.rpis = rpis
+        self.frames = frames or []
+        self.injected = Queue.Queue()
+
+    def inject(self, mac_address):
+        self.injected.put(probe_request_frame(mac_address))
+
+    def capture_packets(self, network_interface, network_interface_mac, mac_addresses):
+        tracker = self.rpis.PacketTracker(mac_addresses, self.rpis.packet_detected)
+        start = time.time()
+        for offset, frame in self.frames:
+            time.sleep(max(start + offset - time.time(), 0))
+            tracker.raw_frame(frame)
+        while True:
+            tracker.raw_frame(self.injected.get())
+
+class FakeLayer(object):
+    """
+    Stands in for scapy Ether and ARP layers, fields are combined with the / operator.
+    """
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __div__(self, other):
+        packet = FakeLayer(**self.__dict__)
+        packet.__dict__.update(other.__dict__)
+        return packet
+    __truediv__ = __div__
+
+class FakeNetwork(object):
+    """
+    Provides srp for ARP pings. MAC addresses in online answer, every srp call takes timeout * scale seconds
+    when any packet is unanswered, as a real one would.
+    """
+    def __init__(self, online=None, scale=1.0):
+        self.online = online or {}
+        self.scale = scale
+
+    def srp(self, packets, timeout=1, verbose=False):
+        answered = []
+        for packet in packets:
+            if packet.dst in self.online:
+                answered.append((packet, FakeLayer(hwsrc=packet.dst, psrc=self.online[packet.dst])))
+        if len(answered) < len(packets):
+            time.sleep(timeout * self.scale)
+        return answered, []
+
+class FakeTelegramServer(ThreadingMixIn, HTTPServer):
+    """
+    A local Telegram Bot API server. Every request is recorded with the time it finished uploading.
+    Uploads are slowed down to simulate the uplink with latency seconds and bandwidth bytes/s.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, bandwidth=250000):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeTelegramHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = []
+        self.condition = Condition()
+        self.url = 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def start(self):
+        server_thread = Thread(name='fake_telegram', target=self.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return self
+
+    def record(self, method, body):
+        with self.condition:
+            self.requests.append(Namespace(method=method, time=time.time(), size=len(body), body=body))
+            self.condition.notify_all()
+
+    def wait_for(self, match, start=0, timeout=60):
+        """
+        Waits for a request from index start where match(request) is true and returns it, or None on timeout.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                for request in self.requests[start:]:
+                    if match(request):
+                        return request
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        method = self.path.rstrip('/').split('/')[-1]
+        if method == 'getUpdates':
+            time.sleep(1)
+            result = []
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'rpi-security', 'username': 'rpi_security_bot'}
+        else:
+            time.sleep(self.server.latency + len(body) / float(self.server.bandwidth))
+            self.server.record(method, body)
+            result = {'message_id': len(self.server.requests), 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'}}
+        response = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+class SimpleBot(object):
+    """
+    A minimal Telegram Bot API client used when python-telegram-bot is not installed.
+    """
+    def __init__(self, token, base_url):
+        self.base_url = '%s/bot%s' % (base_url, token)
+
+    def post(self, method, body, timeout):
+        urlopen(Request('%s/%s' % (self.base_url, method), data=body), timeout=timeout).read()
+
+    def sendMessage(self, chat_id, text, parse_mode=None, timeout=None, **kwargs):
+        self.post('sendMessage', json.dumps({'chat_id': chat_id, 'text': text}).encode('utf-8'), timeout)
+
+    def sendPhoto(self, chat_id, photo, timeout=None, **kwargs):
+        self.post('sendPhoto', photo.read(), timeout)
+
+    def sendDocument(self, chat_id, document, timeout=None, **kwargs):
+        self.post('sendDocument', document.read(), timeout)
+
+    def sendVideo(self, chat_id, video, timeout=None, **kwargs):
+        self.post('sendVideo', video.read(), timeout)
+
+    def sendMediaGroup(self, chat_id, media, timeout=None, **kwargs):
+        self.post('sendMediaGroup', b''.join([item.media.read() for item in media]), timeout)
+
+class Simulation(object):
+    """
+    Runs rpi-security with every backend simulated. config holds rpi-security.conf values as strings.
+    The simulated backends are installed by replacing the load_ functions used by start(). With setup=False
+    nothing is loaded or set up, so the caller can run start() itself.
+    """
+    def __init__(self, rpis, config=None, frames=None, latency=0.05, bandwidth=250000, arp_scale=1.0, arm_delay=20, still_delay=0.0, setup=True):
+        self.rpis = rpis
+        self.still_delay = still_delay
+        self.temp_dir = tempfile.mkdtemp(prefix='rpi-security-sim-')
+        values = {
+            'mac_addresses': 'aa:aa:aa:bb:bb:bb',
+            'telegram_bot_token': 'simulated',
+            'camera_save_path': self.temp_dir,
+            'outbox_file': os.path.join(self.temp_dir, 'outbox.db'),
+        }
+        values.update(config or {})
+        config_file = os.path.join(self.temp_dir, 'rpi-security.conf')
+        with open(config_file, 'w') as f:
+            f.write('[main]\n' + ''.join(['%s=%s\n' % item for item in values.items()]))
+        rpis.config = rpis.parse_config_file(config_file)
+        rpis.config['network_interface_mac'] = '00:0f:60:08:9c:01'
+        rpis.config['network_address'] = '192.168.1.0/24'
+        rpis.state = {'telegram_chat_id': 1}
+        rpis.state_store = rpis.StateStore(os.path.join(self.temp_dir, 'state'))
+        self.server = FakeTelegramServer(latency, bandwidth).start()
+        self.network = FakeNetwork(scale=arp_scale)
+        self.gpio = SimulatedGPIO()
+        self.sniffer = ReplaySniffer(rpis, frames)
+        rpis.capture_packets = self.sniffer.capture_packets
+        # Bot commands are not simulated
+        rpis.telegram_bot = lambda token: None
+        rpis.load_gpio = self.load_gpio
+        rpis.load_camera = self.load_camera
+        rpis.load_imaging = self.load_imaging
+        rpis.load_telegram = self.load_telegram
+        rpis.load_scapy = self.load_scapy
+        if setup:
+            for load in [self.load_gpio, self.load_camera, self.load_imaging, self.load_telegram, self.load_scapy]:
+                load()
+            rpis.setup_services()
+            rpis.setup_pre_trigger_buffer()
+            # Nodes of a coordinator have no presence monitor
+            if rpis.presence_monitor:
+                rpis.presence_monitor.arm_delay = arm_delay
+                rpis.presence_monitor.state_changed()
+
+    def load_gpio(self):
+        self.rpis.setup_gpio(self.gpio)
+
+    def load_camera(self):
+        self.rpis.setup_camera(Namespace(PiCamera=lambda: FakeCamera(still_delay=self.still_delay)))
+
+    def load_imaging(self):
+        from PIL import Image
+        self.rpis.Image = Image
+        try:
+            import numpy
+            self.rpis.np = numpy
+        except ImportError:
+            pass
+
+    def load_telegram(self):
+        try:
+            import telegram
+            self.rpis.bot = telegram.Bot(token=self.rpis.config['telegram_bot_token'], base_url=self.server.url + '/bot')
+            self.rpis.InputMediaPhoto = telegram.InputMediaPhoto
+        except ImportError:
+            self.rpis.bot = SimpleBot(self.rpis.config['telegram_bot_token'], self.server.url)
+            self.rpis.InputMediaPhoto = Namespace
+
+    def load_scapy(self):
+        self.rpis.srp = self.network.srp
+        self.rpis.Ether = FakeLayer
+        self.rpis.ARP = FakeLayer
+
+    def start(self):
+        self.rpis.start_threads()
+        self.rpis.start_motion_detection()
+        return self
+
+    def pir_edge(self):
+        self.gpio.edge(self.rpis.config['pir_pin'])
+
+    def close(self):
+        self.rpis.camera.close()
+        self.server.shutdown()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
@@ -1,21 +1,40 @@
 #!/usr/bin/python
 
 import os
+import io
+import math
+import socket
+import struct
+import ctypes
+import binascii
+import hashlib
+import hmac
+import shutil
+import subprocess
 import argparse
 import logging
 import logging.handlers
 from ConfigParser import SafeConfigParser
-import RPi.GPIO as GPIO
 from datetime import datetime, timedelta
 import sys
 import time
 import signal
-import yaml
+import json
+import sqlite3
+import Queue
+import heapq
+import bisect
+import functools
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from threading import Thread, Lock, Condition, Event, current_thread
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
 
 def parse_arguments():
     p = argparse.ArgumentParser(description='A simple security system to run on a Raspberry Pi.')
     p.add_argument('-c', '--config_file', help='Path to config file.', default='/etc/rpi-security.conf')
-    p.add_argument('-s', '--state_file', help='Path to state file.', default='/var/lib/rpi-security/state.yaml')
+    p.add_argument('-s', '--state_dir', help='Path to state directory.', default='/var/lib/rpi-security/state')
     p.add_argument('-d', '--debug', help='To enable debug output to stdout', action='store_true', default=False)
     return p.parse_args()
 
@@ -72,7 +91,51 @@ def parse_config_file(config_file):
         'camera_hflip': 'False',
         'camera_image_size': '1024x768',
         'camera_mode': 'video',
-        'camera_capture_length': '3'
+        'camera_capture_length': '3',
+        'motion_detection': 'pir',
+        'camera_motion_size': '320x240',
+        'camera_motion_zones': '',
+        'camera_motion_threshold': '12',
+        'camera_motion_blocks': '2',
+        'camera_motion_fps': '5',
+        'camera_motion_cpu': '0.25',
+        'camera_pre_trigger_seconds': '0',
+        'camera_pre_trigger_fps': '2',
+        'camera_pre_trigger_size': '800x600',
+        'camera_pre_trigger_frame_kb': '128',
+        'upload_workers': '2',
+        'upload_queue_size': '100',
+        'upload_retries': '5',
+        'outbox_file': '/var/lib/rpi-security/outbox.db',
+        'packet_capture': 'scapy',
+        'metrics_address': '127.0.0.1',
+        'metrics_port': '0',
+        'media_max_mb': '500',
+        'media_max_age_days': '30',
+        'archive_backend': 'none',
+        'archive_path': '/var/lib/rpi-security/archive',
+        'archive_s3_bucket': '',
+        'archive_s3_prefix': 'rpi-security/',
+        'archive_s3_endpoint': '',
+        'archive_batch_size': '20',
+        'archive_chunk_mb': '8',
+        'camera_burst_fps': '0',
+        'camera_video_bitrate': '2000000',
+        'camera_gif_max_kb': '0',
+        'camera_on_demand_freshness': '5',
+        'motion_cooldown': '10',
+        'motion_max_event_seconds': '60',
+        'motion_max_captures_per_hour': '60',
+        'alert_preview': 'True',
+        'alert_preview_size': '320x240',
+        'alert_upload_target_seconds': '10',
+        'state_snapshot_kb': '256',
+        'state_history_mb': '5',
+        'coordinator_role': 'standalone',
+        'coordinator_address': '0.0.0.0:8765',
+        'coordinator_secret': '',
+        'coordinator_node_name': '',
+        'coordinator_dedup_seconds': '30'
     }
     cfg = SafeConfigParser(defaults=default_config)
     cfg.read(config_file)
@@ -84,36 +147,510 @@ def parse_config_file(config_file):
     dict_config['camera_image_size'] = tuple([int(x) for x in dict_config['camera_image_size'].split('x')])
     dict_config['camera_capture_length'] = int(dict_config['camera_capture_length'])
     dict_config['packet_timeout'] = int(dict_config['packet_timeout'])
+    dict_config['motion_detection'] = dict_config['motion_detection'].lower()
+    dict_config['packet_capture'] = dict_config['packet_capture'].lower()
+    dict_config['camera_motion_size'] = tuple([int(x) for x in dict_config['camera_motion_size'].split('x')])
+    dict_config['camera_motion_zones'] = [tuple([float(x) for x in zone.split(',')]) for zone in dict_config['camera_motion_zones'].split(';') if zone.strip()]
+    dict_config['camera_motion_threshold'] = int(dict_config['camera_motion_threshold'])
+    dict_config['camera_motion_blocks'] = int(dict_config['camera_motion_blocks'])
+    dict_config['camera_motion_fps'] = float(dict_config['camera_motion_fps'])
+    dict_config['camera_motion_cpu'] = float(dict_config['camera_motion_cpu'])
+    dict_config['camera_pre_trigger_seconds'] = float(dict_config['camera_pre_trigger_seconds'])
+    dict_config['camera_pre_trigger_fps'] = float(dict_config['camera_pre_trigger_fps'])
+    dict_config['camera_pre_trigger_size'] = tuple([int(x) for x in dict_config['camera_pre_trigger_size'].split('x')])
+    dict_config['camera_pre_trigger_frame_kb'] = int(dict_config['camera_pre_trigger_frame_kb'])
+    dict_config['upload_workers'] = int(dict_config['upload_workers'])
+    dict_config['upload_queue_size'] = int(dict_config['upload_queue_size'])
+    dict_config['upload_retries'] = int(dict_config['upload_retries'])
+    dict_config['metrics_port'] = int(dict_config['metrics_port'])
+    dict_config['media_max_mb'] = int(dict_config['media_max_mb'])
+    dict_config['media_max_age_days'] = float(dict_config['media_max_age_days'])
+    dict_config['archive_backend'] = dict_config['archive_backend'].lower()
+    dict_config['archive_batch_size'] = int(dict_config['archive_batch_size'])
+    dict_config['archive_chunk_mb'] = int(dict_config['archive_chunk_mb'])
+    dict_config['camera_burst_fps'] = float(dict_config['camera_burst_fps'])
+    dict_config['camera_video_bitrate'] = int(dict_config['camera_video_bitrate'])
+    dict_config['camera_gif_max_kb'] = int(dict_config['camera_gif_max_kb'])
+    dict_config['camera_on_demand_freshness'] = float(dict_config['camera_on_demand_freshness'])
+    dict_config['motion_cooldown'] = float(dict_config['motion_cooldown'])
+    dict_config['motion_max_event_seconds'] = float(dict_config['motion_max_event_seconds'])
+    dict_config['motion_max_captures_per_hour'] = int(dict_config['motion_max_captures_per_hour'])
+    dict_config['alert_preview'] = str2bool(dict_config['alert_preview'])
+    dict_config['alert_preview_size'] = tuple([int(x) for x in dict_config['alert_preview_size'].split('x')])
+    dict_config['alert_upload_target_seconds'] = float(dict_config['alert_upload_target_seconds'])
+    dict_config['state_snapshot_kb'] = int(dict_config['state_snapshot_kb'])
+    dict_config['state_history_mb'] = float(dict_config['state_history_mb'])
+    dict_config['coordinator_role'] = dict_config['coordinator_role'].lower()
+    dict_config['coordinator_node_name'] = dict_config['coordinator_node_name'] or socket.gethostname().split('.')[0]
+    dict_config['coordinator_dedup_seconds'] = float(dict_config['coordinator_dedup_seconds'])
     if ',' in dict_config['mac_addresses']:
         dict_config['mac_addresses'] = dict_config['mac_addresses'].lower().split(',')
     else:
         dict_config['mac_addresses'] = [ dict_config['mac_addresses'].lower() ]
     return dict_config
 
-def read_state_file(state_file):
-    result = {}
+def migrate_state_file(state_file, state_store):
+    """
+    Copies the Telegram chat_id from the YAML state file used by earlier versions into the state store.
+    """
+    if not os.path.exists(state_file) or state_store.get('telegram_chat_id') is not None:
+        return
     try:
+        import yaml
         with open(state_file, 'r') as stream:
-            result = yaml.load(stream) or {}
+            legacy_state = yaml.safe_load(stream) or {}
+        if 'telegram_chat_id' in legacy_state:
+            state_store.set('telegram_chat_id', legacy_state['telegram_chat_id'])
+        os.rename(state_file, state_file + '.migrated')
     except Exception as e:
-        logger.error('Failed to read state file %s: %s' % (state_file, e))
+        logger.error('Failed to migrate state file %s: %s' % (state_file, e))
     else:
-        logger.debug('State file read: %s' % state_file)
-    return result
+        logger.info('Migrated state file %s' % state_file)
+
+class StateStore(object):
+    """
+    Durable state and event history kept in a directory as an append-only journal plus a snapshot.
+    Records are appended to the current journal segment by a single writer thread, so a burst of records
+    costs one write and one fsync. Values set with durable=False, such as the time of the last packet, are
+    only kept in memory until the next snapshot so frequent updates never touch the SD card. Snapshots are
+    written to a temporary file and renamed into place when values are waiting and snapshot_interval has
+    passed, and when the segment reaches snapshot_bytes, when a new segment is also started. Loading reads
+    the snapshot and replays only the records after it. Older segments are kept up to history_bytes and
+    are read backwards by events(), so queries for recent events only read the end of the journal.
+    Each record is one line of JSON prefixed with its CRC32, so a record torn by a power cut is discarded.
+    """
+    def __init__(self, path, snapshot_bytes=256*1024, snapshot_interval=3600, history_bytes=5*1024*1024, flush_interval=0.5, clock=time.time):
+        self.path = path
+        self.snapshot_bytes = snapshot_bytes
+        self.snapshot_interval = snapshot_interval
+        self.history_bytes = history_bytes
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.lock = Lock()
+        self.condition = Condition(self.lock)
+        # Held while writing the journal or a snapshot so close() can flush from another thread
+        self.write_lock = Lock()
+        self.pending = []
+        self.values = {}
+        self.seq = 0
+        self.segment = 0
+        self.dirty = False
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.load()
+        self.last_snapshot = clock()
+        self.journal = open(self.segment_file(self.segment), 'ab')
+
+    def segment_file(self, segment):
+        return os.path.join(self.path, 'journal-%08d.log' % segment)
+
+    def segments(self):
+        """
+        Returns the numbers of the journal segments on disk in ascending order.
+        """
+        return sorted([int(name[8:16]) for name in os.listdir(self.path) if name.startswith('journal-') and name.endswith('.log')])
+
+    def encode(self, record):
+        line = json.dumps(record, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        return ('%08x ' % (binascii.crc32(line) & 0xffffffff)).encode('ascii') + line + b'\n'
+
+    def decode(self, line):
+        """
+        Returns the record from a journal line, or None if it is torn or corrupt.
+        """
+        line = line.rstrip(b'\n')
+        if len(line) < 10 or line[8:9] != b' ':
+            return None
+        try:
+            if int(line[:8], 16) != binascii.crc32(line[9:]) & 0xffffffff:
+                return None
+            return json.loads(line[9:].decode('utf-8'))
+        except ValueError:
+            return None
+
+    def load(self):
+        snapshot_file = os.path.join(self.path, 'snapshot.json')
+        first_segment = 0
+        if os.path.exists(snapshot_file):
+            try:
+                with open(snapshot_file, 'r') as f:
+                    snapshot = json.load(f)
+                self.values = snapshot['values']
+                self.seq = snapshot['seq']
+                first_segment = snapshot['segment']
+            except Exception as e:
+                logger.error('Failed to read state snapshot %s, replaying the whole journal: %s' % (snapshot_file, e))
+                self.values, self.seq = {}, 0
+        segments = [segment for segment in self.segments() if segment >= first_segment]
+        replayed = 0
+        for segment in segments:
+            valid_size = 0
+            with open(self.segment_file(segment), 'rb') as f:
+                for line in f:
+                    record = self.decode(line)
+                    if record is None:
+                        break
+                    valid_size += len(line)
+                    if record['seq'] <= self.seq:
+                        continue
+                    self.seq = record['seq']
+                    if record['type'] == 'set':
+                        self.values[record['key']] = record['value']
+                    replayed += 1
+            if valid_size < os.path.getsize(self.segment_file(segment)):
+                logger.warning('Discarding a torn record at the end of %s' % self.segment_file(segment))
+                with open(self.segment_file(segment), 'r+b') as f:
+                    f.truncate(valid_size)
+        self.segment = max(segments + [first_segment])
+        logger.debug('State loaded from %s, replayed %s journal records' % (self.path, replayed))
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.values.get(key, default)
+
+    def set(self, key, value, durable=True):
+        """
+        Sets a value. Durable values are journaled straight away, others are written with the next snapshot.
+        """
+        with self.lock:
+            if key in self.values and self.values[key] == value:
+                return
+            self.values[key] = value
+            if not durable:
+                if not self.dirty:
+                    self.dirty = True
+                    # Wakes the writer thread to start waiting for snapshot_interval
+                    self.condition.notify()
+                return
+        self.append({'type': 'set', 'key': key, 'value': value})
+
+    def record(self, event_type, **fields):
+        """
+        Appends an event, such as an alarm or a state change, to the journal.
+        """
+        fields['type'] = event_type
+        self.append(fields)
+
+    def append(self, record):
+        with self.condition:
+            self.seq += 1
+            record['seq'] = self.seq
+            record.setdefault('time', self.clock())
+            self.pending.append(record)
+            self.condition.notify()
+
+    def flush(self):
+        """
+        Writes pending records with one fsync and takes a snapshot if one is due.
+        """
+        with self.write_lock:
+            with self.lock:
+                records, self.pending = self.pending, []
+            if records:
+                self.journal.write(b''.join([self.encode(record) for record in records]))
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+            if self.journal.tell() >= self.snapshot_bytes:
+                self.snapshot(rotate=True)
+            elif self.dirty and self.clock() - self.last_snapshot >= self.snapshot_interval:
+                self.snapshot()
+
+    def snapshot(self, rotate=False):
+        """
+        Writes the values to a new snapshot, optionally starting a new journal segment. Must hold write_lock.
+        Records already in the snapshot are skipped when the segment it points to is replayed.
+        """
+        if rotate:
+            self.journal.close()
+            self.segment += 1
+            self.journal = open(self.segment_file(self.segment), 'ab')
+        with self.lock:
+            values = json.dumps({'seq': self.seq, 'segment': self.segment, 'values': self.values})
+            self.dirty = False
+        snapshot_file = os.path.join(self.path, 'snapshot.json')
+        with open(snapshot_file + '.tmp', 'w') as f:
+            f.write(values)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(snapshot_file + '.tmp', snapshot_file)
+        directory = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.last_snapshot = self.clock()
+        if rotate:
+            self.prune()
+        logger.debug('State snapshot written at journal segment %s' % self.segment)
+
+    def prune(self):
+        """
+        Deletes the oldest journal segments from before the snapshot beyond history_bytes.
+        """
+        kept = 0
+        for segment in reversed(self.segments()):
+            if segment >= self.segment:
+                continue
+            kept += os.path.getsize(self.segment_file(segment))
+            if kept > self.history_bytes:
+                os.remove(self.segment_file(segment))
+
+    def read_backwards(self, file_path, block_size=8192):
+        """
+        Yields the lines of a file from last to first, reading one block at a time.
+        """
+        with open(file_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b''
+            while position > 0:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + remainder).split(b'\n')
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    if line:
+                        yield line
+            if remainder:
+                yield remainder
+
+    def events(self, event_type=None, limit=10):
+        """
+        Returns up to limit of the most recent events, newest first, optionally only those of one type.
+        """
+        result = []
+        with self.lock:
+            pending = list(self.pending)
+        for record in reversed(pending):
+            if len(result) < limit and record['type'] != 'set' and event_type in [None, record['type']]:
+                result.append(record)
+        for segment in reversed(self.segments()):
+            if len(result) >= limit:
+                break
+            try:
+                for line in self.read_backwards(self.segment_file(segment)):
+                    record = self.decode(line)
+                    if record is None or record['type'] == 'set' or event_type not in [None, record['type']]:
+                        continue
+                    if pending and record['seq'] >= pending[0]['seq']:
+                        continue
+                    result.append(record)
+                    if len(result) >= limit:
+                        break
+            except (IOError, OSError):
+                # Removed by prune() while being read
+                continue
+        return result
+
+    def close(self):
+        """
+        Writes pending records and a final snapshot so the next start has nothing to replay.
+        """
+        self.flush()
+        with self.write_lock:
+            self.snapshot()
+
+    def run(self):
+        logger.info("thread running")
+        while True:
+            with self.condition:
+                if not self.pending:
+                    self.condition.wait(self.snapshot_interval if self.dirty else None)
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('Failed to write state journal %s: %s' % (self.path, e))
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets. Recording is a bisect and a few increments under a lock,
+    so memory use never grows and it is cheap enough to leave on permanently.
+    """
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket containing quantile q, or None if there are no observations.
+        """
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if count == 0:
+            return None
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += bucket_count
+            if cumulative >= q * count:
+                return bound
+
+    def prometheus(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.total, self.count
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s histogram' % self.name]
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds, counts):
+            cumulative += bucket_count
+            lines.append('%s_bucket{le="%s"} %s' % (self.name, bound, cumulative))
+        lines.append('%s_bucket{le="+Inf"} %s' % (self.name, count))
+        lines.append('%s_sum %s' % (self.name, total))
+        lines.append('%s_count %s' % (self.name, count))
+        return lines
+
+    def summary(self):
+        if self.count == 0:
+            return '%s: none' % self.name
+        return '%s: %s, mean %.2fs, p50 <%ss, p95 <%ss' % (self.name, self.count, self.total / self.count, self.quantile(0.5), self.quantile(0.95))
 
-def write_state_file(state_file, state_data):
+class Counter(object):
     """
-    Writes a state file to disk.
+    A counter with an optional label, e.g. packets per MAC address.
     """
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, label_value=None, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def prometheus(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s counter' % self.name]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_value, value in values:
+            if self.label:
+                lines.append('%s{%s="%s"} %s' % (self.name, self.label, label_value, value))
+            else:
+                lines.append('%s %s' % (self.name, value))
+        return lines
+
+    def summary(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        if self.label and values:
+            return '%s: %s' % (self.name, ', '.join(['%s %s' % item for item in values]))
+        return '%s: %s' % (self.name, sum([value for label_value, value in values]))
+
+class Gauge(object):
+    """
+    A value read from a function when metrics are collected.
+    """
+    def __init__(self, name, help_text, function):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+
+    def value(self):
+        try:
+            return self.function()
+        except Exception:
+            return 0
+
+    def prometheus(self):
+        return ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s gauge' % self.name, '%s %s' % (self.name, self.value())]
+
+    def summary(self):
+        return '%s: %s' % (self.name, self.value())
+
+class Metrics(object):
+    """
+    Registry of metrics exposed in Prometheus text format and summarised by the /stats bot command.
+    """
+    latency_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, prefix='rpi_security_'):
+        self.prefix = prefix
+        self.metrics = OrderedDict()
+
+    def add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, help_text, buckets=latency_buckets):
+        return self.add(Histogram(name, help_text, buckets))
+
+    def counter(self, name, help_text, label=None):
+        return self.add(Counter(name, help_text, label))
+
+    def gauge(self, name, help_text, function):
+        return self.add(Gauge(name, help_text, function))
+
+    def timed(self, name, help_text):
+        """
+        Decorator that records the duration of each call in a histogram.
+        """
+        histogram = self.histogram(name, help_text)
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    histogram.observe(time.time() - start)
+            return wrapper
+        return decorator
+
+    def prometheus(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.prometheus())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        return '\n'.join([metric.summary()[len(self.prefix):] for metric in self.metrics.values()])
+
+metrics = Metrics()
+packets_metric = metrics.counter('packets_total', 'Packets detected from monitored MAC addresses', label='mac')
+motion_metric = metrics.counter('motion_events_total', 'Motion events while armed')
+send_failures_metric = metrics.counter('telegram_send_failures_total', 'Failed Telegram file sends')
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(address, port):
+    """
+    Serves metrics in Prometheus text format on http://address:port/metrics.
+    """
+    logger.info("thread running")
     try:
-        with open(state_file, 'w') as f:
-            yaml.dump(state_data, f, default_flow_style=False)
+        HTTPServer((address, port), MetricsHandler).serve_forever()
     except Exception as e:
-        logger.error('Failed to write state file %s: %s' % (state_file, e))
-    else:
-        logger.debug('State file written: %s' % state_file)
+        logger.error('Metrics server failed with error: %s' % e)
 
-def take_photo(output_file):
+@metrics.timed('take_photo_seconds', 'Time to capture a photo')
+def take_photo(output_file, resize=None):
     """
     Captures a photo and saves it disk.
     """
@@ -122,7 +659,7 @@ def take_photo(output_file):
         time.sleep(0.25)
         GPIO.output(32, False)
     try:
-        camera.capture(output_file)
+        camera.capture(output_file, resize=resize)
     except Exception as e:
         logger.error('Failed to take photo: %s' % e)
         return False
@@ -130,21 +667,184 @@ def take_photo(output_file):
         logger.info("Captured image: %s" % output_file)
         return True
 
-def take_gif(output_file, length):
-    temp_jpeg_path = config['camera_save_path'] + "/rpi-security-" + datetime.now().strftime("%Y-%m-%d-%H%M%S") + 'gif-part'
-    jpeg_files = ['%s-%s.jpg' % (temp_jpeg_path, i) for i in range(length*3)]
+@metrics.timed('take_preview_seconds', 'Time to capture an alert preview')
+def take_preview(output_file, size, quality=60):
+    """
+    Captures a small, low quality JPEG through the video port to send ahead of the full media.
+    This takes about one frame time as the sensor is already streaming.
+    """
+    try:
+        camera.capture(output_file, format='jpeg', use_video_port=True, resize=size, quality=quality)
+    except Exception as e:
+        logger.error('Failed to take preview: %s' % e)
+        return False
+    return True
+
+@metrics.timed('take_burst_seconds', 'Time to capture a burst of photos')
+def take_burst(count, fps, frame_captured=None, resize=None):
+    """
+    Captures count JPEG frames at up to fps through the video port in one capture_sequence call. Unlike
+    take_photo the sensor keeps streaming between frames so there is no mode switch per frame.
+    Returns the frames as a list of JPEG bytes. Each frame is also passed to frame_captured(index, jpeg)
+    as soon as it is complete so it can be sent before the burst finishes.
+    """
+    frames = []
+    def outputs():
+        interval = 1.0 / fps
+        next_frame = time.time()
+        for i in range(count):
+            delay = next_frame - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            next_frame = max(next_frame + interval, time.time())
+            stream = io.BytesIO()
+            # capture_sequence asks for the next output after the previous frame is complete
+            yield stream
+            frames.append(stream.getvalue())
+            if frame_captured:
+                frame_captured(i, frames[-1])
+    if args.debug:
+        GPIO.output(32, True)
     try:
-        for jpeg in jpeg_files:
-            camera.capture(jpeg, resize=(800,600))
-        im=Image.open(jpeg_files[0])
-        jpeg_files_no_first_frame=[x for x in jpeg_files if x != jpeg_files[0]]
-        ims = [Image.open(i) for i in jpeg_files_no_first_frame]
-        im.save(output_file, append_images=ims, save_all=True, loop=0, duration=200)
-        im.close()
-        for imfile in ims:
-            imfile.close()
-        for jpeg in jpeg_files:
-            os.remove(jpeg)
+        camera.capture_sequence(outputs(), format='jpeg', use_video_port=True, resize=resize)
+    except Exception as e:
+        logger.error('Failed to take burst: %s' % e)
+    if args.debug:
+        GPIO.output(32, False)
+    return frames
+
+def capture_frames(count, resize=None):
+    """
+    Captures a sequence of frames into memory and returns them as a list of PIL images.
+    Frames are captured as raw RGB so nothing is written to disk and no JPEG encode/decode is needed.
+    """
+    width, height = resize or camera.resolution
+    # The camera pads raw output to a multiple of 32 columns and 16 rows
+    padded_size = ((width + 31) // 32 * 32, (height + 15) // 16 * 16)
+    streams = [io.BytesIO() for i in range(count)]
+    camera.capture_sequence(streams, format='rgb', resize=resize)
+    frames = []
+    for stream in streams:
+        frame = Image.frombuffer('RGB', padded_size, stream.getvalue(), 'raw', 'RGB', 0, 1)
+        frames.append(frame.crop((0, 0, width, height)))
+        stream.close()
+    return frames
+
+class GifEncoder(object):
+    """
+    Encodes RGB frames as an animated GIF. One palette is computed for the whole sequence from a sample
+    of the frames and applied to every pixel through a numpy lookup table of 5 bit colours, instead of
+    PIL quantizing each frame separately. After the first frame only the bounding box of the pixels that
+    changed by more than tolerance is stored and the unchanged pixels inside it are transparent. Frames
+    without changes are merged into the previous frame's duration.
+    """
+    transparent = 255
+
+    def __init__(self, tolerance=12, sample_step=4):
+        self.tolerance = tolerance
+        self.sample_step = sample_step
+
+    def palette(self, frames):
+        """
+        Returns a palette of up to 255 colours, leaving index 255 for transparency, as an (n, 3) array.
+        """
+        sample = np.concatenate([np.asarray(frame)[::self.sample_step, ::self.sample_step].reshape(-1, 3) for frame in frames])
+        strip = Image.frombuffer('RGB', (len(sample), 1), sample.tobytes(), 'raw', 'RGB', 0, 1)
+        palette = strip.quantize(self.transparent).getpalette()
+        return np.array(palette[:self.transparent * 3], dtype=np.uint8).reshape(-1, 3)
+
+    def lookup_table(self, palette):
+        """
+        Returns the nearest palette index for every 5 bit colour, computed in chunks to limit memory use.
+        """
+        grid = (np.indices((32, 32, 32)).reshape(3, -1).T * 8 + 4).astype(np.float32)
+        colours = palette.astype(np.float32)
+        colour_norms = (colours ** 2).sum(axis=1)
+        table = np.empty(len(grid), dtype=np.uint8)
+        for start in range(0, len(grid), 8192):
+            chunk = grid[start:start + 8192]
+            # |a - b|^2 = |a|^2 - 2a.b + |b|^2, |a|^2 is the same for every colour so is left out
+            table[start:start + 8192] = np.argmin(colour_norms - 2 * chunk.dot(colours.T), axis=1)
+        return table
+
+    def indices(self, frame, table):
+        pixels = np.asarray(frame).astype(np.uint16) >> 3
+        return table[(pixels[:, :, 0] << 10) | (pixels[:, :, 1] << 5) | pixels[:, :, 2]]
+
+    def frame_image(self, indices, palette_bytes):
+        height, width = indices.shape
+        image = Image.frombuffer('P', (width, height), np.ascontiguousarray(indices).tobytes(), 'raw', 'P', 0, 1)
+        image.putpalette(palette_bytes)
+        return image
+
+    def encode(self, frames, duration):
+        """
+        Returns the GIF as bytes, each frame shown for duration milliseconds.
+        """
+        from PIL import GifImagePlugin
+        palette = self.palette(frames)
+        table = self.lookup_table(palette)
+        colours = palette.astype(np.int16)
+        palette_bytes = palette.tobytes() + b'\x00' * (768 - palette.size)
+        canvas = self.indices(frames[0], table)
+        # Frames are (indices, offset, duration), durations grow as unchanged frames are merged
+        gif_frames = [[canvas.copy(), (0, 0), duration]]
+        for frame in frames[1:]:
+            indices = self.indices(frame, table)
+            changed = np.abs(colours[indices] - colours[canvas]).sum(axis=2) > self.tolerance
+            rows = np.flatnonzero(changed.any(axis=1))
+            if len(rows) == 0:
+                gif_frames[-1][2] += duration
+                continue
+            cols = np.flatnonzero(changed.any(axis=0))
+            box = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+            canvas[changed] = indices[changed]
+            delta = np.where(changed[box], indices[box], self.transparent).astype(np.uint8)
+            gif_frames.append([delta, (int(cols[0]), int(rows[0])), duration])
+        first = self.frame_image(gif_frames[0][0], palette_bytes)
+        header, used_palette_colors = GifImagePlugin.getheader(first, info={'loop': 0})
+        chunks = list(header)
+        for indices, offset, frame_duration in gif_frames:
+            image = self.frame_image(indices, palette_bytes)
+            chunks.extend(GifImagePlugin.getdata(image, offset, duration=frame_duration, disposal=1, transparency=self.transparent))
+        chunks.append(b';')
+        return b''.join(chunks)
+
+    def encode_to_size(self, frames, duration, max_bytes=0, attempts=4):
+        """
+        Encodes the frames, then while the GIF is larger than max_bytes halves the frame rate, down to two
+        frames per second, and reduces the resolution, down to a quarter, until it fits.
+        """
+        data = self.encode(frames, duration)
+        for attempt in range(attempts):
+            if not max_bytes or len(data) <= max_bytes:
+                break
+            ratio = 0.9 * max_bytes / len(data)
+            if ratio < 0.75 and duration * 2 <= 500 and len(frames) > 2:
+                frames = frames[::2]
+                duration *= 2
+                ratio *= 1.5
+            if ratio < 1:
+                scale = max(math.sqrt(ratio), 0.25)
+                width, height = frames[0].size
+                frames = [frame.resize((max(int(width * scale), 16), max(int(height * scale), 16)), Image.BILINEAR) for frame in frames]
+            data = self.encode(frames, duration)
+        return data
+
+@metrics.timed('take_gif_seconds', 'Time to capture and encode a GIF')
+def take_gif(output_file, length, pre_trigger_frames=None, size=(800,600), max_bytes=0, capture=None):
+    """
+    Captures length*3 frames into memory and encodes them as a GIF. Only the final GIF is written to disk.
+    pre_trigger_frames is an optional list of JPEG frames from before the trigger to start the GIF with.
+    If max_bytes is set the frame rate and resolution are reduced until the GIF fits. capture replaces
+    capture_frames, such as with capture_frames_on_demand.
+    """
+    try:
+        frames = [Image.open(io.BytesIO(jpeg)).convert('RGB').resize(size) for jpeg in pre_trigger_frames or []]
+        frames.extend((capture or capture_frames)(length*3, resize=size))
+        data = GifEncoder().encode_to_size(frames, 200, max_bytes)
+        with open(output_file, 'wb') as f:
+            f.write(data)
     except Exception as e:
         logger.error('Failed to create GIF: %s' % e)
         return False
@@ -152,10 +852,413 @@ def take_gif(output_file, length):
         logger.info("Captured gif: %s" % output_file)
         return True
 
+def mux_mp4(h264_file, mp4_file, framerate):
+    """
+    Wraps a raw H.264 stream in an MP4 container without re-encoding, using MP4Box or failing that ffmpeg.
+    """
+    commands = [
+        ['MP4Box', '-quiet', '-fps', str(framerate), '-add', h264_file, '-new', mp4_file],
+        ['ffmpeg', '-loglevel', 'error', '-y', '-framerate', str(framerate), '-i', h264_file, '-c', 'copy', '-movflags', 'faststart', mp4_file]
+    ]
+    for command in commands:
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(command, stdout=devnull)
+            return
+        except OSError:
+            continue
+    raise OSError('MP4Box or ffmpeg is needed to create MP4 files')
+
+@metrics.timed('take_video_seconds', 'Time to record a video and create the MP4')
+def take_video(output_file, length, end_time=None, bitrate=None):
+    """
+    Records length seconds of H.264 from the camera's hardware encoder on splitter port 1 and wraps it
+    in an MP4 container. The CPU only copies the encoded stream. end_time is an optional function
+    returning when to stop, it is checked while recording so the recording can be extended.
+    """
+    h264_file = os.path.splitext(output_file)[0] + '.h264'
+    try:
+        camera.start_recording(h264_file, format='h264', splitter_port=1, bitrate=bitrate or config['camera_video_bitrate'])
+        start = time.time()
+        try:
+            while True:
+                remaining = (end_time() if end_time else start + length) - time.time()
+                if remaining <= 0:
+                    break
+                camera.wait_recording(min(remaining, 0.5), splitter_port=1)
+        finally:
+            camera.stop_recording(splitter_port=1)
+        mux_mp4(h264_file, output_file, float(camera.framerate))
+    except Exception as e:
+        logger.error('Failed to take video: %s' % e)
+        return False
+    finally:
+        if os.path.exists(h264_file):
+            os.remove(h264_file)
+    return True
+
+on_demand_metric = metrics.counter('on_demand_requests_total', 'Photo and GIF requests from the bot', label='result')
+
+class CameraArbiter(object):
+    """
+    Gives the camera to one capture at a time, alarm captures before on-demand ones from the bot, and
+    shares on-demand captures. An alarm capture only waits for a capture already using the camera, while
+    on-demand captures wait until no alarm capture is using or waiting for it. A request() while a capture
+    of the same kind is running shares it, and one within freshness seconds of the last capture of that
+    kind reuses its file, so repeated taps or several people asking at once cause one capture.
+    """
+    def __init__(self, freshness=5, clock=time.time):
+        self.freshness = freshness
+        self.clock = clock
+        self.condition = Condition()
+        self.busy = False
+        self.alarms_waiting = 0
+        self.running = set()
+        self.recent = {}
+
+    @contextmanager
+    def alarm(self):
+        with self.condition:
+            self.alarms_waiting += 1
+            while self.busy:
+                self.condition.wait()
+            self.alarms_waiting -= 1
+            self.busy = True
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def on_demand(self):
+        with self.condition:
+            while self.busy or self.alarms_waiting:
+                self.condition.wait()
+            self.busy = True
+        try:
+            yield
+        finally:
+            self.release()
+
+    def release(self):
+        with self.condition:
+            self.busy = False
+            self.condition.notify_all()
+
+    def request(self, kind, capture, deliver):
+        """
+        Handles an on-demand request in its own thread and returns 'captured', 'shared' or 'cached' at once.
+        capture() returns the path of a new file or None if it failed, and deliver(file_path) sends it.
+        A shared capture is delivered once.
+        """
+        with self.condition:
+            recent = self.recent.get(kind)
+            if kind in self.running:
+                result = 'shared'
+            elif recent and self.clock() - recent[0] <= self.freshness and os.path.exists(recent[1]):
+                result = 'cached'
+            else:
+                result = 'captured'
+                self.running.add(kind)
+        on_demand_metric.inc(result)
+        logger.debug('On-demand %s request %s' % (kind, result))
+        if result == 'shared':
+            return result
+        def run():
+            if result == 'cached':
+                deliver(recent[1])
+                return
+            file_path = None
+            try:
+                file_path = capture()
+            finally:
+                with self.condition:
+                    self.running.discard(kind)
+                    if file_path:
+                        self.recent[kind] = (self.clock(), file_path)
+            if file_path:
+                deliver(file_path)
+        request_thread = Thread(name='on_demand_%s' % kind, target=run)
+        request_thread.daemon = True
+        request_thread.start()
+        return result
+
+def capture_frames_on_demand(count, resize=None):
+    """
+    Captures frames like capture_frames but three at a time, about a second of GIF, releasing the camera
+    in between so an alarm capture never waits for a whole GIF.
+    """
+    frames = []
+    for i in range(0, count, 3):
+        with camera_arbiter.on_demand():
+            frames.extend(capture_frames(min(3, count - i), resize=resize))
+    return frames
+
+def capture_on_demand_photo():
+    file_path = config['camera_save_path'] + "/rpi-security-" + datetime.now().strftime("%Y-%m-%d-%H%M%S") + '.jpeg'
+    with camera_arbiter.on_demand():
+        captured = take_photo(file_path)
+    if captured:
+        outbox.add(file_path, state='delivered')
+        return file_path
+
+def capture_on_demand_gif():
+    file_path = config['camera_save_path'] + "/rpi-security-" + datetime.now().strftime("%Y-%m-%d-%H%M%S") + '.gif'
+    if take_gif(file_path, config['camera_capture_length'], capture=capture_frames_on_demand):
+        outbox.add(file_path, state='delivered')
+        return file_path
+
+# Created by setup_pre_trigger_buffer when camera_pre_trigger_seconds is set
+pre_trigger_buffer = None
+
+class FrameRingBuffer(object):
+    """
+    Keeps the last few seconds of JPEG frames from the camera video port so that alarms can include
+    frames from before the motion was detected. All frame storage is allocated up front so memory use
+    is fixed at slots * max_frame_size bytes and nothing is allocated per frame.
+    Instances are passed to camera.start_recording() as the output object.
+    """
+    def __init__(self, camera, seconds, fps, size, max_frame_size, splitter_port=3, clock=time.time):
+        self.camera = camera
+        self.size = size
+        self.splitter_port = splitter_port
+        self.clock = clock
+        self.interval = 1.0 / fps
+        self.slots = max(1, int(seconds * fps))
+        self.max_frame_size = max_frame_size
+        self.buffers = [bytearray(max_frame_size) for i in range(self.slots)]
+        self.frame_sizes = [0] * self.slots
+        self.timestamps = [0.0] * self.slots
+        self.lock = Lock()
+        self.recording = False
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.head = 0
+            self.count = 0
+        self.next_frame_time = 0
+        self.keeping = False
+        self.offset = 0
+
+    def start(self):
+        if not self.recording:
+            self.clear()
+            self.camera.start_recording(self, format='mjpeg', resize=self.size, splitter_port=self.splitter_port)
+            self.recording = True
+            logger.debug('Pre-trigger buffer started with %s slots of %s bytes' % (self.slots, self.max_frame_size))
+
+    def stop(self):
+        if self.recording:
+            self.camera.stop_recording(splitter_port=self.splitter_port)
+            self.recording = False
+            self.clear()
+            logger.debug('Pre-trigger buffer stopped')
+
+    def write(self, buf):
+        if buf.startswith(b'\xff\xd8'):
+            now = self.clock()
+            self.keeping = now >= self.next_frame_time
+            if self.keeping:
+                self.next_frame_time = now + self.interval
+                self.frame_time = now
+                self.offset = 0
+        if self.keeping:
+            end = self.offset + len(buf)
+            if end > self.max_frame_size:
+                # Frame is too large for a slot, drop it
+                self.keeping = False
+            else:
+                self.buffers[self.head][self.offset:end] = buf
+                self.offset = end
+                if buf.endswith(b'\xff\xd9'):
+                    with self.lock:
+                        self.frame_sizes[self.head] = self.offset
+                        self.timestamps[self.head] = self.frame_time
+                        self.head = (self.head + 1) % self.slots
+                        self.count = min(self.count + 1, self.slots)
+                    self.keeping = False
+        return len(buf)
+
+    def flush(self):
+        pass
+
+    def frames(self, before=None):
+        """
+        Returns copies of the buffered JPEG frames, oldest first, optionally only those captured before a time.
+        """
+        result = []
+        with self.lock:
+            for i in range(self.head - self.count, self.head):
+                slot = i % self.slots
+                if before is None or self.timestamps[slot] <= before:
+                    result.append(bytes(self.buffers[slot][:self.frame_sizes[slot]]))
+        return result
+
+archive_metric = metrics.counter('archive_files_total', 'Files handled by the archive', label='result')
+
+class DirectoryArchive(object):
+    """
+    Archives to a local directory or NFS mount. Files are copied in chunks to a temporary name and then
+    renamed so a partial copy never has the final name.
+    """
+    def __init__(self, path, chunk_size=1024*1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def upload(self, file_path, key):
+        destination = os.path.join(self.path, key)
+        temp_path = destination + '.part'
+        with open(file_path, 'rb') as source:
+            with open(temp_path, 'wb') as target:
+                shutil.copyfileobj(source, target, self.chunk_size)
+                target.flush()
+                os.fsync(target.fileno())
+        os.rename(temp_path, destination)
+
+    def flush(self):
+        """
+        Makes the renames in a batch durable with one fsync of the directory.
+        """
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class S3Archive(object):
+    """
+    Archives to Amazon S3 or an S3 compatible service such as MinIO. boto3 reads the credentials from the
+    usual AWS environment variables or files. Files larger than chunk_size are streamed as multipart uploads.
+    """
+    def __init__(self, bucket, prefix='', endpoint=None, chunk_size=8*1024*1024):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client('s3', endpoint_url=endpoint or None)
+        self.transfer_config = TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size)
+
+    def upload(self, file_path, key):
+        self.client.upload_file(file_path, self.bucket, self.prefix + key, Config=self.transfer_config)
+
+    def flush(self):
+        pass
+
+class Archiver(object):
+    """
+    Archives sent files to a backend in a background thread so archiving never delays an alert. Files are
+    taken from the queue in batches and hashed as they are read, a file with the same content as one already
+    archived is skipped. The hashes are kept in the archive table of db_file, updated once per batch.
+    Files are archived under the start of their hash and their name, so files with the same name captured on
+    different days or by different nodes never overwrite each other. done() is called with each file once
+    the archiver has finished with it.
+    """
+    def __init__(self, backend, db_file, batch_size=20, batch_interval=5, max_size=1000, chunk_size=1024*1024, done=None):
+        self.backend = backend
+        self.done = done or (lambda file_path: None)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.chunk_size = chunk_size
+        self.queue = Queue.Queue(max_size)
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS archive (hash TEXT PRIMARY KEY, key TEXT, size INTEGER, archived REAL)')
+        self.db.commit()
+
+    def put(self, file_path):
+        """
+        Queues a file without blocking. If the archive has fallen far behind the file is not archived.
+        """
+        try:
+            self.queue.put_nowait(file_path)
+        except Queue.Full:
+            archive_metric.inc('dropped')
+            logger.warning('Archive queue is full, not archiving: %s' % file_path)
+            self.done(file_path)
+
+    def get_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.batch_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return batch
+
+    def file_hash(self, file_path):
+        digest = hashlib.sha256()
+        size = 0
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size
+
+    def archive(self, batch):
+        try:
+            return self.archive_batch(batch)
+        finally:
+            for file_path in batch:
+                self.done(file_path)
+
+    def archive_batch(self, batch):
+        archived = []
+        hashes = set()
+        for file_path in batch:
+            try:
+                content_hash, size = self.file_hash(file_path)
+            except (IOError, OSError) as e:
+                archive_metric.inc('failed')
+                logger.warning('Failed to read %s for archiving: %s' % (file_path, e))
+                continue
+            if content_hash in hashes or self.db.execute('SELECT 1 FROM archive WHERE hash = ?', (content_hash,)).fetchone():
+                archive_metric.inc('duplicate')
+                logger.debug('Skipped archiving duplicate file: %s' % file_path)
+                continue
+            key = '%s-%s' % (content_hash[:16], os.path.basename(file_path))
+            try:
+                self.backend.upload(file_path, key)
+            except Exception as e:
+                archive_metric.inc('failed')
+                logger.error('Failed to archive %s: %s' % (file_path, e))
+                continue
+            hashes.add(content_hash)
+            archived.append((content_hash, key, size, time.time()))
+            archive_metric.inc('archived')
+        if archived:
+            self.backend.flush()
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO archive (hash, key, size, archived) VALUES (?, ?, ?, ?)', archived)
+            logger.debug('Archived %s of %s files' % (len(archived), len(batch)))
+        return archived
+
+    def run(self):
+        logger.info("thread running")
+        while True:
+            self.archive(self.get_batch())
+
+def create_archive_backend():
+    if config['archive_backend'] == 'directory':
+        return DirectoryArchive(config['archive_path'], chunk_size=config['archive_chunk_mb'] * 1024 * 1024)
+    elif config['archive_backend'] == 's3':
+        return S3Archive(
+            bucket=config['archive_s3_bucket'],
+            prefix=config['archive_s3_prefix'],
+            endpoint=config['archive_s3_endpoint'],
+            chunk_size=config['archive_chunk_mb'] * 1024 * 1024
+        )
+    raise ValueError('Unknown archive_backend: %s' % config['archive_backend'])
+
 def archive_photo(photo_path):
-    #command = 'cp %(source) %(destination)' % {"source": "/var/tmp/blah", "destination": "s3/blah/blah"}
-    logger.debug('Archiving of photo complete: %s' % photo_path)
-    pass
+    if archiver:
+        archiver.put(photo_path)
 
 def telegram_send_message(message):
     if 'telegram_chat_id' not in state:
@@ -169,11 +1272,13 @@ def telegram_send_message(message):
         logger.info('Telegram message Sent: "%s"' % message)
         return True
 
+@metrics.timed('telegram_send_file_seconds', 'Time to send a file via Telegram')
 def telegram_send_file(file_path):
     if 'telegram_chat_id' not in state:
         logger.error('Telegram failed to send file %s because Telegram chat_id is not set. Send a message to the Telegram bot' % file_path)
         return False
     filename, file_extension = os.path.splitext(file_path)
+    start = time.time()
     try:
         if file_extension == '.mp4':
             bot.sendVideo(chat_id=state['telegram_chat_id'], video=open(file_path, 'rb'), timeout=30)
@@ -185,89 +1290,822 @@ def telegram_send_file(file_path):
             logger.error('Uknown file not sent: %s' % file_path)
     except Exception as e:
         logger.error('Telegram failed to send file %s with exception: %s' % (file_path, e))
+        send_failures_metric.inc()
         return False
     else:
         logger.info('Telegram file sent: %s' % file_path)
+        if upload_throughput:
+            upload_throughput.observe(os.path.getsize(file_path), time.time() - start)
+        return True
+
+@metrics.timed('telegram_send_album_seconds', 'Time to send an album of photos via Telegram')
+def telegram_send_album(file_paths):
+    """
+    Sends several photos as one album message with sendMediaGroup.
+    """
+    if 'telegram_chat_id' not in state:
+        logger.error('Telegram failed to send album because Telegram chat_id is not set. Send a message to the Telegram bot')
+        return False
+    start = time.time()
+    files = [open(file_path, 'rb') for file_path in file_paths]
+    try:
+        bot.sendMediaGroup(chat_id=state['telegram_chat_id'], media=[InputMediaPhoto(media=f) for f in files], timeout=30)
+    except Exception as e:
+        logger.error('Telegram failed to send album of %s photos with exception: %s' % (len(file_paths), e))
+        send_failures_metric.inc()
+        return False
+    else:
+        logger.info('Telegram album sent: %s' % ', '.join(file_paths))
+        if upload_throughput:
+            upload_throughput.observe(sum([os.path.getsize(file_path) for file_path in file_paths]), time.time() - start)
         return True
+    finally:
+        for f in files:
+            f.close()
+
+class UploadThroughput(object):
+    """
+    Measures upload throughput from recent sends and picks how much to scale down the next capture so
+    its full media can be uploaded within target_seconds. The size of each kind of capture is remembered
+    as its size at full scale. Scale is the fraction of the full resolution for photos and GIFs, for
+    video the bitrate is multiplied by its square so the size changes by the same amount.
+    """
+    scales = [1.0, 0.75, 0.5, 0.35, 0.25]
+
+    def __init__(self, target_seconds=10, smoothing=0.3, min_bytes=20000):
+        self.target_seconds = target_seconds
+        self.smoothing = smoothing
+        # Small files mostly measure latency rather than throughput
+        self.min_bytes = min_bytes
+        self.rate = None
+        self.full_sizes = {}
+        self.lock = Lock()
+
+    def observe(self, size, seconds):
+        if size < self.min_bytes or seconds <= 0:
+            return
+        with self.lock:
+            rate = size / seconds
+            self.rate = rate if self.rate is None else self.rate + self.smoothing * (rate - self.rate)
+
+    def record(self, kind, size, scale):
+        with self.lock:
+            full_size = size / scale ** 2
+            previous = self.full_sizes.get(kind)
+            self.full_sizes[kind] = full_size if previous is None else previous + self.smoothing * (full_size - previous)
+
+    def scale(self, kind):
+        """
+        Returns the largest scale expected to upload within target_seconds.
+        """
+        with self.lock:
+            if not self.target_seconds or self.rate is None or kind not in self.full_sizes:
+                return 1.0
+            budget = self.rate * self.target_seconds
+            for scale in self.scales:
+                if self.full_sizes[kind] * scale ** 2 <= budget:
+                    return scale
+            return self.scales[-1]
 
-def arp_ping_macs(mac_addresses, repeat=1):
+# Created by setup_services, sends are not measured until then
+upload_throughput = None
+
+# Last known IP address of each MAC address that has answered an ARP ping
+arp_ip_cache = {}
+# process_photos checks each motion event in its own thread alongside the presence monitor's probes
+arp_ip_cache_lock = Lock()
+
+@metrics.timed('arp_ping_seconds', 'Time spent ARP pinging MAC addresses')
+def arp_ping_macs(mac_addresses, repeat=1, repeat_interval=2, unicast_timeout=0.3):
     """
-    Performs an ARP scan of a destination MAC address to try and determine if they are present on the network.
+    Performs an ARP scan directed at the MAC addresses to try and determine if they are present on the network.
+    MAC addresses with a known IP address are first probed together with unicast packets and a short timeout.
+    If none answer, all remaining MAC addresses are probed across the whole network in a single send and receive
+    window. No further rounds are sent once any device answers and answers are recorded as detected packets.
+    Each srp call still waits for its full timeout when some addresses do not answer, as srp has no way to stop
+    a send and receive window early.
+    Returns a dict of the MAC addresses that answered and their IP addresses.
     """
-    def _arp_ping(mac_address, ip_address):
-        result = False
-        answered,unanswered = srp(Ether(dst=mac_address)/ARP(pdst=ip_address), timeout=1, verbose=False)
-        if len(answered) > 0:
-            for reply in answered:
-                if reply[1].hwsrc == mac_address:
-                    if type(result) is not list:
-                        result = []
-                    result.append(str(reply[1].psrc))
-                    result = ', '.join(result)
+    def _arp_ping(targets, timeout):
+        result = {}
+        start = time.time()
+        answered, unanswered = srp([Ether(dst=mac_address)/ARP(pdst=ip_address) for mac_address, ip_address in targets], timeout=timeout, verbose=False)
+        for sent, reply in answered:
+            mac_address = reply.hwsrc.lower()
+            if mac_address in mac_addresses:
+                result[mac_address] = str(reply.psrc)
+        logger.debug('ARP ping of %s MAC addresses took %.2f seconds' % (len(targets), time.time() - start))
+        for mac_address, ip_address in targets:
+            if mac_address in result:
+                logger.debug('MAC %s responded to ARP ping with address %s' % (mac_address, result[mac_address]))
+                with arp_ip_cache_lock:
+                    arp_ip_cache[mac_address] = result[mac_address]
+                packet_detected(mac_address)
+            else:
+                logger.debug('MAC %s did not respond to ARP ping' % mac_address)
         return result
+    result = {}
     while repeat > 0:
         if time.time() - alarm_state['last_packet'] < 30:
             break
-        for mac_address in mac_addresses:
-            result = _arp_ping(mac_address, config['network_address'])
-            if result:
-                logger.debug('MAC %s responded to ARP ping with address %s' % (mac_address, result))
+        with arp_ip_cache_lock:
+            cached = [(mac_address, arp_ip_cache[mac_address]) for mac_address in mac_addresses if mac_address in arp_ip_cache]
+        if cached:
+            result = _arp_ping(cached, unicast_timeout)
+        if not result:
+            result = _arp_ping([(mac_address, config['network_address']) for mac_address in mac_addresses], 1)
+            # Addresses may have changed, only keep those that answered the network wide scan
+            with arp_ip_cache_lock:
+                for mac_address in mac_addresses:
+                    if mac_address not in result:
+                        arp_ip_cache.pop(mac_address, None)
+        if result:
+            break
+        repeat -= 1
+        if repeat > 0:
+            time.sleep(repeat_interval)
+    return result
+
+class UploadQueue(object):
+    """
+    A thread safe queue of captured files waiting to be sent.
+    Files are handed to a small pool of worker threads. Files in the same group, e.g. the photos from one
+    motion event, always go to the same worker so they are delivered in order, while different groups
+    are sent in parallel. Failed sends are retried with exponential backoff. When max_size files are
+    queued, put() blocks to apply backpressure to the capture. If send_album is given, files from the
+    same group that are waiting together and pass album_filter are sent with one send_album call. Files
+    passed to dispatch_many() reach the worker together, so they are always sent as one album.
+    """
+    def __init__(self, send, failed=None, workers=2, max_size=100, retries=5, retry_delay=1, max_retry_delay=60, put_timeout=30, send_album=None, album_filter=None, album_size=10):
+        self.send = send
+        self.failed = failed
+        self.send_album = send_album
+        self.album_filter = album_filter or (lambda file_path: True)
+        self.album_size = album_size
+        self.workers = workers
+        self.max_size = max_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.put_timeout = put_timeout
+        self.incoming = Queue.Queue()
+        self.worker_queues = [Queue.Queue() for i in range(workers)]
+        self.group_workers = OrderedDict()
+        self.condition = Condition()
+        self.pending = 0
+
+    def start(self):
+        for i in range(self.workers):
+            worker_thread = Thread(name='upload_worker_%s' % i, target=self.worker, args=(i,))
+            worker_thread.daemon = True
+            worker_thread.start()
+
+    def put(self, file_path, group=None):
+        """
+        Adds a file to the queue, blocking while the queue is full. Returns False if the file was dropped.
+        """
+        deadline = time.time() + self.put_timeout
+        with self.condition:
+            while self.pending >= self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.error('Upload queue full, dropping file: %s' % file_path)
+                    return False
+                self.condition.wait(remaining)
+            self.pending += 1
+        self.incoming.put((file_path, group))
+        return True
+
+    def get(self, timeout=None):
+        """
+        Blocks until a file is queued and returns (file_path, group), or None on timeout.
+        """
+        try:
+            return self.incoming.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def dispatch(self, file_path, group=None):
+        """
+        Passes a file from the queue to a worker. New groups go to the worker with the least queued.
+        """
+        self.dispatch_many([file_path], group)
+
+    def dispatch_many(self, file_paths, group=None):
+        """
+        Passes several files from the queue in the same group to a worker as one unit.
+        """
+        if group in self.group_workers:
+            index = self.group_workers[group]
+        else:
+            index = min(range(self.workers), key=lambda i: self.worker_queues[i].qsize())
+            self.group_workers[group] = index
+            if len(self.group_workers) > self.max_size:
+                self.group_workers.popitem(last=False)
+        self.worker_queues[index].put((file_paths, group))
+
+    def done(self):
+        with self.condition:
+            self.pending -= 1
+            self.condition.notify()
+
+    def depth(self):
+        return self.pending
+
+    def album(self, index, file_path, group, ready):
+        """
+        Takes files that can be sent in the same album as file_path, first from ready, the (file_path, group)
+        items left from units already taken from the worker's queue, and then from the queue. Returns the files.
+        """
+        file_paths = [file_path]
+        if not self.send_album or not self.album_filter(file_path):
+            return file_paths
+        while len(file_paths) < self.album_size:
+            if not ready:
+                try:
+                    unit, unit_group = self.worker_queues[index].get_nowait()
+                except Queue.Empty:
+                    break
+                ready.extend([(unit_file, unit_group) for unit_file in unit])
+            next_file, next_group = ready[0]
+            if next_group != group or not self.album_filter(next_file):
                 break
+            file_paths.append(ready.popleft()[0])
+        return file_paths
+
+    def worker(self, index):
+        logger.info("thread running")
+        ready = deque()
+        while True:
+            if not ready:
+                unit, group = self.worker_queues[index].get()
+                ready.extend([(unit_file, group) for unit_file in unit])
+            file_path, group = ready.popleft()
+            file_paths = self.album(index, file_path, group, ready)
+            if len(file_paths) > 1:
+                send = lambda: self.send_album(file_paths)
             else:
-                logger.debug('MAC %s did not respond to ARP ping' % mac_address)
-        if repeat > 1:
-            time.sleep(2)
-        repeat -= 1
+                send = lambda: self.send(file_path)
+            attempt = 0
+            while not send():
+                if attempt >= self.retries:
+                    logger.error('Giving up sending file after %s retries: %s' % (attempt, ', '.join(file_paths)))
+                    if self.failed:
+                        for failed_file in file_paths:
+                            self.failed(failed_file)
+                    break
+                delay = min(self.retry_delay * 2 ** attempt, self.max_retry_delay)
+                attempt += 1
+                logger.debug('Retrying file %s in %s seconds' % (', '.join(file_paths), delay))
+                time.sleep(delay)
+            for sent_file in file_paths:
+                self.done()
+
+class Outbox(object):
+    """
+    A durable record of captured files and their delivery state, stored in SQLite, so that files still
+    waiting to be sent survive a crash or restart. Writes are made by a single thread which commits them in
+    batches, so the SD card sees one fsync per batch rather than one per file.
+    """
+    def __init__(self, db_file, batch_size=500, flush_interval=0.5, retry_interval=300):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.writes = Queue.Queue()
+        self.queued = set()
+        self.resumed = set()
+        self.lock = Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, file_path TEXT UNIQUE, file_group TEXT, created REAL, state TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, id)')
+        if 'size' not in [column[1] for column in self.db.execute('PRAGMA table_info(outbox)')]:
+            self.db.execute('ALTER TABLE outbox ADD COLUMN size INTEGER DEFAULT 0')
+        self.db.commit()
+        self.retention = None
+        # Only used by the resume thread, WAL mode allows it to read while the writer commits
+        self.reader = sqlite3.connect(db_file, check_same_thread=False)
+
+    def start(self, put):
+        """
+        Starts the writer thread and a thread that queues undelivered files with put(), now and every retry_interval.
+        """
+        writer_thread = Thread(name='outbox_writer', target=self.writer)
+        writer_thread.daemon = True
+        writer_thread.start()
+        resume_thread = Thread(name='outbox_resume', target=self.resume, args=(put,))
+        resume_thread.daemon = True
+        resume_thread.start()
+
+    def add(self, file_path, group=None, state='pending'):
+        """
+        Records a captured file. Files added with state 'delivered' are only recorded for retention.
+        """
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = 0
+        if state == 'pending':
+            with self.lock:
+                self.queued.add(file_path)
+        self.writes.put(('INSERT OR REPLACE INTO outbox (file_path, file_group, created, state, size) VALUES (?, ?, ?, ?, ?)', (file_path, group, time.time(), state, size)))
+        if self.retention:
+            self.retention.add(file_path, size, delivered=state != 'pending')
+
+    def mark(self, file_path, state):
+        """
+        Records a file as 'delivered' or 'discarded'. Discarded files are deleted straight away.
+        """
+        with self.lock:
+            self.queued.discard(file_path)
+            self.resumed.discard(file_path)
+        self.writes.put(('UPDATE outbox SET state = ? WHERE file_path = ?', (state, file_path)))
+        if self.retention:
+            if state == 'discarded':
+                self.retention.remove(file_path)
+            else:
+                self.retention.delivered(file_path)
+
+    def forget(self, file_path):
+        self.writes.put(('DELETE FROM outbox WHERE file_path = ?', (file_path,)))
+
+    def prune(self):
+        """
+        Removes the entries of every file that is no longer waiting to be sent.
+        """
+        self.writes.put(("DELETE FROM outbox WHERE state != 'pending'", ()))
+
+    def sync(self, timeout=10):
+        """
+        Waits until every write made before it has been committed. Returns False if the commit failed or
+        did not happen within timeout seconds.
+        """
+        committed = Event()
+        result = []
+        self.writes.put((None, (committed, result)))
+        committed.wait(timeout)
+        return bool(result)
+
+    def release(self, file_path):
+        """
+        Records that a file is no longer queued but still undelivered so it is picked up on the next retry.
+        """
+        with self.lock:
+            self.queued.discard(file_path)
+            self.resumed.discard(file_path)
+
+    def writer(self):
+        logger.info("thread running")
+        while True:
+            batch = [self.writes.get()]
+            deadline = time.time() + self.flush_interval
+            # Commit straight away when someone is waiting in sync()
+            while len(batch) < self.batch_size and batch[-1][0] is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.writes.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+            synced = [values for statement, values in batch if statement is None]
+            try:
+                with self.db:
+                    for statement, values in batch:
+                        if statement is not None:
+                            self.db.execute(statement, values)
+            except Exception as e:
+                logger.error('Failed to write %s outbox entries: %s' % (len(batch) - len(synced), e))
+            else:
+                for committed, result in synced:
+                    result.append(True)
+            for committed, result in synced:
+                committed.set()
+
+    def catalogue(self):
+        return self.reader.execute('SELECT file_path, created, size, state FROM outbox ORDER BY created').fetchall()
+
+    def undelivered(self, after_id=0, limit=100):
+        """
+        Returns up to limit (id, file_path, file_group) rows of undelivered files with an id after after_id.
+        """
+        return self.reader.execute("SELECT id, file_path, file_group FROM outbox WHERE state = 'pending' AND id > ? ORDER BY id LIMIT ?", (after_id, limit)).fetchall()
+
+    def resume_pass(self, put):
+        """
+        Queues undelivered files that are not already queued, a page at a time. Stops when put() fails because
+        the upload queue stayed full, the rest are queued on the next pass. Returns the number queued.
+        """
+        count = 0
+        last_id = 0
+        while True:
+            rows = self.undelivered(after_id=last_id)
+            if not rows:
+                return count
+            for row_id, file_path, group in rows:
+                last_id = row_id
+                with self.lock:
+                    if file_path in self.queued:
+                        continue
+                if not os.path.exists(file_path):
+                    self.mark(file_path, 'discarded')
+                    continue
+                with self.lock:
+                    self.queued.add(file_path)
+                    self.resumed.add(file_path)
+                if not put(file_path, group):
+                    self.release(file_path)
+                    return count
+                count += 1
+
+    def resume(self, put):
+        logger.info("thread running")
+        while True:
+            count = self.resume_pass(put)
+            if count > 0:
+                logger.info('Queued %s undelivered files from the outbox' % count)
+            if self.retention:
+                self.retention.enforce()
+            time.sleep(self.retry_interval)
+
+class MediaRetention(object):
+    """
+    Keeps captured media within a disk budget and maximum age by deleting the oldest sent files first.
+    The outbox is the catalogue of captured media, it is read once at startup and then kept in memory so
+    the directory is never rescanned. Files waiting to be sent count towards the budget but are never deleted.
+    Each eviction is O(1) so enforcing the budget costs O(evicted) however many files are kept.
+    Without a budget or maximum age sent files are kept forever, so they are dropped from the outbox once sent.
+    """
+    def __init__(self, outbox, max_bytes=0, max_age=0):
+        self.outbox = outbox
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.limited = bool(max_bytes or max_age)
+        # Set when an Archiver calls archived() for every sent file, which is kept until then
+        self.archiving = False
+        self.lock = Lock()
+        # file_path: (timestamp, size), oldest first
+        self.evictable = OrderedDict()
+        self.pending = {}
+        self.unarchived = {}
+        self.total_bytes = 0
+        for file_path, created, size, state in outbox.catalogue():
+            size = size or 0
+            if state == 'pending':
+                self.pending[file_path] = size
+            elif self.limited:
+                self.evictable[file_path] = (created, size)
+            else:
+                continue
+            self.total_bytes += size
+        if not self.limited:
+            outbox.prune()
+        logger.debug('Media catalogue has %s files using %s bytes' % (len(self.pending) + len(self.evictable), self.total_bytes))
+
+    def add(self, file_path, size, delivered=False):
+        if delivered and not self.limited:
+            self.outbox.forget(file_path)
+            return
+        with self.lock:
+            self.total_bytes += size
+            if delivered:
+                self.evictable[file_path] = (time.time(), size)
+            else:
+                self.pending[file_path] = size
+        self.enforce()
+
+    def delivered(self, file_path):
+        with self.lock:
+            if file_path not in self.pending:
+                return
+            size = self.pending.pop(file_path)
+            if self.limited:
+                if self.archiving:
+                    self.unarchived[file_path] = size
+                else:
+                    self.evictable[file_path] = (time.time(), size)
+                return
+            self.total_bytes -= size
+        self.outbox.forget(file_path)
+
+    def archived(self, file_path):
+        """
+        Lets a sent file be deleted now that the archiver has finished with it.
+        """
+        with self.lock:
+            if file_path in self.unarchived:
+                self.evictable[file_path] = (time.time(), self.unarchived.pop(file_path))
+
+    def remove(self, file_path):
+        """
+        Deletes a file straight away, e.g. a false positive.
+        """
+        with self.lock:
+            if file_path in self.pending:
+                size = self.pending.pop(file_path)
+            elif file_path in self.unarchived:
+                size = self.unarchived.pop(file_path)
+            elif file_path in self.evictable:
+                size = self.evictable.pop(file_path)[1]
+            else:
+                size = 0
+            self.total_bytes -= size
+        self.delete(file_path)
+
+    def enforce(self):
+        """
+        Deletes the oldest sent files while over the disk budget or older than the maximum age.
+        """
+        evicted = []
+        now = time.time()
+        with self.lock:
+            while self.evictable:
+                file_path, (timestamp, size) = next(iter(self.evictable.items()))
+                over_budget = self.max_bytes and self.total_bytes > self.max_bytes
+                too_old = self.max_age and now - timestamp > self.max_age
+                if not (over_budget or too_old):
+                    break
+                self.evictable.popitem(last=False)
+                self.total_bytes -= size
+                evicted.append(file_path)
+        for file_path in evicted:
+            self.delete(file_path)
+        if evicted:
+            logger.info('Deleted %s old captured files, %s bytes now used' % (len(evicted), self.total_bytes))
+
+    def delete(self, file_path):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+        else:
+            logger.debug('Deleted captured file: %s' % file_path)
+        self.outbox.forget(file_path)
+
+def queue_captured_file(file_path, group=None, sync=False):
+    """
+    Records a captured file in the outbox and queues it to be sent. On the leader, previews after the
+    first in an incident are skipped. With sync the file is only queued once the outbox entry has been
+    committed. Returns False if the outbox entry could not be committed or the upload queue stayed full.
+    """
+    if config['coordinator_role'] == 'leader' and not coordinator.accept(file_path, group):
+        return True
+    outbox.add(file_path, group)
+    if sync and not outbox.sync():
+        outbox.release(file_path)
+        return False
+    if not upload_queue.put(file_path, group):
+        # Still pending in the outbox, so it is queued again by the next resume pass
+        outbox.release(file_path)
+        return False
+    return True
+
+def discard_false_positive(file_path):
+    """
+    Discards a file if the alarm is no longer armed. Files resumed from the outbox after a restart are
+    always sent as the state they were captured in is unknown.
+    """
+    if alarm_state['current_state'] != 'armed' and file_path not in outbox.resumed:
+        logger.info('Removing photo as it is a false positive: %s' % file_path)
+        outbox.mark(file_path, 'discarded')
+        return True
+    return False
+
+def set_alarm_triggered(triggered):
+    """
+    Records whether the alarm has been triggered since it was last disarmed. Only changes are written.
+    """
+    if alarm_state['alarm_triggered'] != triggered:
+        alarm_state['alarm_triggered'] = triggered
+        state_store.set('alarm_triggered', triggered)
+
+def send_captured_file(file_path):
+    """
+    Sends a captured file if the alarm is still armed, otherwise it is discarded as a false positive.
+    Returns False if sending failed and should be retried.
+    """
+    if discard_false_positive(file_path):
+        return True
+    logger.debug('Processing the photo: %s' % file_path)
+    set_alarm_triggered(True)
+    if telegram_send_file(file_path):
+        outbox.mark(file_path, 'delivered')
+        archive_photo(file_path)
+        return True
+    return False
+
+def send_captured_album(file_paths):
+    """
+    Sends several captured photos from the same motion event as one album, like send_captured_file.
+    """
+    file_paths = [file_path for file_path in file_paths if not discard_false_positive(file_path)]
+    if len(file_paths) < 2:
+        return all([send_captured_file(file_path) for file_path in file_paths])
+    logger.debug('Processing %s photos as an album' % len(file_paths))
+    set_alarm_triggered(True)
+    if telegram_send_album(file_paths):
+        for file_path in file_paths:
+            outbox.mark(file_path, 'delivered')
+            archive_photo(file_path)
+        return True
+    return False
+
+def forward_captured_file(file_path):
+    """
+    Sends a captured file from a node to the leader, which checks for false positives and sends it on.
+    Returns False if it should be retried.
+    """
+    if coordinator.send_file(file_path):
+        outbox.mark(file_path, 'delivered')
+        archive_photo(file_path)
+        return True
+    return False
+
+def album_photo(file_path):
+    """
+    Returns True for captured photos that can be sent in an album. Previews are always sent on their own.
+    """
+    return file_path.endswith('.jpeg') and not file_path.endswith('-preview.jpeg')
 
 def process_photos():
     """
-    Monitors the captured_from_camera list for newly captured photos.
-    When a new photos are present it will run arp_ping_macs to remove false positives and then send the photos via Telegram.
-    After successfully sendind the photo it will also archive the photo and remove it from the list.
+    Waits on the upload queue for newly captured photos.
+    When photos from a new motion event arrive it runs arp_ping_macs in a separate thread to remove false
+    positives. The preview is passed to the upload workers straight away, the rest of the event's files are
+    held until the check finishes and then passed on together to be sent via Telegram, photos as one album,
+    and archived.
     """
     logger.info("thread running")
+    upload_queue.start()
+    outbox.start(put=upload_queue.put)
+    lock = Lock()
+    # group: files waiting for the group's ARP check
+    checking = {}
+    def check_group(group):
+        try:
+            arp_ping_macs(mac_addresses=config['mac_addresses'], repeat=3)
+        finally:
+            with lock:
+                held = checking.pop(group)
+                if held:
+                    # Sent as one album rather than depending on when the worker wakes
+                    upload_queue.dispatch_many(held, group)
+    last_group = None
     while True:
-        if len(captured_from_camera) > 0:
-            if alarm_state['current_state'] == 'armed':
-                arp_ping_macs(mac_addresses=config['mac_addresses'], repeat=3)
-                for photo in list(captured_from_camera):
-                    if alarm_state['current_state'] != 'armed':
-                        break
-                    logger.debug('Processing the photo: %s' % photo)
-                    alarm_state['alarm_triggered'] = True
-                    if telegram_send_file(photo):
-                        archive_photo(photo)
-                        captured_from_camera.remove(photo)
+        photo, group = upload_queue.get()
+        with lock:
+            # Nodes leave checking for false positives to the leader
+            if group != last_group and group not in checking and alarm_state['current_state'] == 'armed' and config['coordinator_role'] != 'node':
+                checking[group] = []
+                check_thread = Thread(name='arp_check', target=check_group, args=(group,))
+                check_thread.daemon = True
+                check_thread.start()
+            last_group = group
+            if group in checking and not photo.endswith('-preview.jpeg'):
+                checking[group].append(photo)
             else:
-                logger.debug('Stopping photo processing as state is now %s' % alarm_state['current_state'])
-                for photo in list(captured_from_camera):
-                    logger.info('Removing photo as it is a false positive: %s' % photo)
-                    captured_from_camera.remove(photo)
-                    # Delete the photo file
-        time.sleep(5)
+                upload_queue.dispatch(photo, group)
+
+def calculate_filter(mac_addresses, network_interface_mac):
+    """
+    Returns the BPF filter for probe requests from the MAC addresses and packets from them to this host.
+    """
+    mac_string = ' or '.join(mac_addresses)
+    return '((wlan addr2 (%(mac_string)s) or wlan addr3 (%(mac_string)s)) and type mgt subtype probe-req) or (wlan addr1 %(network_interface_mac)s and wlan addr3 (%(mac_string)s))' % { 'mac_string' : mac_string, 'network_interface_mac' : network_interface_mac }
+
+class PacketTracker(object):
+    """
+    Matches captured packets against the monitored MAC addresses using set lookups.
+    To stay cheap at high packet rates, detected() is called at most once per update_interval for each MAC
+    and packet counts are logged as a summary every log_interval instead of once per packet.
+    """
+    def __init__(self, mac_addresses, detected, update_interval=1, log_interval=60, clock=time.time):
+        self.mac_addresses = frozenset(mac_addresses)
+        self.raw_mac_addresses = dict((binascii.unhexlify(mac_address.replace(':', '')), mac_address) for mac_address in mac_addresses)
+        self.detected = detected
+        self.update_interval = update_interval
+        self.log_interval = log_interval
+        self.clock = clock
+        self.counts = dict((mac_address, 0) for mac_address in mac_addresses)
+        self.last_update = dict((mac_address, 0) for mac_address in mac_addresses)
+        self.next_log = clock() + log_interval
+
+    def scapy_packet(self, packet):
+        """
+        Callback for scapy sniff.
+        """
+        addr2 = getattr(packet, 'addr2', None)
+        addr3 = getattr(packet, 'addr3', None)
+        if addr2 in self.mac_addresses:
+            self.seen(addr2)
+        elif addr3 in self.mac_addresses:
+            self.seen(addr3)
+
+    def raw_frame(self, frame):
+        """
+        Callback for raw_sniff, frame is a radiotap header followed by the 802.11 frame.
+        Frames too short to hold the header and the first three addresses are ignored.
+        """
+        if len(frame) < 4:
+            return
+        offset = struct.unpack_from('<H', frame, 2)[0]
+        if len(frame) < offset + 22:
+            return
+        mac_address = self.raw_mac_addresses.get(frame[offset + 10:offset + 16]) or self.raw_mac_addresses.get(frame[offset + 16:offset + 22])
+        if mac_address:
+            self.seen(mac_address)
+
+    def seen(self, mac_address):
+        now = self.clock()
+        self.counts[mac_address] += 1
+        packets_metric.inc(mac_address)
+        if now - self.last_update[mac_address] >= self.update_interval:
+            self.last_update[mac_address] = now
+            self.detected(mac_address)
+        if now >= self.next_log:
+            self.next_log = now + self.log_interval
+            logger.debug('Packets detected: %s' % ', '.join(['%s: %s' % (mac, count) for mac, count in sorted(self.counts.items()) if count > 0]))
+            for mac in self.counts:
+                self.counts[mac] = 0
+
+def compile_bpf_filter(network_interface, bpf_filter):
+    """
+    Compiles a BPF filter with tcpdump into a struct sock_fprog for SO_ATTACH_FILTER.
+    Returns the struct and the instruction buffer, which must be kept alive while the filter is attached.
+    """
+    output = subprocess.check_output(['tcpdump', '-i', network_interface, '-ddd', bpf_filter])
+    lines = output.strip().splitlines()
+    instructions = [struct.pack('HBBI', *[int(x) for x in line.split()]) for line in lines[1:int(lines[0]) + 1]]
+    program = ctypes.create_string_buffer(b''.join(instructions))
+    return struct.pack('HP', len(instructions), ctypes.addressof(program)), program
+
+def raw_sniff(network_interface, bpf_filter, callback):
+    """
+    A lighter alternative to scapy sniff. Reads frames from a raw socket with the BPF filter attached in the
+    kernel and passes the undissected frame to callback. A frame the callback fails on is logged and skipped.
+    """
+    SO_ATTACH_FILTER = 26
+    ETH_P_ALL = 3
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    try:
+        fprog, program = compile_bpf_filter(network_interface, bpf_filter)
+        sock.bind((network_interface, ETH_P_ALL))
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+        # Drop frames from any interface that arrived before the filter was attached
+        sock.setblocking(False)
+        try:
+            while True:
+                sock.recv(65535)
+        except socket.error:
+            pass
+        sock.setblocking(True)
+        while True:
+            frame = sock.recv(65535)
+            try:
+                callback(frame)
+            except Exception as e:
+                logger.debug('Skipped a frame of %s bytes that could not be parsed: %s' % (len(frame), e))
+    finally:
+        sock.close()
 
 def capture_packets(network_interface, network_interface_mac, mac_addresses):
     """
-    This function uses scapy to sniff packets for our MAC addresses and updates a counter when packets are detected.
+    This function sniffs packets for our MAC addresses and updates a counter when packets are detected.
+    It uses scapy, or a raw socket when packet_capture is set to raw.
     """
     logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
     from scapy.all import sniff
-    def update_time(packet):
-        for mac_address in mac_addresses:
-            if mac_address in packet[0].addr2 or mac_address in packet[0].addr3:
-                alarm_state['last_packet_mac'] = mac_address
-                break
-        alarm_state['last_packet'] = time.time()
-        logger.debug('Packet detected from %s' % str(alarm_state['last_packet_mac']))
-    def calculate_filter(mac_addresses):
-        mac_string = ' or '.join(mac_addresses)
-        return '((wlan addr2 (%(mac_string)s) or wlan addr3 (%(mac_string)s)) and type mgt subtype probe-req) or (wlan addr1 %(network_interface_mac)s and wlan addr3 (%(mac_string)s))' % { 'mac_string' : mac_string, 'network_interface_mac' : network_interface_mac }
+    tracker = PacketTracker(mac_addresses, packet_detected)
+    bpf_filter = calculate_filter(mac_addresses, network_interface_mac)
     while True:
         logger.info("thread running")
         try:
-            sniff(iface=network_interface, store=0, prn=update_time, filter=calculate_filter(mac_addresses))
+            if config['packet_capture'] == 'raw':
+                raw_sniff(network_interface, bpf_filter, tracker.raw_frame)
+            else:
+                sniff(iface=network_interface, store=0, prn=tracker.scapy_packet, filter=bpf_filter)
         except Exception as e:
-            exit_error('Scapy failed to sniff with error %s. Please check help or update scapy version' % e)
+            exit_error('Failed to sniff with error %s. Please check help or update scapy version' % e)
+
+def packet_detected(mac_address, timestamp=None):
+    """
+    Records that a monitored MAC address has been seen, either by packet capture, ARP ping or a node.
+    Nodes pass the sighting on to the leader.
+    """
+    timestamp = timestamp or time.time()
+    if config['coordinator_role'] == 'node':
+        coordinator.packet_detected(mac_address, timestamp)
+    else:
+        presence_monitor.packet_detected(mac_address, timestamp)
+    if timestamp < alarm_state['last_packet']:
+        return
+    alarm_state['last_packet_mac'] = mac_address
+    alarm_state['last_packet'] = timestamp
+    # Packets arrive every few seconds so these are only written with the next snapshot
+    state_store.set('last_packet_mac', mac_address, durable=False)
+    state_store.set('last_packet', alarm_state['last_packet'], durable=False)
 
 def update_alarm_state(new_alarm_state):
     if new_alarm_state != alarm_state['current_state']:
@@ -275,23 +2113,641 @@ def update_alarm_state(new_alarm_state):
         alarm_state['current_state'] = new_alarm_state
         alarm_state['last_state_change'] = time.time()
         logger.info("rpi-security is now %s" % alarm_state['current_state'])
+        state_store.set('current_state', new_alarm_state)
+        state_store.set('last_state_change', alarm_state['last_state_change'])
+        state_store.record('state', state=new_alarm_state, previous=alarm_state['previous_state'])
+        if new_alarm_state == 'disarmed':
+            set_alarm_triggered(False)
+        if pre_trigger_buffer:
+            if new_alarm_state == 'armed':
+                pre_trigger_buffer.start()
+            else:
+                pre_trigger_buffer.stop()
+        if config['coordinator_role'] == 'node':
+            # The leader sent the state and tells Telegram
+            return
+        if 'disabled' in [new_alarm_state, alarm_state['previous_state']]:
+            presence_monitor.state_changed()
+        if config['coordinator_role'] == 'leader':
+            coordinator.state_changed(new_alarm_state)
         telegram_send_message('rpi-security: *%s*' % alarm_state['current_state'])
 
+class PresenceMonitor(object):
+    """
+    Arms and disarms the alarm based on when packets were last seen from the monitored MAC addresses.
+    Instead of polling, probe and arm deadlines are kept in a heap and the monitor thread sleeps until the
+    next one is due or until it is woken by a packet or a state change. Deadlines scheduled before the latest
+    packet are invalidated by a generation number rather than removed from the heap.
+    The clock can be replaced and run_due() called directly to drive the monitor with a simulated clock.
+    last_packet defaults to now, so the alarm arms packet_timeout after starting unless a packet is seen.
+    """
+    def __init__(self, mac_addresses, packet_timeout, get_state, set_state, probe=None, arm_delay=20, probe_interval=3, clock=time.time, last_packet=None):
+        self.packet_timeout = packet_timeout
+        self.get_state = get_state
+        self.set_state = set_state
+        self.probe = probe
+        self.arm_delay = arm_delay
+        self.probe_interval = probe_interval
+        self.clock = clock
+        self.condition = Condition()
+        self.deadlines = []
+        self.generation = 0
+        self.woken = False
+        self.probing = False
+        self.last_packet = clock() if last_packet is None else last_packet
+        self.last_seen = dict((mac_address, None) for mac_address in mac_addresses)
+        self.schedule()
+
+    def schedule(self):
+        """
+        Replaces any scheduled deadlines with new ones based on the last packet. Must hold the condition.
+        """
+        self.generation += 1
+        self.deadlines = []
+        probe_time = self.last_packet + self.packet_timeout
+        arm_time = probe_time + self.arm_delay
+        if self.probe:
+            heapq.heappush(self.deadlines, (probe_time, self.generation, 'probe'))
+        heapq.heappush(self.deadlines, (arm_time, self.generation, 'arm'))
+
+    def packet_detected(self, mac_address, timestamp=None):
+        """
+        Records a packet from a MAC address and wakes the monitor thread.
+        """
+        with self.condition:
+            timestamp = timestamp or self.clock()
+            self.last_seen[mac_address] = timestamp
+            if timestamp > self.last_packet:
+                self.last_packet = timestamp
+                self.schedule()
+            # When disarmed the new deadlines are later than the one being waited for, so no need to wake
+            if self.get_state() != 'disarmed':
+                self.woken = True
+                self.condition.notify()
+
+    def state_changed(self):
+        """
+        Wakes the monitor thread after the alarm is enabled or disabled so deadlines are reconsidered.
+        """
+        with self.condition:
+            self.schedule()
+            self.woken = True
+            self.condition.notify()
+
+    def run_due(self, now):
+        """
+        Performs any state changes or probes that are due and returns the time of the next deadline, or None.
+        State changes are made without holding the lock so a slow Telegram message never blocks packet capture.
+        """
+        new_state = None
+        probe = False
+        with self.condition:
+            self.woken = False
+            if self.get_state() == 'disabled':
+                return None
+            if now - self.last_packet <= self.packet_timeout:
+                new_state = 'disarmed'
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, generation, action = heapq.heappop(self.deadlines)
+                if generation != self.generation:
+                    continue
+                if action == 'arm':
+                    new_state = 'armed'
+                elif action == 'probe':
+                    probe = True
+                    next_probe = deadline + self.probe_interval
+                    if next_probe < self.last_packet + self.packet_timeout + self.arm_delay:
+                        heapq.heappush(self.deadlines, (next_probe, generation, 'probe'))
+            next_deadline = self.deadlines[0][0] if self.deadlines else None
+        if probe:
+            self.start_probe()
+        if new_state:
+            self.set_state(new_state)
+        return next_deadline
+
+    def start_probe(self):
+        """
+        Runs the probe in its own thread so that a slow probe never delays a deadline.
+        """
+        if self.probing:
+            return
+        self.probing = True
+        def run():
+            try:
+                self.probe()
+            finally:
+                self.probing = False
+        probe_thread = Thread(name='presence_probe', target=run)
+        probe_thread.daemon = True
+        probe_thread.start()
+
+    def run(self):
+        logger.info("thread running")
+        while True:
+            next_deadline = self.run_due(self.clock())
+            with self.condition:
+                if not self.woken:
+                    if next_deadline is None:
+                        self.condition.wait()
+                    else:
+                        self.condition.wait(max(next_deadline - self.clock(), 0))
+
 def monitor_alarm_state():
     """
-    This function monitors and updates the alarm state based on data from Telegram and the alarm_state dictionary.
+    This function monitors and updates the alarm state based on packets from the monitored MAC addresses and state changes from Telegram.
     """
-    logger.info("thread running")
-    while True:
-        time.sleep(3)
-        now = time.time()
-        if alarm_state['current_state'] != 'disabled':
-            if now - alarm_state['last_packet'] > config['packet_timeout'] + 20:
-                update_alarm_state('armed')
-            elif now - alarm_state['last_packet'] > config['packet_timeout']:
-                arp_ping_macs(config['mac_addresses'])
+    presence_monitor.run()
+
+coordinator_metric = metrics.counter('coordinator_messages_total', 'Messages received from nodes', label='type')
+incident_metric = metrics.counter('coordinator_motion_events_total', 'Motion events from all nodes by whether they started an incident', label='result')
+
+# Created by setup_services when coordinator_role is leader or node
+coordinator = None
+
+def encode_message(message):
+    return (json.dumps(message, separators=(',', ':')) + '\n').encode('utf-8')
+
+def read_message(rfile, max_length=65536):
+    """
+    Reads one newline terminated JSON message and returns it, or None when the connection is closed.
+    """
+    line = rfile.readline(max_length)
+    if not line:
+        return None
+    if not line.endswith(b'\n'):
+        raise ValueError('Message longer than %s bytes' % max_length)
+    return json.loads(line.decode('utf-8'))
+
+def node_auth(secret, nonce):
+    return hmac.new(secret.encode('utf-8'), nonce.encode('utf-8'), hashlib.sha256).hexdigest()
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+class CoordinatorServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class CoordinatorHandler(StreamRequestHandler):
+    """
+    A connection from a node to the leader. The node proves it knows coordinator_secret by answering a
+    challenge, then its messages are passed to the Coordinator until it disconnects. Messages to the node
+    are written by their own thread so a slow node never holds up the others.
+    """
+    # Nodes send a ping at least every 10 seconds
+    timeout = 60
+
+    def handle(self):
+        self.outgoing = Queue.Queue()
+        nonce = binascii.hexlify(os.urandom(16)).decode('ascii')
+        try:
+            self.wfile.write(encode_message({'t': 'challenge', 'nonce': nonce}))
+            hello = read_message(self.rfile)
+        except (socket.error, ValueError) as e:
+            logger.warning('Node connection from %s failed: %s' % (self.client_address[0], e))
+            return
+        if not hello or hello.get('t') != 'hello' or not hmac.compare_digest(str(hello.get('auth', '')), node_auth(coordinator.secret, nonce)):
+            logger.warning('Rejected node connection from %s' % self.client_address[0])
+            return
+        node = hello.get('node', '')
+        if not node.replace('-', '').replace('_', '').isalnum():
+            logger.warning('Rejected node with invalid name from %s' % self.client_address[0])
+            return
+        writer_thread = Thread(name='coordinator_writer_%s' % node, target=self.writer)
+        writer_thread.daemon = True
+        writer_thread.start()
+        coordinator.connected(node, self)
+        try:
+            while True:
+                message = read_message(self.rfile)
+                if message is None:
+                    break
+                coordinator.handle(node, message, self.rfile)
+        except (socket.error, ValueError, KeyError, TypeError) as e:
+            logger.warning('Connection from node %s failed: %s' % (node, e))
+        finally:
+            coordinator.disconnected(node, self)
+            self.outgoing.put(None)
+
+    def send(self, message):
+        self.outgoing.put(message)
+
+    def close(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def writer(self):
+        while True:
+            message = self.outgoing.get()
+            if message is None:
+                return
+            try:
+                self.wfile.write(encode_message(message))
+            except socket.error as e:
+                logger.warning('Failed to send to node: %s' % e)
+                self.close()
+                return
+
+class Coordinator(object):
+    """
+    Runs on the leader of several rpi-security nodes, such as one Pi per camera in a building. Nodes
+    stream compact events over TCP: the age of their latest sighting of each monitored MAC address, motion
+    events, alarms and captured files. Sightings are merged into the leader's PresenceMonitor so there is one
+    arm state, which is sent to every node when it changes. Motion events from any node, the leader
+    included, within dedup_seconds of each other belong to one incident, which is one group in the
+    upload queue so it gets one ARP check and one preview. The leader owns the only Telegram bot.
+    Ages rather than timestamps are sent so the nodes' clocks do not need to agree.
+    """
+    def __init__(self, name, secret, save_path, dedup_seconds=30, max_incident_seconds=300, clock=time.time):
+        self.name = name
+        self.secret = secret
+        self.save_path = save_path
+        self.dedup_seconds = dedup_seconds
+        self.max_incident_seconds = max_incident_seconds
+        self.clock = clock
+        self.lock = Lock()
+        self.nodes = OrderedDict()
+        self.incident = None
+        self.incidents = OrderedDict()
+        self.groups = OrderedDict()
+
+    def listen(self, address):
+        try:
+            self.server = CoordinatorServer(parse_address(address), CoordinatorHandler)
+        except Exception as e:
+            exit_error('Coordinator failed to listen on %s with error: %s' % (address, e))
+
+    def serve(self):
+        logger.info("thread running")
+        self.server.serve_forever()
+
+    def connected(self, node, connection):
+        with self.lock:
+            previous = self.nodes.get(node, {}).get('connection')
+            self.nodes[node] = {'connection': connection, 'last_message': self.clock()}
+        if previous:
+            previous.close()
+        logger.info('Node %s connected from %s' % (node, connection.client_address[0]))
+        connection.send({'t': 'state', 'state': alarm_state['current_state']})
+
+    def disconnected(self, node, connection):
+        with self.lock:
+            if self.nodes.get(node, {}).get('connection') is connection:
+                self.nodes[node]['connection'] = None
+                logger.warning('Node %s disconnected' % node)
+
+    def connected_nodes(self):
+        with self.lock:
+            return len([n for n in self.nodes.values() if n['connection']])
+
+    def status(self):
+        """
+        Returns a line for /status listing each node and when it was last heard from.
+        """
+        now = self.clock()
+        with self.lock:
+            nodes = ['%s %.0fs ago' % (node, now - n['last_message']) if n['connection'] else '%s offline' % node for node, n in self.nodes.items()]
+        return 'Nodes: _%s_' % (', '.join(nodes) or 'none')
+
+    def handle(self, node, message, rfile):
+        now = self.clock()
+        with self.lock:
+            self.nodes[node]['last_message'] = now
+        message_type = message['t']
+        coordinator_metric.inc(message_type)
+        if message_type == 'seen':
+            for mac_address, age in message['macs'].items():
+                if mac_address in config['mac_addresses']:
+                    packet_detected(mac_address, now - age)
+        elif message_type == 'motion':
+            self.motion(node, message['group'], now - message['age'])
+        elif message_type == 'alarm':
+            state_store.record('alarm', start=now - message['age'], edges=message['edges'], mode=message['mode'], files=message['files'], prefix=message['prefix'], node=node)
+        elif message_type == 'file':
+            self.receive_file(node, message, rfile)
+        elif message_type == 'capture_failed':
+            telegram_send_message('Node %s could not take a %s, %s' % (node, message['kind'], message['reason']))
+
+    def motion(self, node, prefix, start):
+        """
+        Adds a motion event to the current incident, or starts a new one, and returns the incident's group.
+        """
+        with self.lock:
+            incident = self.incident
+            if incident is None or start - incident['last'] > self.dedup_seconds or start - incident['start'] > self.max_incident_seconds:
+                group = 'incident-%s' % datetime.fromtimestamp(start).strftime("%Y-%m-%d-%H%M%S")
+                incident = self.incident = {'group': group, 'start': start, 'last': start, 'nodes': [], 'preview': False}
+                self.incidents[group] = incident
+                if len(self.incidents) > 100:
+                    self.incidents.popitem(last=False)
+                incident_metric.inc('new')
             else:
-                update_alarm_state('disarmed')
+                incident_metric.inc('joined')
+            incident['last'] = max(incident['last'], start)
+            if node not in incident['nodes']:
+                incident['nodes'].append(node)
+            self.groups[(node, prefix)] = incident['group']
+            if len(self.groups) > 100:
+                self.groups.popitem(last=False)
+        logger.debug('Motion on %s is part of %s from %s' % (node, incident['group'], ', '.join(incident['nodes'])))
+        return incident['group']
+
+    def motion_event(self, file_prefix, event):
+        return self.motion(self.name, os.path.basename(file_prefix), event['start'])
+
+    def alarm(self, fields):
+        state_store.record('alarm', node=self.name, **fields)
+
+    def accept(self, file_path, group):
+        """
+        Returns False for the preview of a motion event when its incident already has one.
+        """
+        if not file_path.endswith('-preview.jpeg'):
+            return True
+        with self.lock:
+            incident = self.incidents.get(group)
+            if incident is None:
+                return True
+            if incident['preview']:
+                logger.debug('Skipping preview, %s already has one: %s' % (group, file_path))
+                return False
+            incident['preview'] = True
+            return True
+
+    def receive_file(self, node, message, rfile):
+        """
+        Saves a file sent by a node, queues it for sending and acknowledges it once it has been committed to
+        the outbox and queued. Otherwise it is refused so the node sends it again.
+        """
+        name = os.path.basename(message['name'])
+        if os.path.splitext(name)[1] not in ['.jpeg', '.gif', '.mp4']:
+            raise ValueError('Unexpected file %s' % name)
+        file_path = os.path.join(self.save_path, '%s-%s' % (node, name))
+        remaining = message['size']
+        with open(file_path + '.part', 'wb') as f:
+            while remaining > 0:
+                data = rfile.read(min(remaining, 65536))
+                if not data:
+                    raise ValueError('Connection closed while receiving %s' % name)
+                f.write(data)
+                remaining -= len(data)
+        os.rename(file_path + '.part', file_path)
+        if message.get('on_demand'):
+            outbox.add(file_path, state='delivered')
+            send_thread = Thread(name='send_on_demand', target=telegram_send_file, args=(file_path,))
+            send_thread.daemon = True
+            send_thread.start()
+        else:
+            group = self.groups.get((node, message.get('group')))
+            if group is None:
+                # Resumed from the node's outbox after a restart, so its motion event is unknown
+                group = self.motion(node, message.get('group') or name, self.clock())
+            if not queue_captured_file(file_path, group=group, sync=True):
+                logger.error('Failed to queue %s from %s, asking for it again' % (name, node))
+                self.send(node, {'t': 'nack', 'name': message['name']})
+                return
+        self.send(node, {'t': 'ack', 'name': message['name']})
+
+    def send(self, node, message):
+        with self.lock:
+            connection = self.nodes.get(node, {}).get('connection')
+        if connection:
+            connection.send(message)
+            return True
+        return False
+
+    def state_changed(self, new_alarm_state):
+        """
+        Sends the alarm state to every connected node.
+        """
+        with self.lock:
+            nodes = list(self.nodes.keys())
+        for node in nodes:
+            self.send(node, {'t': 'state', 'state': new_alarm_state})
+
+    def request_capture(self, node, kind):
+        """
+        Asks a node for an on-demand photo or GIF. Returns False if it is not connected.
+        """
+        return self.send(node, {'t': 'capture', 'kind': kind})
+
+class CoordinatorNode(object):
+    """
+    Runs on a node and keeps a connection to the leader open, reconnecting with backoff. The node still
+    sniffs packets and captures motion events but has no Telegram bot and does not decide the alarm state,
+    the leader sends it. Sightings of the monitored MAC addresses are sent in batches at most every
+    batch_interval, so a burst of packets costs one small message. Motion events and alarms are kept
+    while disconnected and sent first after reconnecting. The upload workers send captured files with
+    send_file, which returns True once the leader has acknowledged the file, so a file sent while the
+    leader is unreachable is retried and stays in the outbox.
+    """
+    def __init__(self, name, address, secret, batch_interval=1, ping_interval=10, ack_timeout=60, max_retry_delay=30, clock=time.time):
+        self.name = name
+        self.address = address
+        self.secret = secret
+        self.batch_interval = batch_interval
+        self.ping_interval = ping_interval
+        self.ack_timeout = ack_timeout
+        self.max_retry_delay = max_retry_delay
+        self.clock = clock
+        self.condition = Condition()
+        self.write_lock = Lock()
+        self.connection = None
+        self.seen = {}
+        self.pending = deque(maxlen=100)
+        self.prefixes = deque(maxlen=20)
+        # name: True once acknowledged by the leader, False if it was refused
+        self.acked = {}
+        self.last_sent = 0
+
+    def packet_detected(self, mac_address, timestamp):
+        with self.condition:
+            self.seen[mac_address] = max(timestamp, self.seen.get(mac_address, 0))
+            self.condition.notify_all()
+
+    def queue(self, message):
+        with self.condition:
+            self.pending.append(message)
+            self.condition.notify_all()
+
+    def motion_event(self, file_prefix, event):
+        prefix = os.path.basename(file_prefix)
+        with self.condition:
+            self.prefixes.append(prefix)
+        self.queue({'t': 'motion', 'group': prefix, 'start': event['start']})
+        return file_prefix
+
+    def alarm(self, fields):
+        state_store.record('alarm', **fields)
+        message = {'t': 'alarm'}
+        message.update(fields)
+        self.queue(message)
+
+    def write(self, connection, message, f=None):
+        """
+        Writes a message, followed by the contents of f if given. Must hold write_lock.
+        """
+        now = self.clock()
+        if 'start' in message:
+            message = dict(message)
+            message['age'] = now - message.pop('start')
+        connection.sendall(encode_message(message))
+        if f:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    break
+                connection.sendall(data)
+        self.last_sent = now
+
+    def flush(self, connection):
+        """
+        Sends the queued messages and sightings. Must hold write_lock.
+        """
+        with self.condition:
+            messages = list(self.pending)
+            self.pending.clear()
+            seen, self.seen = self.seen, {}
+        now = self.clock()
+        if seen:
+            messages.append({'t': 'seen', 'macs': dict((mac_address, round(now - timestamp, 2)) for mac_address, timestamp in seen.items())})
+        try:
+            for i, message in enumerate(messages):
+                self.write(connection, message)
+        except socket.error:
+            # Motion events and alarms are kept to send after reconnecting, sightings are out of date by then
+            with self.condition:
+                self.pending.extendleft(reversed([m for m in messages[i:] if m['t'] != 'seen']))
+            raise
+
+    def send_file(self, file_path, on_demand=False):
+        """
+        Sends a file to the leader and waits for it to be acknowledged. Returns True if it was, False if it
+        was refused or not acknowledged within ack_timeout.
+        """
+        name = os.path.basename(file_path)
+        group = None
+        with self.condition:
+            prefixes = list(self.prefixes)
+        for prefix in reversed(prefixes):
+            if name.startswith(prefix):
+                group = prefix
+                break
+        message = {'t': 'file', 'name': name, 'size': os.path.getsize(file_path), 'group': group, 'on_demand': on_demand}
+        connection = self.connection
+        if connection is None:
+            return False
+        with self.condition:
+            self.acked.pop(name, None)
+        try:
+            with self.write_lock, open(file_path, 'rb') as f:
+                self.flush(connection)
+                self.write(connection, message, f)
+        except (socket.error, IOError) as e:
+            logger.error('Failed to send %s to the leader: %s' % (file_path, e))
+            self.disconnect(connection)
+            return False
+        deadline = self.clock() + self.ack_timeout
+        with self.condition:
+            while name not in self.acked and self.connection is connection and self.clock() < deadline:
+                self.condition.wait(deadline - self.clock())
+            return self.acked.pop(name, False)
+
+    def connect(self):
+        connection = socket.create_connection(parse_address(self.address), timeout=10)
+        rfile = connection.makefile('rb')
+        challenge = read_message(rfile)
+        if not challenge or challenge.get('t') != 'challenge':
+            raise ValueError('Unexpected message from leader: %s' % challenge)
+        connection.sendall(encode_message({'t': 'hello', 'node': self.name, 'auth': node_auth(self.secret, challenge['nonce'])}))
+        connection.settimeout(None)
+        with self.write_lock:
+            self.flush(connection)
+            with self.condition:
+                self.connection = connection
+                self.condition.notify_all()
+        logger.info('Connected to leader %s' % self.address)
+        return connection, rfile
+
+    def disconnect(self, connection):
+        with self.condition:
+            if self.connection is connection:
+                self.connection = None
+            self.condition.notify_all()
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        connection.close()
+
+    def receive(self, rfile):
+        while True:
+            message = read_message(rfile)
+            if message is None:
+                raise socket.error('Connection closed by leader')
+            if message['t'] == 'state':
+                update_alarm_state(message['state'])
+            elif message['t'] in ['ack', 'nack']:
+                with self.condition:
+                    self.acked[message['name']] = message['t'] == 'ack'
+                    self.condition.notify_all()
+            elif message['t'] == 'capture' and message['kind'] in ['photo', 'gif']:
+                if 'camera' not in globals():
+                    # The connection to the leader is made before the camera has loaded
+                    self.queue({'t': 'capture_failed', 'kind': message['kind'], 'reason': 'the camera is still starting'})
+                    continue
+                capture = capture_on_demand_photo if message['kind'] == 'photo' else capture_on_demand_gif
+                camera_arbiter.request(message['kind'], capture, lambda file_path: self.send_file(file_path, on_demand=True))
+
+    def sender(self):
+        """
+        Sends queued messages as soon as they arrive, sightings at most every batch_interval, and a ping
+        when nothing else has been sent for ping_interval.
+        """
+        logger.info("thread running")
+        while True:
+            with self.condition:
+                while True:
+                    connection = self.connection
+                    now = self.clock()
+                    if connection and (self.pending or (self.seen and now - self.last_sent >= self.batch_interval) or now - self.last_sent >= self.ping_interval):
+                        break
+                    if connection is None:
+                        self.condition.wait()
+                    elif self.seen:
+                        self.condition.wait(self.last_sent + self.batch_interval - now)
+                    else:
+                        self.condition.wait(self.last_sent + self.ping_interval - now)
+            try:
+                with self.write_lock:
+                    self.flush(connection)
+                    if self.clock() - self.last_sent >= self.ping_interval:
+                        self.write(connection, {'t': 'ping'})
+            except socket.error as e:
+                logger.warning('Failed to send to the leader: %s' % e)
+                self.disconnect(connection)
+
+    def run(self):
+        logger.info("thread running")
+        sender_thread = Thread(name='coordinator_sender', target=self.sender)
+        sender_thread.daemon = True
+        sender_thread.start()
+        delay = 1
+        while True:
+            connection = None
+            try:
+                connection, rfile = self.connect()
+                delay = 1
+                self.receive(rfile)
+            except (socket.error, ValueError, KeyError) as e:
+                logger.warning('Connection to leader %s failed: %s' % (self.address, e))
+            if connection:
+                self.disconnect(connection)
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
 
 def telegram_bot(token):
     """
@@ -307,19 +2763,20 @@ def telegram_bot(token):
                 if days > 0:
                     text = '%s days, ' % days + text
             return text
-        return '*rpi-security status*\nCurrent state: _%s_\nLast state: _%s_\nLast change: _%s ago_\nUptime: _%s_\nLast MAC detected: _%s %s ago_\nAlarm triggered: _%s_' % (
+        return '*rpi-security status*\nCurrent state: _%s_\nLast state: _%s_\nLast change: _%s ago_\nUptime: _%s_\nLast MAC detected: _%s %s ago_\nAlarm triggered: _%s_\nUpload queue: _%s_' % (
                 alarm_state_dict['current_state'],
                 alarm_state_dict['previous_state'],
                 readable_delta(alarm_state_dict['last_state_change']),
                 readable_delta(alarm_state_dict['start_time']),
                 alarm_state_dict['last_packet_mac'],
                 readable_delta(alarm_state_dict['last_packet']),
-                alarm_state_dict['alarm_triggered']
-            )
+                alarm_state_dict['alarm_triggered'],
+                upload_queue.depth()
+            ) + ('\n' + coordinator.status() if config['coordinator_role'] == 'leader' else '')
     def save_chat_id(bot, update):
         if 'telegram_chat_id' not in state:
             state['telegram_chat_id'] = update.message.chat_id
-            write_state_file(state_file=args.state_file, state_data=state)
+            state_store.set('telegram_chat_id', update.message.chat_id)
             logger.debug('Set Telegram chat_id %s' % update.message.chat_id)
     def debug(bot, update):
         logger.debug('Received Telegram bot message: %s' % update.message.text)
@@ -331,26 +2788,40 @@ def telegram_bot(token):
             return True
     def help(bot, update):
         if check_chat_id(update):
-            bot.sendMessage(update.message.chat_id, parse_mode='Markdown', text='/status: Request status\n/disable: Disable alarm\n/enable: Enable alarm\n/photo: Take a photo\n/gif: Take a gif\n', timeout=10)
+            bot.sendMessage(update.message.chat_id, parse_mode='Markdown', text='/status: Request status\n/stats: Request performance stats\n/alarms: List recent alarms, /alarms 20 for more\n/disable: Disable alarm\n/enable: Enable alarm\n/photo: Take a photo, /photo <node> on another node\n/gif: Take a gif, /gif <node> on another node\n', timeout=10)
     def status(bot, update):
         if check_chat_id(update):
             bot.sendMessage(update.message.chat_id, parse_mode='Markdown', text=prepare_status(alarm_state), timeout=10)
+    def stats(bot, update):
+        if check_chat_id(update):
+            bot.sendMessage(update.message.chat_id, parse_mode='Markdown', text='*rpi-security stats*\n```\n%s\n```' % metrics.summary(), timeout=10)
+    def alarms(bot, update, args):
+        if check_chat_id(update):
+            try:
+                limit = max(1, min(int(args[0]), 50)) if args else 5
+            except ValueError:
+                limit = 5
+            events = state_store.events('alarm', limit=limit)
+            lines = ['%s: %s%s, %s files, %s triggers' % (datetime.fromtimestamp(event['start']).strftime('%Y-%m-%d %H:%M:%S'), event['mode'], ' on %s' % event['node'] if 'node' in event else '', event['files'], event['edges']) for event in events]
+            bot.sendMessage(update.message.chat_id, parse_mode='Markdown', text='*rpi-security alarms*\n%s' % ('\n'.join(lines) or 'None recorded'), timeout=10)
     def disable(bot, update):
         if check_chat_id(update):
             update_alarm_state('disabled')
     def enable(bot, update):
         if check_chat_id(update):
             update_alarm_state('disarmed')
-    def photo(bot, update):
+    def on_demand(update, args, kind, capture):
+        if args and args[0] != config['coordinator_node_name']:
+            if config['coordinator_role'] != 'leader' or not coordinator.request_capture(args[0], kind):
+                bot.sendMessage(update.message.chat_id, text='Node %s is not connected' % args[0], timeout=10)
+        else:
+            camera_arbiter.request(kind, capture, telegram_send_file)
+    def photo(bot, update, args):
         if check_chat_id(update):
-            file_path = config['camera_save_path'] + "/rpi-security-" + datetime.now().strftime("%Y-%m-%d-%H%M%S") + '.jpeg'
-            take_photo(file_path)
-            telegram_send_file(file_path)
-    def gif(bot, update):
+            on_demand(update, args, 'photo', capture_on_demand_photo)
+    def gif(bot, update, args):
         if check_chat_id(update):
-            file_path = config['camera_save_path'] + "/rpi-security-" + datetime.now().strftime("%Y-%m-%d-%H%M%S") + '.gif'
-            take_gif(file_path, config['camera_capture_length'])
-            telegram_send_file(file_path)
+            on_demand(update, args, 'gif', capture_on_demand_gif)
     def error(bot, update, error):
         logger.error('Update "%s" caused error "%s"' % (update, error))
     updater = Updater(token)
@@ -359,39 +2830,683 @@ def telegram_bot(token):
     dp.add_handler(RegexHandler('.*', debug), group=2)
     dp.add_handler(CommandHandler("help", help))
     dp.add_handler(CommandHandler("status", status))
+    dp.add_handler(CommandHandler("stats", stats))
+    dp.add_handler(CommandHandler("alarms", alarms, pass_args=True))
     dp.add_handler(CommandHandler("disable", disable))
     dp.add_handler(CommandHandler("enable", enable))
-    dp.add_handler(CommandHandler("photo", photo))
-    dp.add_handler(CommandHandler("gif", gif))
+    dp.add_handler(CommandHandler("photo", photo, pass_args=True))
+    dp.add_handler(CommandHandler("gif", gif, pass_args=True))
     dp.add_error_handler(error)
     logger.info("thread running")
     updater.start_polling(timeout=10)
 
+def queue_pre_trigger_frames(file_prefix, pre_trigger_frames, group=None):
+    """
+    Saves the JPEG frames from before the trigger and queues them to be sent first.
+    """
+    for i, jpeg in enumerate(pre_trigger_frames):
+        camera_output_file = "%s-pre-%s.jpeg" % (file_prefix, i)
+        with open(camera_output_file, 'wb') as f:
+            f.write(jpeg)
+        queue_captured_file(camera_output_file, group=group or file_prefix)
+
 def motion_detected(channel):
     """
-    Capture a photo if motion is detected and the alarm state is armed
+    Called by RPi.GPIO and the camera motion detector. Only records the time, the capture scheduler does the rest.
+    """
+    capture_scheduler.trigger()
+
+def capture_motion_event(event):
+    """
+    Captures photos, a GIF or a video for a motion event, starting with the frames from the pre-trigger
+    buffer from before the first edge. With a coordinator the files are grouped by incident.
     """
-    current_state = alarm_state['current_state']
-    if current_state == 'armed':
-        logger.info('Motion detected')
-        file_prefix = config['camera_save_path'] + "/rpi-security-" + datetime.now().strftime("%Y-%m-%d-%H%M%S")
-        if config['camera_mode'].lower() == 'gif':
+    file_prefix = config['camera_save_path'] + "/rpi-security-" + datetime.fromtimestamp(event['start']).strftime("%Y-%m-%d-%H%M%S")
+    pre_trigger_frames = pre_trigger_buffer.frames(before=event['start']) if pre_trigger_buffer else []
+    group = coordinator.motion_event(file_prefix, event) if coordinator else file_prefix
+    # Alarm captures go before on-demand captures from the bot
+    with camera_arbiter.alarm():
+        if config['alert_preview']:
+            preview_file = "%s-preview.jpeg" % file_prefix
+            if take_preview(preview_file, config['alert_preview_size']):
+                queue_captured_file(preview_file, group=group)
+        camera_mode = config['camera_mode'].lower()
+        # Capture less detail when the uplink is too slow to send the full media quickly
+        scale = upload_throughput.scale(camera_mode)
+        if scale < 1:
+            logger.debug('Capturing at %s scale for the measured upload throughput' % scale)
+        captured_files = []
+        if camera_mode == 'gif':
             camera_output_file = "%s.gif" % file_prefix
-            take_gif(camera_output_file, config['camera_capture_length'])
-            captured_from_camera.append(camera_output_file)
-        elif config['camera_mode'].lower() == 'photo':
-            for i in range(0, config['camera_capture_length'], 1):
-                camera_output_file = "%s-%s.jpeg" % (file_prefix, i)
-                take_photo(camera_output_file)
-                captured_from_camera.append(camera_output_file)
+            size = (int(800 * scale), int(600 * scale))
+            take_gif(camera_output_file, config['camera_capture_length'], pre_trigger_frames, size=size, max_bytes=config['camera_gif_max_kb'] * 1024)
+            queue_captured_file(camera_output_file, group=group)
+            captured_files.append(camera_output_file)
+        elif camera_mode == 'video':
+            queue_pre_trigger_frames(file_prefix, pre_trigger_frames, group=group)
+            camera_output_file = "%s.mp4" % file_prefix
+            end_time = lambda: capture_scheduler.recording_end(config['camera_capture_length'])
+            bitrate = int(config['camera_video_bitrate'] * scale ** 2)
+            if take_video(camera_output_file, config['camera_capture_length'], end_time, bitrate=bitrate):
+                queue_captured_file(camera_output_file, group=group)
+                captured_files.append(camera_output_file)
+        elif camera_mode == 'photo':
+            queue_pre_trigger_frames(file_prefix, pre_trigger_frames, group=group)
+            width, height = config['camera_image_size']
+            resize = (int(width * scale), int(height * scale)) if scale < 1 else None
+            if config['camera_burst_fps'] > 0:
+                def frame_captured(i, jpeg):
+                    camera_output_file = "%s-%s.jpeg" % (file_prefix, i)
+                    with open(camera_output_file, 'wb') as f:
+                        f.write(jpeg)
+                    queue_captured_file(camera_output_file, group=group)
+                    captured_files.append(camera_output_file)
+                take_burst(config['camera_capture_length'], config['camera_burst_fps'], frame_captured, resize=resize)
+            else:
+                for i in range(0, config['camera_capture_length'], 1):
+                    camera_output_file = "%s-%s.jpeg" % (file_prefix, i)
+                    take_photo(camera_output_file, resize=resize)
+                    queue_captured_file(camera_output_file, group=group)
+                    captured_files.append(camera_output_file)
         else:
             logger.error("Unkown camera_mode %s" % config['camera_mode'])
+    captured_size = sum([os.path.getsize(f) for f in captured_files if os.path.exists(f)])
+    if captured_size:
+        upload_throughput.record(camera_mode, captured_size, scale)
+    fields = {'start': event['start'], 'edges': event['edges'], 'mode': camera_mode, 'files': len(captured_files), 'prefix': os.path.basename(file_prefix)}
+    if coordinator:
+        coordinator.alarm(fields)
+    else:
+        state_store.record('alarm', **fields)
+
+class CaptureScheduler(object):
+    """
+    Turns motion triggers into captures in its own thread so the GPIO callback never blocks. trigger()
+    only records the time of the edge. Edges belong to the same motion event, which has one capture, until
+    there are none for cooldown seconds. A video recording is extended until length seconds after the
+    latest edge. An event lasts at most max_event_seconds, after that continuing motion starts a new one,
+    and at most max_per_hour captures are started in any hour. So continuous motion cannot cause a
+    capture and upload storm.
+    """
+    def __init__(self, capture, get_state, cooldown=10, max_event_seconds=60, max_per_hour=60, clock=time.time):
+        self.capture = capture
+        self.get_state = get_state
+        self.cooldown = cooldown
+        self.max_event_seconds = max_event_seconds
+        self.max_per_hour = max_per_hour
+        self.clock = clock
+        self.condition = Condition()
+        self.edges = 0
+        self.last_edge = None
+        self.event = None
+        self.capture_times = deque()
+        self.rate_limited = False
+
+    def trigger(self, timestamp=None):
+        with self.condition:
+            self.edges += 1
+            self.last_edge = timestamp or self.clock()
+            self.condition.notify()
+
+    def recording_end(self, length):
+        """
+        Returns when a recording for the current event should end, length seconds after the latest edge.
+        Edges up to now have extended the recording so they do not start another capture.
+        """
+        with self.condition:
+            self.event['edges'] += self.edges
+            self.edges = 0
+            return min(self.last_edge + length, self.event['start'] + self.max_event_seconds)
+
+    def idle_timeout(self, now):
+        """
+        Ends the current event once the cooldown has passed since its last capture or edge. Returns the
+        seconds until it ends, or None when there is no event. Must hold the condition.
+        """
+        if self.event is None:
+            return None
+        timeout = max(self.event['last_capture'], self.last_edge) + self.cooldown - now
+        if timeout <= 0:
+            logger.debug('Motion event ended after %s edges' % self.event['edges'])
+            self.event = None
+            return None
+        return timeout
+
+    def wait_for_edges(self):
+        """
+        Waits for edges and returns the number since the last call and the time of the latest one.
+        """
+        with self.condition:
+            while not self.edges:
+                self.condition.wait(self.idle_timeout(self.clock()))
+            edges, self.edges = self.edges, 0
+            return edges, self.last_edge
+
+    def allow_capture(self, now):
+        while self.capture_times and self.capture_times[0] <= now - 3600:
+            self.capture_times.popleft()
+        if self.max_per_hour and len(self.capture_times) >= self.max_per_hour:
+            if not self.rate_limited:
+                logger.warning('Motion captures limited to %s per hour' % self.max_per_hour)
+            self.rate_limited = True
+            return False
+        self.rate_limited = False
+        self.capture_times.append(now)
+        return True
+
+    def handle(self, edges, edge_time):
+        current_state = self.get_state()
+        if current_state != 'armed':
+            logger.debug('Motion detected but current_state is: %s' % current_state)
+            self.event = None
+            return
+        now = self.clock()
+        if self.event is None or now - self.event['start'] > self.max_event_seconds:
+            logger.info('Motion detected')
+            motion_metric.inc()
+            self.event = {'start': edge_time, 'edges': edges, 'last_capture': now}
+        else:
+            self.event['edges'] += edges
+            return
+        if not self.allow_capture(now):
+            return
+        try:
+            self.capture(self.event)
+        except Exception as e:
+            logger.error('Failed to capture motion event: %s' % e)
+        self.event['last_capture'] = self.clock()
+
+    def run(self):
+        logger.info("thread running")
+        while True:
+            self.handle(*self.wait_for_edges())
+
+class CameraMotionDetector(object):
+    """
+    Detects motion from low resolution frames read continuously from the camera video port.
+    Each frame's luminance is compared block by block against a running background model and
+    when enough blocks inside the configured zones change, the same trigger as the PIR sensor is fired.
+    Instances are passed to camera.start_recording() as the output object.
+    """
+    block_size = 16
+
+    def __init__(self, size, callback, zones=None, threshold=12, min_blocks=2, max_fps=5, cpu_budget=0.25, learning_rate=0.05, clock=time.time):
+        self.width, self.height = size
+        self.padded_width = (self.width + 31) // 32 * 32
+        self.padded_height = (self.height + 15) // 16 * 16
+        # A YUV420 frame is the Y plane followed by the quarter size U and V planes
+        self.frame_size = self.padded_width * self.padded_height * 3 // 2
+        self.partial = bytearray()
+        self.rows = self.height // self.block_size
+        self.cols = self.width // self.block_size
+        self.callback = callback
+        # Threshold is the mean absolute difference per pixel, compare against block sums to avoid a division
+        self.block_threshold = threshold * self.block_size * self.block_size
+        self.min_blocks = min_blocks
+        self.min_interval = 1.0 / max_fps
+        self.cpu_budget = cpu_budget
+        self.learning_rate = learning_rate
+        self.clock = clock
+        self.mask = self.zone_mask(zones)
+        shape = (self.rows * self.block_size, self.cols * self.block_size)
+        self.background = None
+        self.frame = np.empty(shape, dtype=np.float32)
+        self.diff = np.empty(shape, dtype=np.float32)
+        self.next_frame_time = 0
+        self.frames_analysed = 0
+        self.frames_skipped = 0
+
+    def zone_mask(self, zones):
+        """
+        Converts zones given as (x1, y1, x2, y2) fractions of the frame into a boolean mask of blocks.
+        """
+        if not zones:
+            return np.ones((self.rows, self.cols), dtype=bool)
+        mask = np.zeros((self.rows, self.cols), dtype=bool)
+        for x1, y1, x2, y2 in zones:
+            mask[int(y1 * self.rows):int(math.ceil(y2 * self.rows)), int(x1 * self.cols):int(math.ceil(x2 * self.cols))] = True
+        return mask
+
+    def score(self, luma):
+        """
+        Returns the number of blocks in the zones that differ from the background and updates the background.
+        luma is a 2D uint8 array of at least rows*block_size by cols*block_size.
+        """
+        self.frame[:] = luma[:self.frame.shape[0], :self.frame.shape[1]]
+        if self.background is None:
+            self.background = self.frame.copy()
+            return 0
+        np.subtract(self.frame, self.background, out=self.diff)
+        self.background += self.learning_rate * self.diff
+        np.abs(self.diff, out=self.diff)
+        block_sums = self.diff.reshape(self.rows, self.block_size, self.cols, self.block_size).sum(axis=(1, 3))
+        return int(np.count_nonzero((block_sums > self.block_threshold) & self.mask))
+
+    def analyse(self, luma):
+        """
+        Scores a frame if the frame rate and CPU budget allow it. Returns True if motion was detected.
+        """
+        start = self.clock()
+        if start < self.next_frame_time:
+            self.frames_skipped += 1
+            return False
+        motion = self.score(luma) >= self.min_blocks
+        self.frames_analysed += 1
+        elapsed = self.clock() - start
+        self.next_frame_time = start + max(self.min_interval, elapsed / self.cpu_budget)
+        if motion:
+            self.callback('camera')
+        return motion
+
+    def write(self, buf):
+        """
+        Called by the camera with each frame. A frame split over several writes is put back together first.
+        """
+        if not self.partial and len(buf) == self.frame_size:
+            self.analyse_frame(buf)
+            return len(buf)
+        self.partial.extend(buf)
+        while len(self.partial) >= self.frame_size:
+            self.analyse_frame(bytes(self.partial[:self.frame_size]))
+            del self.partial[:self.frame_size]
+        return len(buf)
+
+    def analyse_frame(self, frame):
+        # Only the Y plane of the YUV420 frame is needed
+        luma = np.frombuffer(frame, dtype=np.uint8, count=self.padded_width * self.padded_height)
+        self.analyse(luma.reshape(self.padded_height, self.padded_width))
+
+    def flush(self):
+        pass
+
+def setup_gpio(gpio_module):
+    """
+    Sets up GPIO pins using RPi.GPIO or a module with the same interface.
+    """
+    global GPIO
+    GPIO = gpio_module
+    GPIO.setwarnings(False)
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setup(32, GPIO.OUT, initial=False)
+
+def setup_camera(camera_module):
+    """
+    Creates and configures the camera using picamera or a module with the same interface.
+    """
+    global camera
+    new_camera = camera_module.PiCamera()
+    new_camera.resolution = config['camera_image_size']
+    new_camera.vflip = config['camera_vflip']
+    new_camera.led = False
+    # Only set once configured, as nodes check for it before on-demand captures
+    camera = new_camera
+
+def setup_pre_trigger_buffer():
+    """
+    Creates the pre-trigger buffer once the camera and services are set up, starting it if already armed.
+    """
+    global pre_trigger_buffer
+    if config['camera_pre_trigger_seconds'] > 0:
+        pre_trigger_buffer = FrameRingBuffer(
+            camera=camera,
+            seconds=config['camera_pre_trigger_seconds'],
+            fps=config['camera_pre_trigger_fps'],
+            size=config['camera_pre_trigger_size'],
+            max_frame_size=config['camera_pre_trigger_frame_kb'] * 1024
+        )
+        if alarm_state['current_state'] == 'armed':
+            pre_trigger_buffer.start()
+
+def setup_services():
+    """
+    Creates the alarm state and the objects that the threads share.
+    """
+    global alarm_state, presence_monitor, outbox, upload_queue, archiver, capture_scheduler, upload_throughput, camera_arbiter, coordinator
+    if config['coordinator_role'] not in ['standalone', 'leader', 'node']:
+        exit_error('Unknown coordinator_role %s' % config['coordinator_role'])
+    if config['coordinator_role'] != 'standalone' and not config['coordinator_secret']:
+        exit_error('coordinator_secret must be set to the same value on the leader and every node')
+    try:
+        outbox = Outbox(config['outbox_file'])
+    except Exception as e:
+        exit_error('Failed to open outbox %s with error: %s' % (config['outbox_file'], e))
+    outbox.retention = MediaRetention(outbox, max_bytes=config['media_max_mb'] * 1024 * 1024, max_age=config['media_max_age_days'] * 86400)
+    if config['coordinator_role'] == 'node':
+        # Files go to the leader, which sends albums, so each is forwarded on its own
+        upload_queue = UploadQueue(
+            send=forward_captured_file,
+            failed=outbox.release,
+            workers=config['upload_workers'],
+            max_size=config['upload_queue_size'],
+            retries=config['upload_retries']
+        )
     else:
-        logger.debug('Motion detected but current_state is: %s' % current_state)
+        upload_queue = UploadQueue(
+            send=send_captured_file,
+            failed=outbox.release,
+            workers=config['upload_workers'],
+            max_size=config['upload_queue_size'],
+            retries=config['upload_retries'],
+            send_album=send_captured_album,
+            album_filter=album_photo
+        )
+    upload_throughput = UploadThroughput(target_seconds=config['alert_upload_target_seconds'])
+    archiver = None
+    if config['archive_backend'] != 'none':
+        try:
+            archiver = Archiver(
+                backend=create_archive_backend(),
+                db_file=config['outbox_file'],
+                batch_size=config['archive_batch_size'],
+                chunk_size=config['archive_chunk_mb'] * 1024 * 1024,
+                done=outbox.retention.archived
+            )
+        except Exception as e:
+            exit_error('Failed to set up %s archive with error: %s' % (config['archive_backend'], e))
+        outbox.retention.archiving = True
+    # Set the initial alarm_state dictionary. After a restart, such as after a power cut, an armed alarm
+    # stays armed until a packet is seen and a disabled alarm stays disabled until /enable is sent
+    restored_state = state_store.get('current_state')
+    last_packet = time.time()
+    if restored_state == 'armed':
+        last_packet = state_store.get('last_packet', 0)
+    elif restored_state != 'disabled':
+        restored_state = None
+    alarm_state = {
+        'start_time': time.time(),
+        'current_state': restored_state or 'disarmed',
+        'previous_state': 'stopped',
+        'last_state_change': state_store.get('last_state_change', time.time()) if restored_state else time.time(),
+        'last_packet': last_packet,
+        'last_packet_mac': state_store.get('last_packet_mac'),
+        'alarm_triggered': state_store.get('alarm_triggered', False)
+    }
+    state_store.set('current_state', alarm_state['current_state'])
+    state_store.set('last_state_change', alarm_state['last_state_change'])
+    state_store.record('start', state=alarm_state['current_state'])
+    camera_arbiter = CameraArbiter(freshness=config['camera_on_demand_freshness'])
+    capture_scheduler = CaptureScheduler(
+        capture=capture_motion_event,
+        get_state=lambda: alarm_state['current_state'],
+        cooldown=config['motion_cooldown'],
+        max_event_seconds=config['motion_max_event_seconds'],
+        max_per_hour=config['motion_max_captures_per_hour']
+    )
+    metrics.gauge('upload_queue_depth', 'Captured files waiting to be sent', upload_queue.depth)
+    metrics.gauge('upload_throughput_bytes', 'Measured upload throughput in bytes/s', lambda: upload_throughput.rate or 0)
+    coordinator = None
+    presence_monitor = None
+    if config['coordinator_role'] == 'node':
+        coordinator = CoordinatorNode(
+            name=config['coordinator_node_name'],
+            address=config['coordinator_address'],
+            secret=config['coordinator_secret']
+        )
+        return
+    if config['coordinator_role'] == 'leader':
+        coordinator = Coordinator(
+            name=config['coordinator_node_name'],
+            secret=config['coordinator_secret'],
+            save_path=config['camera_save_path'],
+            dedup_seconds=config['coordinator_dedup_seconds'],
+            max_incident_seconds=config['motion_max_event_seconds']
+        )
+        coordinator.listen(config['coordinator_address'])
+        metrics.gauge('coordinator_nodes_connected', 'Nodes connected to the leader', coordinator.connected_nodes)
+    presence_monitor = PresenceMonitor(
+        mac_addresses=config['mac_addresses'],
+        packet_timeout=config['packet_timeout'],
+        get_state=lambda: alarm_state['current_state'],
+        set_state=update_alarm_state,
+        probe=lambda: arp_ping_macs(config['mac_addresses']),
+        last_packet=last_packet
+    )
+
+def start_service_threads():
+    """
+    Starts the threads that only need setup_services.
+    """
+    state_writer_thread = Thread(name='state_writer', target=state_store.run)
+    state_writer_thread.daemon = True
+    state_writer_thread.start()
+    if archiver:
+        archive_thread = Thread(name='archive', target=archiver.run)
+        archive_thread.daemon = True
+        archive_thread.start()
+    if config['metrics_port'] > 0:
+        metrics_thread = Thread(name='serve_metrics', target=serve_metrics, kwargs={'address': config['metrics_address'], 'port': config['metrics_port']})
+        metrics_thread.daemon = True
+        metrics_thread.start()
+    if coordinator:
+        coordinator_thread = Thread(name='coordinator', target=coordinator.serve if config['coordinator_role'] == 'leader' else coordinator.run)
+        coordinator_thread.daemon = True
+        coordinator_thread.start()
+
+def start_capture_threads():
+    """
+    Starts capturing motion events, which needs the camera.
+    """
+    capture_scheduler_thread = Thread(name='capture_scheduler', target=capture_scheduler.run)
+    capture_scheduler_thread.daemon = True
+    capture_scheduler_thread.start()
+
+def start_telegram_threads():
+    """
+    Starts the bot and sending captured files, which need Telegram and scapy for the ARP ping before each event.
+    Nodes have no bot and send captured files to the leader.
+    """
+    if config['coordinator_role'] != 'node':
+        telegram_bot_thread = Thread(name='telegram_bot', target=telegram_bot, kwargs={'token': config['telegram_bot_token']})
+        telegram_bot_thread.daemon = True
+        telegram_bot_thread.start()
+    process_photos_thread = Thread(name='process_photos', target=process_photos)
+    process_photos_thread.daemon = True
+    process_photos_thread.start()
+
+def start_presence_threads():
+    """
+    Starts arming and disarming from packets, which needs scapy and Telegram for state change messages.
+    Nodes only capture packets, the leader arms and disarms.
+    """
+    if presence_monitor:
+        monitor_alarm_state_thread = Thread(name='monitor_alarm_state', target=monitor_alarm_state)
+        monitor_alarm_state_thread.daemon = True
+        monitor_alarm_state_thread.start()
+    capture_packets_thread = Thread(name='capture_packets', target=capture_packets, kwargs={'network_interface': config['network_interface'], 'network_interface_mac': config['network_interface_mac'], 'mac_addresses': config['mac_addresses']})
+    capture_packets_thread.daemon = True
+    capture_packets_thread.start()
+
+def start_threads():
+    start_service_threads()
+    start_capture_threads()
+    start_telegram_threads()
+    start_presence_threads()
+
+def start_pir():
+    if config['motion_detection'] in ['pir', 'both']:
+        GPIO.setup(config['pir_pin'], GPIO.IN)
+        GPIO.add_event_detect(config['pir_pin'], GPIO.RISING, callback=motion_detected)
+
+def start_camera_motion_detection():
+    global camera_motion_detector
+    if config['motion_detection'] in ['camera', 'both']:
+        camera_motion_detector = CameraMotionDetector(
+            size=config['camera_motion_size'],
+            callback=motion_detected,
+            zones=config['camera_motion_zones'],
+            threshold=config['camera_motion_threshold'],
+            min_blocks=config['camera_motion_blocks'],
+            max_fps=config['camera_motion_fps'],
+            cpu_budget=config['camera_motion_cpu']
+        )
+        camera.start_recording(camera_motion_detector, format='yuv', resize=config['camera_motion_size'], splitter_port=2)
+
+def start_motion_detection():
+    """
+    Starts detecting motion with the PIR sensor, the camera or both.
+    """
+    start_pir()
+    start_camera_motion_detection()
+
+def sd_notify(message):
+    """
+    Sends a notification such as READY=1 to systemd when run as a Type=notify service. Returns True if sent.
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        notify_socket.connect(address)
+        notify_socket.sendall(message.encode('utf-8'))
+    except socket.error as e:
+        logger.debug('Failed to notify systemd: %s' % e)
+        return False
+    finally:
+        notify_socket.close()
+    return True
+
+class Startup(object):
+    """
+    Runs the slow parts of startup in threads and records when each phase started and finished, relative
+    to when the process started. Progress is reported to systemd as the service status.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.start_time = clock()
+        self.timings = OrderedDict()
+        self.threads = {}
+        self.errors = {}
+        self.lock = Lock()
+
+    def mark(self, phase, started=None):
+        now = self.clock() - self.start_time
+        with self.lock:
+            self.timings[phase] = (started - self.start_time if started else None, now)
+        sd_notify('STATUS=Started %s after %.2fs' % (phase, now))
+
+    def run(self, phase, function):
+        """
+        Runs function in its own thread. wait() returns when it has finished.
+        """
+        def target():
+            started = self.clock()
+            try:
+                function()
+            except Exception as e:
+                self.errors[phase] = e
+            else:
+                self.mark(phase, started)
+        phase_thread = Thread(name='startup_%s' % phase, target=target)
+        phase_thread.daemon = True
+        phase_thread.start()
+        self.threads[phase] = phase_thread
+
+    def wait(self, phase):
+        """
+        Waits for a phase started with run() and raises its exception if it failed.
+        """
+        self.threads[phase].join()
+        if phase in self.errors:
+            raise self.errors[phase]
+
+    def summary(self):
+        with self.lock:
+            timings = list(self.timings.items())
+        return ', '.join(['%s %.2fs' % (phase, finished) + (' (took %.2fs)' % (finished - started) if started is not None else '') for phase, (started, finished) in timings])
+
+def load_gpio():
+    import RPi.GPIO
+    setup_gpio(RPi.GPIO)
+
+def load_camera():
+    import picamera
+    setup_camera(picamera)
+
+def load_imaging():
+    global Image, np
+    from PIL import Image
+    import numpy as np
+
+def load_telegram():
+    global bot, InputMediaPhoto, Updater, CommandHandler, MessageHandler, Filters, RegexHandler
+    import telegram
+    from telegram import InputMediaPhoto
+    from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, RegexHandler
+    bot = telegram.Bot(token=config['telegram_bot_token'])
+
+def load_scapy():
+    global srp, Ether, ARP
+    logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
+    from scapy.all import srp, Ether, ARP
+    from scapy.all import conf as scapy_conf
+    scapy_conf.promisc=0
+    scapy_conf.sniff_promisc=0
+
+def start(startup):
+    """
+    Starts everything in order of urgency. The PIR sensor is set up first, before any slow module is
+    imported, so motion is recorded within a fraction of a second. The camera, PIL and numpy, Telegram and
+    scapy are then loaded in parallel and each thread is started as soon as what it needs is ready.
+    Motion events are captured once the camera is ready and captured files wait in the upload queue and
+    outbox until Telegram is ready. systemd is told the service is ready once the PIR sensor is set up.
+    The load_ functions can be replaced to start with other backends.
+    """
+    load_gpio()
+    setup_services()
+    start_service_threads()
+    start_pir()
+    startup.mark('pir')
+    # Motion is recorded from here on. The slow phases can take longer than systemd's start timeout on
+    # older boards, so they are only reported as the status
+    sd_notify('READY=1')
+    startup.run('camera', load_camera)
+    startup.run('imaging', load_imaging)
+    if config['coordinator_role'] != 'node':
+        startup.run('telegram', load_telegram)
+    startup.run('scapy', load_scapy)
+    try:
+        startup.wait('camera')
+    except Exception as e:
+        exit_error('Camera module failed to intialise with error %s' % e)
+    setup_pre_trigger_buffer()
+    try:
+        # GIFs and camera motion detection need PIL and numpy, photos and videos can be captured without
+        if config['camera_mode'].lower() == 'gif' or config['motion_detection'] in ['camera', 'both']:
+            startup.wait('imaging')
+    except Exception as e:
+        exit_error('Failed to import PIL and numpy with error: %s' % e)
+    start_capture_threads()
+    start_camera_motion_detection()
+    startup.mark('capture')
+    try:
+        if config['coordinator_role'] != 'node':
+            startup.wait('telegram')
+    except Exception as e:
+        exit_error('Failed to connect to Telegram with error: %s' % e)
+    try:
+        startup.wait('scapy')
+    except Exception as e:
+        exit_error('Failed to import scapy with error: %s' % e)
+    start_telegram_threads()
+    start_presence_threads()
+    try:
+        startup.wait('imaging')
+    except Exception as e:
+        exit_error('Failed to import PIL and numpy with error: %s' % e)
+    startup.mark('ready')
 
 def exit_cleanup():
-    GPIO.cleanup()
-    if 'camera' in vars():
+    if 'state_store' in globals():
+        try:
+            state_store.close()
+        except Exception as e:
+            logger.error('Failed to close state store: %s' % e)
+    if 'GPIO' in globals():
+        GPIO.cleanup()
+    if 'camera' in globals():
         camera.close()
 
 def exit_clean(signal=None, frame=None):
@@ -402,9 +3517,7 @@ def exit_clean(signal=None, frame=None):
 def exit_error(message):
     logger.critical(message)
     exit_cleanup()
-    try:
-        current_thread().getName()
-    except NameError:
+    if current_thread().getName() == 'MainThread':
         sys.exit(1)
     else:
         os._exit(1)
@@ -436,14 +3549,24 @@ def setup_logging(debug_mode=False, log_to_stdout=False):
     return logger
 
 if __name__ == "__main__":
-    GPIO.setwarnings(False)
+    startup = Startup()
     # Parse arguments and configuration, set up logging
     args = parse_arguments()
     config = parse_config_file(args.config_file)
     logger = setup_logging(debug_mode=config['debug_mode'], log_to_stdout=args.debug)
-    state = read_state_file(args.state_file)
+    try:
+        state_store = StateStore(
+            args.state_dir,
+            snapshot_bytes=config['state_snapshot_kb'] * 1024,
+            history_bytes=config['state_history_mb'] * 1024 * 1024
+        )
+    except Exception as e:
+        exit_error('Failed to open state store %s with error: %s' % (args.state_dir, e))
+    migrate_state_file(os.path.join(os.path.dirname(args.state_dir), 'state.yaml'), state_store)
+    state = {}
+    if state_store.get('telegram_chat_id') is not None:
+        state['telegram_chat_id'] = state_store.get('telegram_chat_id')
     sys.excepthook = exception_handler
-    captured_from_camera = []
     # Some intial checks before proceeding
     if check_monitor_mode(config['network_interface']):
         config['network_interface_mac'] = get_interface_mac_addr(config['network_interface'])
@@ -453,60 +3576,13 @@ if __name__ == "__main__":
         exit_error('Interface %s does not exist, is not in monitor mode, is not up or MAC address unknown.' % config['network_interface'])
     if not os.geteuid() == 0:
         exit_error('%s must be run as root' % sys.argv[0])
-    # Now begin importing slow modules and setting up camera, Telegram and threads
-    import picamera
-    logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
-    from scapy.all import srp, Ether, ARP
-    from scapy.all import conf as scapy_conf
-    scapy_conf.promisc=0
-    scapy_conf.sniff_promisc=0
-    import telegram
-    from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, RegexHandler
-    from threading import Thread, current_thread
-    from PIL import Image
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setup(32, GPIO.OUT, initial=False)
-    try:
-        camera = picamera.PiCamera()
-        camera.resolution = config['camera_image_size']
-        camera.vflip = config['camera_vflip']
-        camera.led = False
-    except Exception as e:
-        exit_error('Camera module failed to intialise with error %s' % e)
-    try:
-        bot = telegram.Bot(token=config['telegram_bot_token'])
-    except Exception as e:
-        exit_error('Failed to connect to Telegram with error: %s' % e)
-    # Set the initial alarm_state dictionary
-    alarm_state = {
-        'start_time': time.time(),
-        'current_state': 'disarmed',
-        'previous_state': 'stopped',
-        'last_state_change': time.time(),
-        'last_packet': time.time(),
-        'last_packet_mac': None,
-        'alarm_triggered': False
-    }
-    # Start the threads
-    telegram_bot_thread = Thread(name='telegram_bot', target=telegram_bot, kwargs={'token': config['telegram_bot_token']})
-    telegram_bot_thread.daemon = True
-    telegram_bot_thread.start()
-    monitor_alarm_state_thread = Thread(name='monitor_alarm_state', target=monitor_alarm_state)
-    monitor_alarm_state_thread.daemon = True
-    monitor_alarm_state_thread.start()
-    capture_packets_thread = Thread(name='capture_packets', target=capture_packets, kwargs={'network_interface': config['network_interface'], 'network_interface_mac': config['network_interface_mac'], 'mac_addresses': config['mac_addresses']})
-    capture_packets_thread.daemon = True
-    capture_packets_thread.start()
-    process_photos_thread = Thread(name='process_photos', target=process_photos)
-    process_photos_thread.daemon = True
-    process_photos_thread.start()
+    startup.mark('config')
     signal.signal(signal.SIGTERM, exit_clean)
-    time.sleep(2)
     try:
-        GPIO.setup(config['pir_pin'], GPIO.IN)
-        GPIO.add_event_detect(config['pir_pin'], GPIO.RISING, callback=motion_detected)
-        logger.info("rpi-security running")
-        telegram_send_message('rpi-security running')
+        start(startup)
+        logger.info("rpi-security running, startup timings: %s" % startup.summary())
+        if config['coordinator_role'] != 'node':
+            telegram_send_message('rpi-security running')
         while 1:
             time.sleep(100)
     except KeyboardInterrupt:
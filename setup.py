@@ -12,8 +12,7 @@ setup(
     scripts = [ 'bin/rpi-security.py' ],
     data_files=[
         ('/lib/systemd/system', ['etc/rpi-security.service']),
-        ('/etc', ['etc/rpi-security.conf']),
-        ('/var/lib/rpi-security', ['etc/state.yaml'])
+        ('/etc', ['etc/rpi-security.conf'])
     ],
     install_requires=[
         'python-telegram-bot',
@@ -22,9 +21,14 @@ setup(
         'requests[security]',
         'netaddr',
         'netifaces',
+        # Reads the state.yaml file of earlier versions when it is migrated
         'pyyaml',
-        'Pillow>=3.4.0'
+        'Pillow>=3.4.0',
+        'numpy'
     ],
+    extras_require={
+        's3': ['boto3']
+    },
     classifiers=[
     'Environment :: Console',
         'Operating System :: POSIX',